@@ -0,0 +1,154 @@
+import atexit
+from collections import deque
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import clients
+
+
+class BigQuerySink:
+    # Appends a batch of rows to a BigQuery table with a single load job. The rows are sent as JSON with the
+    # table's schema, so neither pandas nor pandas_gbq is needed (or imported) to get them in.
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def write(self, rows):
+        from google.cloud import bigquery
+        job_config = bigquery.LoadJobConfig(schema=clients.get_table(self.table_name).schema,
+                                            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        json_rows = json.loads(json.dumps(rows, default=str))
+        clients.bigquery_client().load_table_from_json(json_rows, self.table_name, job_config=job_config).result()
+
+
+class JsonLinesSink:
+    # Local stand-in for BigQuery: every row becomes one line in a file
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, rows):
+        with open(self.path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row, default=str) + "\n")
+
+
+class SqliteSink:
+    # Local stand-in for BigQuery: rows are appended to a SQLite table as JSON payloads
+    def __init__(self, path, table_name='rows'):
+        self.path = path
+        self.table_name = table_name
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} (payload TEXT)")
+
+    def write(self, rows):
+        with sqlite3.connect(self.path) as conn:
+            conn.executemany(f"INSERT INTO {self.table_name} (payload) VALUES (?)",
+                             [(json.dumps(row, default=str),) for row in rows])
+
+
+class BufferedWriter:
+    # Collects rows in memory and writes them to the sink in bulk once max_rows rows are buffered
+    # or the oldest buffered row is older than max_age_seconds. Whatever is left is flushed at shutdown, as far as
+    # the platform lets the timer thread and atexit run: rows still buffered when an instance is stopped are lost.
+    # Rows that failed to write are retried with the next flush. While the sink keeps failing, at most
+    # max_buffered_rows rows are kept, the oldest ones are dropped (and counted in dropped_rows).
+    def __init__(self, sink, max_rows=500, max_age_seconds=10.0, max_buffered_rows=10000):
+        self.sink = sink
+        self.max_rows = max_rows
+        self.max_age_seconds = max_age_seconds
+        self.max_buffered_rows = max_buffered_rows
+        self._rows = []
+        self._oldest_row_time = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flush_count = 0
+        self.rows_flushed = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        self.flush_latencies = deque(maxlen=1000)
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+        atexit.register(self.flush)
+
+    def append(self, row):
+        with self._lock:
+            if not self._rows:
+                self._oldest_row_time = time.time()
+            self._rows.append(row)
+            dropped = self._drop_oldest()
+            is_due = self._is_due()
+        if dropped:
+            logging.warning(f"Dropped the {dropped} oldest buffered rows, {self.dropped_rows} so far")
+        if is_due:
+            self.flush()
+
+    def _drop_oldest(self):
+        # Called with _lock held
+        excess = len(self._rows) - self.max_buffered_rows
+        if excess <= 0:
+            return 0
+        del self._rows[:excess]
+        self.dropped_rows += excess
+        return excess
+
+    def _is_due(self):
+        if not self._rows:
+            return False
+        if len(self._rows) >= self.max_rows:
+            return True
+        return time.time() - self._oldest_row_time >= self.max_age_seconds
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.max_age_seconds)
+            with self._lock:
+                is_due = self._is_due()
+            if is_due:
+                self.flush()
+
+    def flush(self):
+        # Only one flush talks to the sink at a time, so the rows keep their order
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._oldest_row_time = None
+            if not rows:
+                return 0
+
+            flush_start = time.time()
+            try:
+                self.sink.write(rows)
+            except Exception as e:
+                # Put the rows back so they are retried with the next flush
+                with self._lock:
+                    self._rows = rows + self._rows
+                    self._oldest_row_time = flush_start
+                    dropped = self._drop_oldest()
+                self.failed_flushes += 1
+                logging.error(f"Flushing {len(rows)} rows failed: {e}")
+                if dropped:
+                    logging.warning(f"Dropped the {dropped} oldest buffered rows, {self.dropped_rows} so far")
+                return 0
+
+            latency = time.time() - flush_start
+            self.flush_count += 1
+            self.rows_flushed += len(rows)
+            self.flush_latencies.append(latency)
+            logging.info(f"Flushed {len(rows)} rows in {latency:.3f}s")
+            return len(rows)
+
+    def stats(self):
+        with self._lock:
+            buffered_rows = len(self._rows)
+        latencies = self.flush_latencies
+        return {
+            'flush_count': self.flush_count,
+            'rows_flushed': self.rows_flushed,
+            'failed_flushes': self.failed_flushes,
+            'dropped_rows': self.dropped_rows,
+            'buffered_rows': buffered_rows,
+            'avg_flush_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+            'max_flush_seconds': max(latencies) if latencies else 0.0
+        }
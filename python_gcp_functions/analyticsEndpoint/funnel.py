@@ -0,0 +1,221 @@
+import argparse
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+# Level funnel of the experiment per serving strategy from exports of match3.tracking, in the shape of
+# r_results_analysis/level_data_final.csv that levels.R and ratings.R read:
+#
+#   python funnel.py exports/ --checkpoint funnel_checkpoint.json --output level_data_final.csv
+#
+# Exports are newline delimited JSON or CSV files (optionally .gz), or directories of them. They are read in chunks
+# of --chunk-rows rows, so memory doesn't grow with their size, and counted per strategy, game_version, level
+# group (first_level: current_level 1, all_levels) and event. After every chunk the counts and how far every file
+# has been read go into the checkpoint, so a run can be stopped and resumed, and when new export files arrive only
+# those are read. CSV files are read by the CSV parser (quoted fields can span lines), NDJSON files line by line.
+#
+# The tracking table has screen views, not level events, and no screen marks the start of a level (the
+# InstructionScreen is only shown once). So the events are what the screens do say: level_completed is a level
+# played to the end (a WinScreen or LostScreen, abandoned levels leave no screen view) and level_passed a WinScreen.
+# levels.R and ratings.R read Firebase's level_start / level_end, so by default the output has the counts under
+# those names (OUTPUT_EVENT_NAMES), with completed levels standing in for started ones (fewer than were started).
+# --event-names level_completed,level_passed writes them under their own names, --completed-screens /
+# --passed-screens change the screens.
+
+COLUMNS = ['screen_name', 'world_served', 'game_version', 'current_level']
+COMPLETED_SCREENS = ['WinScreen', 'LostScreen']
+PASSED_SCREENS = ['WinScreen']
+LEVEL_GROUPS = ['first_level', 'all_levels']
+EVENTS = ['level_completed', 'level_passed']
+OUTPUT_EVENT_NAMES = ['level_start', 'level_end']
+CHUNK_ROWS = 500000
+CHECKPOINT_VERSION = 2
+
+
+def export_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith(('.json', '.jsonl', '.ndjson', '.csv', '.gz')))
+        else:
+            files.append(path)
+    return files
+
+
+def _is_csv(path):
+    return path[:-len('.gz')].endswith('.csv') if path.endswith('.gz') else path.endswith('.csv')
+
+
+def _open(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+class FunnelAggregator:
+    def __init__(self, completed_screens=COMPLETED_SCREENS, passed_screens=PASSED_SCREENS):
+        self.screens = {'level_completed': list(completed_screens), 'level_passed': list(passed_screens)}
+        # (strategy, game_version, level_group, event) -> count
+        self.counts = defaultdict(int)
+        # How much of every file is already counted: rows after the header for CSV, bytes for NDJSON (of the
+        # uncompressed data for .gz)
+        self.offsets = {}
+        self.rows = 0
+
+    def add_chunk(self, df):
+        # Counts one chunk of tracking rows (a DataFrame with COLUMNS)
+        import pandas as pd
+        df = df.reindex(columns=COLUMNS)
+        strategy = df['world_served'].fillna('').astype(str)
+        # Exports have integers as numbers or strings (and versions may be missing), they are counted as '3' or ''
+        # (a missing version is '<NA>' or, with pandas' string dtype, still missing after astype(str))
+        game_version = pd.to_numeric(df['game_version'], errors='coerce').astype('Int64').astype(str) \
+            .fillna('').replace('<NA>', '')
+        first_level = pd.to_numeric(df['current_level'], errors='coerce') == 1
+        for event in EVENTS:
+            is_event = df['screen_name'].isin(self.screens[event])
+            for level_group, mask in (('all_levels', is_event), ('first_level', is_event & first_level)):
+                if not mask.any():
+                    continue
+                for (strategy_value, version), count in \
+                        mask[mask].groupby([strategy[mask], game_version[mask]]).size().items():
+                    self.counts[(strategy_value, version, level_group, event)] += int(count)
+        self.rows += int(df.notna().any(axis=1).sum())
+
+    def read_file(self, path, chunk_rows=CHUNK_ROWS, on_chunk=None):
+        # Counts the file from where the last read of it stopped
+        if _is_csv(path):
+            self._read_csv(path, chunk_rows, on_chunk)
+        else:
+            self._read_json_lines(path, chunk_rows, on_chunk)
+
+    def _read_csv(self, path, chunk_rows, on_chunk):
+        # Blank lines are kept as empty rows, so the rows skipped on resuming are the rows counted before
+        import pandas as pd
+        done = self.offsets.get(path, 0)
+        with _open(path) as f:
+            try:
+                chunks = pd.read_csv(f, usecols=lambda column: column in COLUMNS, dtype=str, chunksize=chunk_rows,
+                                     skiprows=range(1, done + 1), skip_blank_lines=False)
+            except pd.errors.EmptyDataError:
+                return
+            for df in chunks:
+                self.add_chunk(df)
+                self.offsets[path] = self.offsets.get(path, 0) + len(df)
+                if on_chunk:
+                    on_chunk()
+
+    def _read_json_lines(self, path, chunk_rows, on_chunk):
+        # One row per line, a line can be cut at any line break
+        import pandas as pd
+        with _open(path) as f:
+            if self.offsets.get(path):
+                f.seek(self.offsets[path])
+            while True:
+                lines = [line for line in itertools.islice(f, chunk_rows) if line.strip()]
+                if not lines:
+                    break
+                self.add_chunk(pd.read_json(io.BytesIO(b''.join(lines)), lines=True, dtype=False))
+                self.offsets[path] = f.tell()
+                if on_chunk:
+                    on_chunk()
+
+    def rows_for_csv(self, game_versions=None, by_game_version=False, event_names=OUTPUT_EVENT_NAMES):
+        # Rows in the order of level_data_final.csv: per strategy, first_level then all_levels, completed then passed,
+        # with the events named event_names
+        totals = defaultdict(int)
+        for (strategy, version, level_group, event), count in self.counts.items():
+            if game_versions and version not in game_versions:
+                continue
+            totals[(strategy, version if by_game_version else None, level_group, event)] += count
+        strategies = sorted({key[0] for key in totals})
+        versions = sorted({key[1] for key in totals}, key=lambda version: (version is None, str(version)))
+        rows = []
+        for strategy in strategies:
+            for version in versions:
+                if not any(key[0] == strategy and key[1] == version for key in totals):
+                    continue
+                for level_group in LEVEL_GROUPS:
+                    for event, event_name in zip(EVENTS, event_names):
+                        count = totals.get((strategy, version, level_group, event), 0)
+                        rows.append([strategy] + ([version] if by_game_version else []) +
+                                    [level_group, event_name, count])
+        return rows
+
+    def write_csv(self, path, game_versions=None, by_game_version=False, event_names=OUTPUT_EVENT_NAMES):
+        header = ['serving_strategy'] + (['game_version'] if by_game_version else []) + \
+            ['level_group', 'event_name', 'cnt']
+        lines = [','.join(header)] + [','.join(str(value) for value in row)
+                                      for row in self.rows_for_csv(game_versions, by_game_version, event_names)]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+
+    def to_json(self):
+        return json.dumps({'version': CHECKPOINT_VERSION, 'screens': self.screens, 'offsets': self.offsets,
+                           'rows': self.rows, 'counts': [list(key) + [count] for key, count in self.counts.items()]})
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_json())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, completed_screens=COMPLETED_SCREENS, passed_screens=PASSED_SCREENS):
+        aggregator = cls(completed_screens, passed_screens)
+        if not path or not os.path.exists(path):
+            return aggregator
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['version'] != CHECKPOINT_VERSION or checkpoint['screens'] != aggregator.screens:
+            raise ValueError(f"{path} was made with other settings, remove it to start over")
+        aggregator.offsets = checkpoint['offsets']
+        aggregator.rows = checkpoint['rows']
+        for *key, count in checkpoint['counts']:
+            aggregator.counts[tuple(key)] = count
+        return aggregator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Level funnel per serving strategy from match3.tracking exports")
+    parser.add_argument('exports', nargs='+', help="NDJSON / CSV export files (optionally .gz) or directories")
+    parser.add_argument('--output', default='level_data_final.csv')
+    parser.add_argument('--checkpoint', help="file to resume from and save progress to")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="rows read at once")
+    parser.add_argument('--game-version', action='append', help="only count these game versions")
+    parser.add_argument('--by-game-version', action='store_true',
+                        help="add a game_version column (not the shape the Stan models read)")
+    parser.add_argument('--completed-screens', default=','.join(COMPLETED_SCREENS))
+    parser.add_argument('--passed-screens', default=','.join(PASSED_SCREENS))
+    parser.add_argument('--event-names', default=','.join(OUTPUT_EVENT_NAMES),
+                        help="names of the completed and passed counts in the output, the ones levels.R reads by "
+                             "default")
+    args = parser.parse_args()
+    event_names = args.event_names.split(',')
+    if len(event_names) != len(EVENTS):
+        parser.error(f"--event-names needs {len(EVENTS)} names")
+
+    logging.basicConfig(level=logging.INFO)
+    aggregator = FunnelAggregator.load(args.checkpoint, args.completed_screens.split(','),
+                                       args.passed_screens.split(','))
+    start, start_rows = time.time(), aggregator.rows
+
+    def save_checkpoint():
+        if args.checkpoint:
+            aggregator.save(args.checkpoint)
+
+    for path in export_files(args.exports):
+        aggregator.read_file(path, args.chunk_rows, save_checkpoint)
+        logging.info(f"{path} done, {aggregator.rows} rows counted")
+    seconds = time.time() - start
+    logging.info(f"{aggregator.rows - start_rows} new rows in {seconds:.1f}s "
+                 f"({(aggregator.rows - start_rows) / max(seconds, 1e-9):.0f} rows/s)")
+    aggregator.write_csv(args.output, args.game_version, args.by_game_version, event_names)
+
+
+if __name__ == '__main__':
+    main()
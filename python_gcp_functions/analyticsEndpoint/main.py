@@ -1,18 +1,39 @@
-import pandas as pd
-import pandas_gbq
+import os
+from datetime import datetime
+
+from buffered_writer import BigQuerySink, BufferedWriter, JsonLinesSink
+
+# Screen events are buffered per instance and appended to BigQuery in bulk instead of one load job per event.
+# TRACKING_SINK_PATH redirects the rows to a local file, e.g. when running the function locally.
+TRACKING_FLUSH_ROWS = int(os.environ.get('TRACKING_FLUSH_ROWS', 200))
+TRACKING_FLUSH_SECONDS = float(os.environ.get('TRACKING_FLUSH_SECONDS', 10))
+TRACKING_MAX_BUFFERED_ROWS = int(os.environ.get('TRACKING_MAX_BUFFERED_ROWS', 10000))
+# Buffered events are acknowledged before they are written, so the ones an instance still holds when it is stopped
+# are lost. With TRACKING_FLUSH_BEFORE_RESPONSE=1 every request writes the buffer out before it responds (requests
+# running at the same time still share a load job), at the cost of a load job per request otherwise.
+TRACKING_FLUSH_BEFORE_RESPONSE = os.environ.get('TRACKING_FLUSH_BEFORE_RESPONSE', '') == '1'
+
+if os.environ.get('TRACKING_SINK_PATH'):
+    tracking_sink = JsonLinesSink(os.environ['TRACKING_SINK_PATH'])
+else:
+    tracking_sink = BigQuerySink("match3.tracking")
+
+tracking_writer = BufferedWriter(tracking_sink, max_rows=TRACKING_FLUSH_ROWS, max_age_seconds=TRACKING_FLUSH_SECONDS,
+                                 max_buffered_rows=TRACKING_MAX_BUFFERED_ROWS)
 
 
 def main(request):
     data = request.get_json()
-    data_dict = {
-        'created_date': [pd.to_datetime(data['createdDate'])],
-        'user_id': [data['userId']],
-        'level_uid': [data['levelGuid']],
-        'current_level': [data['currentLevel']],
-        'screen_name': [data['screenName']],
-        'world_served': [data['worldServed']],
-        'game_version': [int(data.get('gameVersion', 0))]
+    row = {
+        'created_date': datetime.strptime(data['createdDate'], '%Y-%m-%d %H:%M:%S'),
+        'user_id': data['userId'],
+        'level_uid': data['levelGuid'],
+        'current_level': data['currentLevel'],
+        'screen_name': data['screenName'],
+        'world_served': data['worldServed'],
+        'game_version': int(data.get('gameVersion', 0))
     }
-    df_logs = pd.DataFrame(data_dict)
-    pandas_gbq.to_gbq(df_logs, "match3.tracking", if_exists='append')
+    tracking_writer.append(row)
+    if TRACKING_FLUSH_BEFORE_RESPONSE:
+        tracking_writer.flush()
     return "ok"
@@ -0,0 +1,91 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+# Rows per second of the batch descriptions (batch_descriptions.py) against generate_descriptions' df.apply over
+# generate_sentence_per_row / generate_sentence_per_row_w_stats per player, for a multi-player DataFrame, and a
+# check that both give the same text for every player.
+#
+#   python benchmarks/description_throughput.py [--users 10,100,1000] [--levels-per-user 30]
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+ENDPOINT_DIR = os.path.join(FUNCTIONS_DIR, 'levelStatsEndpoint')
+STAT_COLUMNS = ['score', 'moves_left', 'num_failed_moves', 'num_clicks_on_board', 'num_boosters_used']
+
+
+def histories(num_users, levels_per_user, seed=0):
+    # Made-up histories of many players in the shape of FeatureStore.history_df, with the stats of
+    # cluster_stats.describe (zeros for some levels, as for a cluster without data) and the gaps real data has
+    import pandas as pd
+    sys.path[:0] = [BENCHMARKS_DIR]
+    from prompt_size import history
+    rng = np.random.default_rng(seed)
+    num_rows = num_users * levels_per_user
+    df = history(num_rows, seed)
+    df.insert(0, 'user_id', np.repeat([f'user-{i}' for i in range(num_users)], levels_per_user))
+    df['level_in_row'] = np.tile(np.arange(1, levels_per_user + 1), num_users)
+    df['user_rating'] = [None if missing else rating for missing, rating in
+                         zip(rng.random(num_rows) < 0.3, df['user_rating'])]
+    df['collection_goals'] = [None if i % 7 == 0 else goals + [np.nan] if i % 5 == 0 else goals
+                              for i, goals in enumerate(df['collection_goals'])]
+    has_stats = rng.random(num_rows) < 0.8
+    stats = {}
+    for column in STAT_COLUMNS:
+        mean = rng.uniform(1, 1000, num_rows)
+        stats[f'avg_{column}'] = np.where(has_stats, np.round(mean, 2), 0)
+        stats[f'median_{column}'] = np.where(has_stats, np.round(mean * 0.9, 0), 0).astype(int)
+        stats[f'min_{column}'] = np.where(has_stats, 0, 0)
+        stats[f'max_{column}'] = np.where(has_stats, np.round(mean * 2), 0).astype(int)
+    return pd.concat([df, pd.DataFrame(stats, dtype=object)], axis=1)
+
+
+def per_user_apply(endpoint, df, use_stats):
+    # generate_descriptions' path without a token budget, one player at a time
+    descriptions = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user_id, df_user in df.groupby('user_id', sort=False):
+            if use_stats:
+                sentences = df_user.apply(lambda row: endpoint.generate_sentence_per_row(row) if row['max_score'] == 0
+                                          else endpoint.generate_sentence_per_row_w_stats(row), axis=1)
+            else:
+                sentences = df_user.apply(endpoint.generate_sentence_per_row, axis=1)
+            descriptions[user_id] = '\n'.join(sentences)
+    return descriptions
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='10,100,1000')
+    parser.add_argument('--levels-per-user', type=int, default=30)
+    args = parser.parse_args()
+
+    sys.path[:0] = [ENDPOINT_DIR, FAKES_DIR]
+    import main as endpoint
+    from batch_descriptions import descriptions_per_user
+
+    print("  users     rows  stats      batch rows/s      apply rows/s   speedup")
+    for num_users in [int(users) for users in args.users.split(',')]:
+        df = histories(num_users, args.levels_per_user)
+        for use_stats in (False, True):
+            batch, batch_seconds = timed(lambda: descriptions_per_user(df, use_stats))
+            applied, apply_seconds = timed(lambda: per_user_apply(endpoint, df, use_stats))
+            assert batch == applied, "batch descriptions differ from generate_sentence_per_row(_w_stats)"
+            print(f"{num_users:>7} {len(df):>8} {str(use_stats):>6} {len(df) / batch_seconds:>17,.0f} "
+                  f"{len(df) / apply_seconds:>17,.0f} {apply_seconds / batch_seconds:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
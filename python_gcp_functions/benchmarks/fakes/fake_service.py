@@ -0,0 +1,62 @@
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+# Latency and failures of the fake cloud services. Every fake call goes through call(service, operation), which
+# sleeps for the configured latency (+-50% jitter) and fails with the configured rate.
+#
+#   FAKE_LATENCY_MS="bigquery=60,storage=40,openai=4000,openai.chat_completion=6000"
+#   FAKE_FAILURE_RATE="openai=0.02"
+#
+# Keys are a service or service.operation, the more specific one wins. Timings of every call are kept in
+# `timings` per service.operation.
+
+
+class FakeServiceError(Exception):
+    pass
+
+
+def _parse(value):
+    settings = {}
+    for item in value.split(','):
+        if '=' in item:
+            key, number = item.split('=', 1)
+            settings[key.strip()] = float(number)
+    return settings
+
+
+latency_ms = _parse(os.environ.get('FAKE_LATENCY_MS', ''))
+failure_rate = _parse(os.environ.get('FAKE_FAILURE_RATE', ''))
+timings = defaultdict(list)
+_lock = threading.Lock()
+
+
+def configure(latency=None, failures=None):
+    if latency is not None:
+        latency_ms.clear()
+        latency_ms.update(latency)
+    if failures is not None:
+        failure_rate.clear()
+        failure_rate.update(failures)
+
+
+def reset():
+    with _lock:
+        timings.clear()
+
+
+def _setting(settings, service, operation):
+    return settings.get(f"{service}.{operation}", settings.get(service, 0))
+
+
+def call(service, operation):
+    start = time.perf_counter()
+    delay = _setting(latency_ms, service, operation)
+    if delay:
+        time.sleep(delay * random.uniform(0.5, 1.5) / 1000)
+    with _lock:
+        timings[f"{service}.{operation}"].append(time.perf_counter() - start)
+    if random.random() < _setting(failure_rate, service, operation):
+        raise FakeServiceError(f"Fake {service}.{operation} failed")
@@ -0,0 +1,9 @@
+# Fake google.api_core.exceptions for the benchmarks, the errors the fake clients raise
+
+
+class GoogleAPICallError(Exception):
+    pass
+
+
+class Conflict(GoogleAPICallError):
+    pass
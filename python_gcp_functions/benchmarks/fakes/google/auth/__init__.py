@@ -0,0 +1,10 @@
+# Fake google.auth for the benchmarks, the credentials are never sent anywhere
+
+
+class Credentials:
+    token = 'fake-token'
+    valid = True
+
+
+def default(scopes=None):
+    return Credentials(), 'match3-local'
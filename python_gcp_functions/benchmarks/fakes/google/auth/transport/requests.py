@@ -0,0 +1,10 @@
+# Fake AuthorizedSession for the benchmarks, the fake clients never use it to send anything
+
+
+class AuthorizedSession:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.adapters = {}
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
@@ -0,0 +1,117 @@
+# Fake google.cloud.bigquery for the benchmarks. Everything that is written is kept in `written` per table,
+# latency and failures come from fake_service.
+from collections import defaultdict
+
+import fake_service
+from google.api_core.exceptions import Conflict
+
+written = defaultdict(list)
+# Load jobs started with a job_id, by id
+jobs = {}
+
+
+class SchemaField:
+    def __init__(self, name, field_type, mode='NULLABLE'):
+        self.name = name
+        self.field_type = field_type
+        self.mode = mode
+
+
+class Table:
+    def __init__(self, table_id):
+        self.table_id = table_id
+        self.schema = []
+
+
+class SourceFormat:
+    PARQUET = 'PARQUET'
+    NEWLINE_DELIMITED_JSON = 'NEWLINE_DELIMITED_JSON'
+
+
+class WriteDisposition:
+    WRITE_APPEND = 'WRITE_APPEND'
+
+
+class ScalarQueryParameter:
+    def __init__(self, name, type_, value):
+        self.name = name
+        self.type_ = type_
+        self.value = value
+
+
+class QueryJobConfig:
+    def __init__(self, query_parameters=None, **kwargs):
+        self.query_parameters = query_parameters or []
+        self.__dict__.update(kwargs)
+
+
+class LoadJobConfig:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Job:
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.state = 'DONE'
+        self.error_result = None
+
+    def result(self, timeout=None):
+        return self
+
+
+class QueryJob:
+    # Queries return no rows
+    def result(self, timeout=None):
+        return iter([])
+
+
+class Client:
+    def __init__(self, project=None, credentials=None, _http=None):
+        self.project = project
+
+    def get_table(self, table_id):
+        fake_service.call('bigquery', 'get_table')
+        return Table(str(table_id))
+
+    def query(self, query, job_config=None):
+        fake_service.call('bigquery', 'query')
+        return QueryJob()
+
+    def insert_rows(self, table, rows):
+        fake_service.call('bigquery', 'insert_rows')
+        written[table.table_id].extend(rows)
+        return []
+
+    def _load(self, job_id):
+        # Like BigQuery, a job id can only be used once, also when the job failed
+        if job_id is not None and job_id in jobs:
+            raise Conflict(f"409 Already Exists: Job {job_id}")
+        job = Job(job_id)
+        if job_id is not None:
+            jobs[job_id] = job
+        try:
+            fake_service.call('bigquery', 'load')
+        except Exception as e:
+            job.error_result = {'reason': 'backendError', 'message': str(e)}
+            raise
+        return job
+
+    def get_job(self, job_id):
+        fake_service.call('bigquery', 'get_job')
+        return jobs[job_id]
+
+    def load_table_from_json(self, rows, table_id, job_config=None, job_id=None):
+        job = self._load(job_id)
+        written[table_id].extend(rows)
+        return job
+
+    def load_table_from_file(self, file, table_id, job_config=None, job_id=None):
+        job = self._load(job_id)
+        written[table_id].append(file.read())
+        return job
+
+    def load_table_from_uri(self, uris, table_id, job_config=None, job_id=None):
+        job = self._load(job_id)
+        written[table_id].extend(uris if isinstance(uris, list) else [uris])
+        return job
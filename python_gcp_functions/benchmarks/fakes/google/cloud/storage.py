@@ -0,0 +1,86 @@
+# Fake google.cloud.storage for the benchmarks. Uploaded objects are kept in `objects` by (bucket, name), their
+# generation in `generations` and metadata in `metadata`, latency and failures come from fake_service.
+import itertools
+
+import fake_service
+
+objects = {}
+generations = {}
+metadata = {}
+_next_generation = itertools.count(1)
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class Blob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+        self.content_encoding = None
+        self.content_type = None
+        self.metadata = None
+        self.generation = None
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        fake_service.call('storage', 'upload')
+        key = (self.bucket.name, self.name)
+        if if_generation_match is not None and generations.get(key, 0) != if_generation_match:
+            raise PreconditionFailed(f"412 {self.name} is not at generation {if_generation_match}")
+        self.content_type = content_type
+        self.generation = next(_next_generation)
+        objects[key] = data
+        generations[key] = self.generation
+        metadata[key] = self.metadata
+
+    def download_as_bytes(self, **kwargs):
+        fake_service.call('storage', 'download')
+        data = objects[(self.bucket.name, self.name)]
+        return data.encode('utf-8') if isinstance(data, str) else data
+
+    def exists(self):
+        fake_service.call('storage', 'exists')
+        return (self.bucket.name, self.name) in objects
+
+    def delete(self):
+        fake_service.call('storage', 'delete')
+        objects.pop((self.bucket.name, self.name), None)
+        generations.pop((self.bucket.name, self.name), None)
+        metadata.pop((self.bucket.name, self.name), None)
+
+
+class Bucket:
+    def __init__(self, name):
+        self.name = name
+
+    def blob(self, name):
+        return Blob(self, name)
+
+    def get_blob(self, name):
+        fake_service.call('storage', 'get_blob')
+        if (self.name, name) not in objects:
+            return None
+        blob = Blob(self, name)
+        blob.generation = generations[(self.name, name)]
+        blob.metadata = metadata[(self.name, name)]
+        return blob
+
+
+class Client:
+    def __init__(self, project=None, credentials=None, _http=None):
+        self.project = project
+
+    def get_bucket(self, bucket_name):
+        fake_service.call('storage', 'get_bucket')
+        return Bucket(bucket_name)
+
+    def bucket(self, bucket_name):
+        return Bucket(bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=None):
+        fake_service.call('storage', 'list')
+        bucket = bucket_or_name if isinstance(bucket_or_name, Bucket) else Bucket(bucket_or_name)
+        return [Blob(bucket, name) for bucket_name, name in sorted(objects)
+                if bucket_name == bucket.name and name.startswith(prefix or '')]
@@ -0,0 +1,46 @@
+# Fake openai (0.27 API) for the benchmarks, every completion suggests the same three levels. Latency and failures
+# come from fake_service.
+import json
+import random
+import time
+
+import fake_service
+
+api_key = None
+
+LEVELS = [
+    {'level_number': 1, 'num_different_pieces': 4, 'score_goal': 900, 'board_width': 5, 'board_height': 5,
+     'num_moves': 25, 'collection_goals': [10, 12]},
+    {'level_number': 2, 'num_different_pieces': 4, 'score_goal': 1200, 'board_width': 5, 'board_height': 6,
+     'num_moves': 26, 'collection_goals': [10, 12, 8]},
+    {'level_number': 3, 'num_different_pieces': 5, 'score_goal': 1500, 'board_width': 6, 'board_height': 6,
+     'num_moves': 28, 'collection_goals': [12, 12, 10]}
+]
+STREAM_PIECE_LENGTH = 8
+ARGUMENTS = {'player_type': 'casual player', 'levels': LEVELS, 'type_explanation': 'Fake response. ' * 20}
+
+
+class ChatCompletion:
+    @staticmethod
+    def create(stream=False, **kwargs):
+        if stream:
+            return _stream()
+        fake_service.call('openai', 'chat_completion')
+        return {'choices': [{'message': {'function_call': {'name': 'next_levels',
+                                                           'arguments': json.dumps(ARGUMENTS)}}}]}
+
+
+def _stream():
+    # The arguments in pieces of a few characters, the configured latency is spread over the pieces
+    start = time.perf_counter()
+    arguments = json.dumps(ARGUMENTS)
+    pieces = [arguments[i:i + STREAM_PIECE_LENGTH] for i in range(0, len(arguments), STREAM_PIECE_LENGTH)]
+    delay = fake_service.latency_ms.get('openai.chat_completion', fake_service.latency_ms.get('openai', 0))
+    fails_at = random.randrange(len(pieces)) if random.random() < fake_service.failure_rate.get('openai', 0) else None
+    for i, piece in enumerate(pieces):
+        if i == fails_at:
+            raise fake_service.FakeServiceError("Fake openai stream failed")
+        time.sleep(delay / len(pieces) / 1000)
+        yield {'choices': [{'delta': {'function_call': {'arguments': piece}}}]}
+    with fake_service._lock:
+        fake_service.timings['openai.chat_completion_stream'].append(time.perf_counter() - start)
@@ -0,0 +1,27 @@
+# Fake pandas_gbq for the benchmarks. Queries return no rows, appended DataFrames are kept in `written`,
+# latency and failures come from fake_service.
+from collections import defaultdict
+
+import pandas as pd
+
+import fake_service
+
+written = defaultdict(list)
+
+
+class Context:
+    credentials = None
+    project = None
+
+
+context = Context()
+
+
+def to_gbq(df, destination_table, if_exists='fail', **kwargs):
+    fake_service.call('pandas_gbq', 'to_gbq')
+    written[destination_table].append(df)
+
+
+def read_gbq(query, **kwargs):
+    fake_service.call('pandas_gbq', 'read_gbq')
+    return pd.DataFrame()
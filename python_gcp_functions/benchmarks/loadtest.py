@@ -0,0 +1,268 @@
+import argparse
+import inspect
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Replay / load test of the three functions against the fakes in benchmarks/fakes (see fake_service.py for the
+# latency and failure settings of the fake BigQuery, Cloud Storage, pandas_gbq and openai).
+#
+#   python benchmarks/loadtest.py --synthetic 200 --concurrency 1,4,16
+#   python benchmarks/loadtest.py --replay recorded.jsonl --latency bigquery=60,storage=40,openai=3000
+#   python benchmarks/loadtest.py --synthetic 200 --save run.json      (and later --baseline run.json)
+#
+# A replay file has one request body per line, either as the client sent it or as {"endpoint": ..., "body": ...}.
+# Bodies without an endpoint are assigned by their shape. Every endpoint runs in its own process (they all have
+# a main.py), after one warm-up request. For each concurrency level the report has p50 / p95 / p99 latency,
+# throughput and errors, and per stage (the functions in main.py, inclusive of what they call, and every fake
+# service call) the p50 / p95 time and the total time spent in it per request.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+ENDPOINTS = ['levelStatsEndpoint', 'analyticsEndpoint', 'genDefaultLevelsEndpoint']
+
+
+def endpoint_for(body):
+    if 'level' in body and 'moves' in body:
+        return 'levelStatsEndpoint'
+    if 'screenName' in body:
+        return 'analyticsEndpoint'
+    if 'levelsServingStrategy' in body:
+        return 'genDefaultLevelsEndpoint'
+    return None
+
+
+def read_replay(path):
+    payloads = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'endpoint' in record and 'body' in record:
+                payloads[record['endpoint']].append(record['body'])
+            elif endpoint_for(record):
+                payloads[endpoint_for(record)].append(record)
+    return payloads
+
+
+def synthetic_payloads(n, strategies, num_users, seed):
+    import payloads
+    rng = random.Random(seed)
+    users = [f"loadtest-user-{i}" for i in range(num_users)]
+    return {
+        'levelStatsEndpoint': [payloads.level_stats_payload(rng, rng.choice(users), rng.choice(strategies))
+                               for _ in range(n)],
+        'analyticsEndpoint': [payloads.analytics_payload(rng, rng.choice(users), rng.choice(strategies))
+                              for _ in range(n)],
+        'genDefaultLevelsEndpoint': [payloads.gen_default_payload(rng, rng.choice(['random', 'gpt']))
+                                     for _ in range(n)]
+    }
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    ordered = sorted(values)
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99)}
+
+
+# Everything below runs in the worker process of one endpoint
+
+def fresh(body, suffix):
+    # A copy of a level completion as a new play (levelGuid and dateSent of its own), so requests that were already
+    # sent at a lower concurrency aren't answered as duplicates
+    body = json.loads(json.dumps(body))
+    for completion in body.get('completions', [body]):
+        level = completion.get('level')
+        if isinstance(level, dict) and 'levelGuid' in level:
+            level['levelGuid'] = f"{level['levelGuid']}-{suffix}"
+            if 'dateSent' in level:
+                level['dateSent'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    return body
+
+
+def wrap_stages(module, stage_timings, lock):
+    # Times every function defined in main.py, they are looked up as globals so replacing them is enough
+    for name, function in list(vars(module).items()):
+        if name == 'main' or not inspect.isfunction(function) or function.__module__ != module.__name__:
+            continue
+
+        def timed(*args, _function=function, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                with lock:
+                    stage_timings[_name].append(time.perf_counter() - start)
+        setattr(module, name, timed)
+
+
+def run_level(module, bodies, concurrency, stage_timings, lock):
+    import fake_service
+    from payloads import FakeRequest
+    fake_service.reset()
+    stage_timings.clear()
+    latencies, errors = [], defaultdict(int)
+
+    def send(body):
+        start = time.perf_counter()
+        try:
+            module.main(FakeRequest(body))
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+            return None
+        return time.perf_counter() - start
+
+    bodies = [fresh(body, f"c{concurrency}-{i}") for i, body in enumerate(bodies)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency in pool.map(send, bodies):
+            if latency is not None:
+                latencies.append(latency)
+    wall = time.perf_counter() - start
+    # Writes the response didn't wait for still count towards the stages
+    if hasattr(module, 'stages'):
+        module.stages.drain_background()
+    if hasattr(module, 'tracking_writer'):
+        module.tracking_writer.flush()
+
+    stages = {}
+    all_timings = {**stage_timings, **{f"fake {name}": values for name, values in fake_service.timings.items()}}
+    for name, values in all_timings.items():
+        stages[name] = {**percentiles(values), 'calls': len(values), 'seconds_per_request': sum(values) / len(bodies)}
+    return {
+        'concurrency': concurrency,
+        'requests': len(bodies),
+        'errors': dict(errors),
+        'throughput': len(latencies) / wall if wall else None,
+        'latency': percentiles(latencies),
+        'stages': stages
+    }
+
+
+def worker(endpoint, payload_path, concurrency_levels):
+    endpoint_dir = os.path.join(FUNCTIONS_DIR, endpoint)
+    sys.path[:0] = [endpoint_dir, FAKES_DIR, BENCHMARKS_DIR]
+    os.chdir(endpoint_dir)
+    with open(payload_path) as f:
+        bodies = json.load(f)
+    import main as module
+    from payloads import FakeRequest
+    # The cold start is startup.py's job, the load test measures warm instances
+    try:
+        module.main(FakeRequest(fresh(bodies[0], 'warmup')))
+    except Exception:
+        pass
+    stage_timings, lock = defaultdict(list), threading.Lock()
+    wrap_stages(module, stage_timings, lock)
+    results = [run_level(module, bodies, concurrency, stage_timings, lock) for concurrency in concurrency_levels]
+    print(json.dumps({'endpoint': endpoint, 'levels': results}))
+
+
+# Back in the parent process
+
+def run_endpoint(endpoint, bodies, concurrency_levels, env):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(bodies, f)
+    try:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', endpoint, '--payloads', f.name,
+                                 '--concurrency', ','.join(map(str, concurrency_levels))],
+                                env=env, capture_output=True, text=True)
+    finally:
+        os.remove(f.name)
+    if result.returncode != 0:
+        raise RuntimeError(f"{endpoint} worker failed:\n{result.stderr}")
+    # The functions print too, and generations that missed their deadline can still print after the result
+    return json.loads([line for line in result.stdout.splitlines() if line.startswith('{"endpoint"')][-1])
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:8.1f}" if seconds is not None else "       -"
+
+
+def print_report(results, baseline=None):
+    baseline_levels = {(result['endpoint'], level['concurrency']): level
+                       for result in baseline or [] for level in result['levels']}
+    for result in results:
+        print(f"\n{result['endpoint']}")
+        print("  concurrency  requests  errors  throughput/s    p50 ms    p95 ms    p99 ms")
+        for level in result['levels']:
+            latency = level['latency']
+            line = f"  {level['concurrency']:>11}  {level['requests']:>8}  {sum(level['errors'].values()):>6}  " \
+                   f"{level['throughput'] or 0:>12.1f}  {_ms(latency['p50'])}  {_ms(latency['p95'])}  " \
+                   f"{_ms(latency['p99'])}"
+            before = baseline_levels.get((result['endpoint'], level['concurrency']))
+            if before and before['latency']['p95'] and latency['p95']:
+                line += f"   p95 {100 * (latency['p95'] / before['latency']['p95'] - 1):+.0f}% vs baseline"
+            print(line)
+        # The stage breakdown of the highest concurrency level
+        level = result['levels'][-1]
+        print(f"  stages at concurrency {level['concurrency']}:    p50 ms    p95 ms   ms/request   calls")
+        for name, stage in sorted(level['stages'].items(), key=lambda item: -item[1]['seconds_per_request']):
+            print(f"    {name:<34} {_ms(stage['p50'])}  {_ms(stage['p95'])}     {_ms(stage['seconds_per_request'])}"
+                  f"  {stage['calls']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', choices=ENDPOINTS, action='append')
+    parser.add_argument('--replay', help="JSONL file of recorded request bodies")
+    parser.add_argument('--synthetic', type=int, default=100, help="number of synthetic requests per endpoint")
+    parser.add_argument('--strategies', default='random,gpt,gpt-stats')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--latency', help="fake service latency in ms, e.g. bigquery=60,openai=3000")
+    parser.add_argument('--failures', help="fake service failure rates, e.g. openai=0.05")
+    parser.add_argument('--save', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="results saved by an earlier run to compare with")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--payloads', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+
+    if args.worker:
+        worker(args.worker, args.payloads, concurrency_levels)
+        return
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    if args.replay:
+        payloads = read_replay(args.replay)
+    else:
+        payloads = synthetic_payloads(args.synthetic, args.strategies.split(','), args.users, args.seed)
+
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    # The pipeline is measured, not responses replayed from the single flight store
+    env.setdefault('SINGLE_FLIGHT_TTL_SECONDS', '0')
+    if args.latency is not None:
+        env['FAKE_LATENCY_MS'] = args.latency
+    if args.failures is not None:
+        env['FAKE_FAILURE_RATE'] = args.failures
+
+    results = [run_endpoint(endpoint, payloads[endpoint], concurrency_levels, env)
+               for endpoint in args.endpoint or ENDPOINTS if payloads.get(endpoint)]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
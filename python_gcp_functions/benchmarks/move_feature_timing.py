@@ -0,0 +1,79 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+# Time to compute the skill signals of move_features.py for the completions of a request (one or a batch of queued
+# ones), in one vectorized pass and with a loop over the moves of every completion, which is also checked to give
+# the same features.
+#
+#   python benchmarks/move_feature_timing.py [--completions 1,10,100,1000] [--repeat 20]
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINT_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'levelStatsEndpoint')
+
+
+def move_features_per_row(moves, columns, swipe_directions):
+    # One completion's moves, one move at a time
+    if not moves:
+        return dict.fromkeys(columns)
+    moves = sorted(moves, key=lambda move: move.get('moveNumber') or 0)
+    durations = [move.get('durationInSeconds') or 0 for move in moves]
+    streak = max_streak = 0
+    direction_counts = {}
+    for move in moves:
+        streak = 0 if move.get('isMoveLegal') else streak + 1
+        max_streak = max(max_streak, streak)
+        if move.get('isMoveLegal') and move.get('swipeDirection') in swipe_directions:
+            direction_counts[move['swipeDirection']] = direction_counts.get(move['swipeDirection'], 0) + 1
+    total = sum(direction_counts.values())
+    entropy = sum(count / total * math.log2(total / count) for count in direction_counts.values()) if total else None
+    return {
+        'think_time_p50': round(float(np.percentile(durations, 50)), 3),
+        'think_time_p90': round(float(np.percentile(durations, 90)), 3),
+        'max_illegal_streak': max_streak,
+        'score_per_move': round(sum(move.get('scoreForMove') or 0 for move in moves) / len(moves), 2),
+        'direction_entropy': round(entropy, 3) if entropy is not None else None
+    }
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--completions', default='1,10,100,1000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    sys.path[:0] = [ENDPOINT_DIR, BENCHMARKS_DIR]
+    from move_features import MOVE_FEATURE_COLUMNS, SWIPE_DIRECTIONS, move_features
+    from payloads import level_stats_payload
+
+    rng = random.Random(0)
+    print("completions    moves   vectorized ms   per row ms")
+    for num_completions in [int(completions) for completions in args.completions.split(',')]:
+        moves_per_completion = [level_stats_payload(rng)['moves'] for _ in range(num_completions)]
+        # Moves may arrive out of order, and completions without moves
+        rng.shuffle(moves_per_completion[0])
+        moves_per_completion.append([])
+        vectorized, vectorized_seconds = best_of(args.repeat, lambda: move_features(moves_per_completion))
+        per_row, per_row_seconds = best_of(args.repeat, lambda: [
+            move_features_per_row(moves, MOVE_FEATURE_COLUMNS, SWIPE_DIRECTIONS) for moves in moves_per_completion])
+        assert vectorized == per_row, "vectorized features differ from the per row ones"
+        print(f"{num_completions:>11} {sum(map(len, moves_per_completion)):>8} {vectorized_seconds * 1000:15.3f} "
+              f"{per_row_seconds * 1000:12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import random
+import uuid
+from datetime import datetime, timedelta
+
+# Request bodies shaped like the ones the Unity client sends (GameManager.cs):
+#   levelStatsEndpoint        LevelStatsToCloudFunction - {"level": {...}, "moves": [...]}
+#   analyticsEndpoint         logToBq - one screen event
+#   genDefaultLevelsEndpoint  {"levelsServingStrategy": ...}
+
+SCREEN_NAMES = ['MainMenu', 'LevelStart', 'LevelWon', 'LevelLost', 'RateLevel']
+SWIPE_DIRECTIONS = ['up', 'down', 'left', 'right']
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class FakeRequest:
+    # The part of flask.Request the functions use
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self, silent=False):
+        return self.data
+
+
+def level_stats_payload(rng=random, user_id=None, strategy='random', level_guid=None, num_moves=None):
+    now = datetime.utcnow()
+    num_moves = num_moves if num_moves is not None else rng.randint(15, 30)
+    moves = []
+    for i in range(num_moves):
+        moves.append({
+            'moveNumber': i + 1,
+            'createTime': (now - timedelta(seconds=3 * (num_moves - i))).strftime(DATE_FORMAT),
+            'durationInSeconds': round(rng.uniform(0.3, 6.0), 2),
+            'isMoveLegal': rng.random() > 0.15,
+            'scoreForMove': rng.choice([0, 60, 80, 120, 200]),
+            'starsForMove': rng.randint(0, 1),
+            'swipeDirection': rng.choice(SWIPE_DIRECTIONS)
+        })
+    passed = rng.random() > 0.3
+    return {
+        'level': {
+            'userId': user_id or f"user-{rng.randint(1, 1000)}",
+            'currentLevel': rng.randint(1, 20),
+            'levelGuid': level_guid or f"LUID-{uuid.uuid4()}",
+            'numTimesLost': rng.randint(0, 3),
+            'isLevelPassed': passed,
+            'deviceModel': 'iPhone12,1',
+            'score': rng.randint(300, 2500),
+            'numBoardClicksOverall': rng.randint(20, 80),
+            'movesLeft': rng.randint(0, 8) if passed else 0,
+            'timePlaying': round(rng.uniform(30, 240), 1),
+            'numFailedMoves': sum(not move['isMoveLegal'] for move in moves),
+            'dateSent': now.strftime(DATE_FORMAT),
+            'userRating': rng.choice([None, 3, 4, 5]),
+            'worldServed': strategy,
+            'numBoostersUsed': rng.randint(0, 1),
+            'gameVersion': 12
+        },
+        'moves': moves
+    }
+
+
+def analytics_payload(rng=random, user_id=None, strategy='random'):
+    return {
+        'createdDate': datetime.utcnow().strftime(DATE_FORMAT),
+        'userId': user_id or f"user-{rng.randint(1, 1000)}",
+        'currentLevel': rng.randint(1, 20),
+        'levelGuid': f"LUID-{uuid.uuid4()}",
+        'screenName': rng.choice(SCREEN_NAMES),
+        'worldServed': strategy,
+        'gameVersion': 12
+    }
+
+
+def gen_default_payload(rng=random, strategy='random'):
+    return {'levelsServingStrategy': strategy}
+
+
+PAYLOADS = {
+    'levelStatsEndpoint': level_stats_payload,
+    'analyticsEndpoint': analytics_payload,
+    'genDefaultLevelsEndpoint': gen_default_payload
+}
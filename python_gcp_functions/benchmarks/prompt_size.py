@@ -0,0 +1,78 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+# Size of the player's data in the prompt and the time to build it, against the number of levels played, for the
+# bounded descriptions (prompt_builder.py) and for one sentence per level over the whole history as before.
+#
+#   python benchmarks/prompt_size.py [--levels 10,100,1000,10000] [--recent-levels 10] [--token-budget 3000]
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+ENDPOINT_DIR = os.path.join(FUNCTIONS_DIR, 'levelStatsEndpoint')
+
+
+def history(num_levels, seed=0):
+    # Made-up levels in the shape of FeatureStore.history_df
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'level_in_row': np.arange(1, num_levels + 1),
+        'level_passed': rng.random(num_levels) < 0.7,
+        'score': rng.integers(300, 2500, num_levels),
+        'score_goal': rng.integers(700, 2000, num_levels) // 3 * 3,
+        'moves_left': rng.integers(0, 10, num_levels),
+        'num_moves': rng.integers(20, 31, num_levels),
+        'num_failed_moves': rng.integers(0, 6, num_levels),
+        'num_clicks_on_board': rng.integers(20, 60, num_levels),
+        'num_boosters_used': rng.integers(0, 3, num_levels),
+        'user_rating': rng.integers(1, 6, num_levels),
+        'num_different_pieces': rng.integers(3, 6, num_levels),
+        'board_width': rng.integers(4, 7, num_levels),
+        'board_height': rng.integers(4, 7, num_levels),
+        'collection_goals': [[float(goal) for goal in rng.integers(5, 16, 2)] for _ in range(num_levels)]
+    }, dtype=object)
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--levels', default='10,100,1000,10000')
+    parser.add_argument('--recent-levels', type=int, default=10)
+    parser.add_argument('--token-budget', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path[:0] = [ENDPOINT_DIR, FAKES_DIR]
+    import main as endpoint
+    from prompt_builder import build_descriptions, count_tokens
+
+    print(" levels   bounded tokens       ms   unbounded tokens       ms")
+    for num_levels in [int(levels) for levels in args.levels.split(',')]:
+        df = history(num_levels)
+        # generate_sentence_per_row prints every sentence
+        with contextlib.redirect_stdout(io.StringIO()):
+            bounded, bounded_seconds = best_of(args.repeat, lambda: build_descriptions(
+                df, endpoint.generate_sentence_per_row, args.recent_levels, args.token_budget))
+            unbounded, unbounded_seconds = best_of(args.repeat, lambda: '\n'.join(
+                df.apply(endpoint.generate_sentence_per_row, axis=1)))
+        print(f"{num_levels:>7}   {count_tokens(bounded):>14} {bounded_seconds * 1000:8.1f}   "
+              f"{count_tokens(unbounded):>16} {unbounded_seconds * 1000:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
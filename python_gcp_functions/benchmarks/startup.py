@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Cold start benchmark: imports every endpoint's main.py in a fresh interpreter and sends it one request, with the
+# fakes in benchmarks/fakes standing in for BigQuery, Cloud Storage, pandas_gbq and openai (so nothing leaves the
+# machine and the numbers only depend on our own code and the libraries it imports).
+#
+#   python benchmarks/startup.py [--repeat 5] [--strategy random] [--max-import-seconds 0.5]
+#
+# Prints the median import and first request time per endpoint and which heavy modules were loaded by the import.
+# levelStatsEndpoint is expected to load numpy: every completion needs it (move_features, the random levels), so
+# importing it lazily would only move its ~100 ms from the import to the first request. The other endpoints load
+# none of HEAVY_MODULES at import.
+# With --max-import-seconds the script exits with 1 when an endpoint imports slower, to catch regressions.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+ENDPOINTS = ['analyticsEndpoint', 'genDefaultLevelsEndpoint', 'levelStatsEndpoint']
+HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'pandas_gbq', 'openai', 'google.cloud.bigquery',
+                 'google.cloud.storage']
+
+# Runs in the fresh interpreter: argv is the endpoint directory, the payload as JSON
+CHILD = """
+import json, sys, time
+endpoint_dir, payload = sys.argv[1], json.loads(sys.argv[2])
+sys.path[:0] = [endpoint_dir, %r, %r]
+from payloads import FakeRequest
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+loaded = [name for name in %r if name in sys.modules]
+main.main(FakeRequest(payload))
+done = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'first_request_seconds': done - imported,
+                  'loaded_at_import': loaded}))
+""" % (FAKES_DIR, BENCHMARKS_DIR, HEAVY_MODULES)
+
+
+def run_once(endpoint, payload):
+    endpoint_dir = os.path.join(FUNCTIONS_DIR, endpoint)
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    # Analytics rows would otherwise sit in the buffer until exit, the fake sink is just as fast
+    env.setdefault('TRACKING_FLUSH_ROWS', '1')
+    result = subprocess.run([sys.executable, '-c', CHILD, endpoint_dir, json.dumps(payload)], cwd=endpoint_dir,
+                            env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(endpoint, repeat, strategy):
+    import payloads
+    runs = [run_once(endpoint, payloads.PAYLOADS[endpoint](strategy=strategy)) for _ in range(repeat)]
+    return {
+        'endpoint': endpoint,
+        'import_seconds': statistics.median(run['import_seconds'] for run in runs),
+        'first_request_seconds': statistics.median(run['first_request_seconds'] for run in runs),
+        'loaded_at_import': runs[-1]['loaded_at_import']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', choices=ENDPOINTS, action='append')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--strategy', default='random')
+    parser.add_argument('--max-import-seconds', type=float)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    results = [benchmark(endpoint, args.repeat, args.strategy) for endpoint in args.endpoint or ENDPOINTS]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{result['endpoint']:<26} import {result['import_seconds'] * 1000:8.1f} ms   "
+                  f"first request {result['first_request_seconds'] * 1000:8.1f} ms   "
+                  f"loaded at import: {', '.join(result['loaded_at_import']) or '-'}")
+
+    if args.max_import_seconds is not None:
+        slow = [result['endpoint'] for result in results if result['import_seconds'] > args.max_import_seconds]
+        if slow:
+            print(f"Import slower than {args.max_import_seconds}s: {', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
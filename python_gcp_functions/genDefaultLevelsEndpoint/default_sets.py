@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+import time
+
+import clients
+
+# Cache of a default level set, addressed by the hash of everything that goes into generating it (prompt, function
+# schema, ranges, model). The set is kept in memory and in the bucket object the app fetches, whose metadata holds
+# the hash it was generated from. A new set is only generated when the hash changes, the set is older than
+# max_age_seconds (0: never) or a refresh is forced; otherwise it is served from memory, or on a cold instance
+# from the bucket object.
+#
+# With stale_while_revalidate, an outdated set is served right away and the new one is generated in the background.
+
+HASH_METADATA_KEY = 'content_hash'
+GENERATED_AT_METADATA_KEY = 'generated_at'
+
+
+class DefaultSetCache:
+    def __init__(self, bucket_name, object_name, publish, max_age_seconds=0, stale_while_revalidate=False):
+        # publish(levels_json, metadata) writes the set to the bucket object
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.publish = publish
+        self.max_age_seconds = max_age_seconds
+        self.stale_while_revalidate = stale_while_revalidate
+        self.entry = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def is_fresh(self, entry, key):
+        if entry is None or entry['key'] != key:
+            return False
+        return not self.max_age_seconds or time.time() - entry['generated_at'] <= self.max_age_seconds
+
+    def get(self, key, generate, force_refresh=False):
+        # Returns the levels as JSON and where they came from: memory, bucket, stale or generated.
+        # generate() returns a new set as JSON.
+        if not force_refresh:
+            source = 'memory'
+            entry = self.entry
+            if entry is None:
+                source = 'bucket'
+                entry = self.entry = self._read_bucket()
+            if self.is_fresh(entry, key):
+                return entry['levels'], source
+            if entry is not None and self.stale_while_revalidate:
+                self._refresh_in_background(key, generate)
+                return entry['levels'], 'stale'
+        return self._generate(key, generate, force_refresh)['levels'], 'generated'
+
+    def _generate(self, key, generate, force_refresh=False):
+        # One generation at a time, the requests waiting for it are served its result
+        with self._lock:
+            if not force_refresh and self.is_fresh(self.entry, key):
+                return self.entry
+            entry = {'key': key, 'generated_at': time.time(), 'levels': generate()}
+            self.publish(entry['levels'], {HASH_METADATA_KEY: key,
+                                           GENERATED_AT_METADATA_KEY: str(entry['generated_at'])})
+            self.entry = entry
+            logging.info(f"Default set {self.object_name} generated for {key[:12]}")
+            return entry
+
+    def _refresh_in_background(self, key, generate):
+        with self._refresh_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self._generate(key, generate)
+            except Exception as e:
+                logging.error(f"Refreshing the default set {self.object_name} failed: {e}")
+            finally:
+                self._refreshing = False
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _read_bucket(self):
+        # The set in the bucket object, None if there is none or it wasn't written by this cache
+        try:
+            blob = clients.get_bucket(self.bucket_name).get_blob(f'{self.object_name}.json')
+            metadata = (blob.metadata or {}) if blob is not None else {}
+            if HASH_METADATA_KEY not in metadata:
+                return None
+            levels = json.dumps(json.loads(blob.download_as_bytes()))
+        except Exception as e:
+            logging.error(f"Reading the default set {self.object_name} from the bucket failed: {e}")
+            return None
+        return {'key': metadata[HASH_METADATA_KEY], 'generated_at': float(metadata.get(GENERATED_AT_METADATA_KEY, 0)),
+                'levels': levels}
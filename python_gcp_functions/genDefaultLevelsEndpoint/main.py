@@ -1,14 +1,19 @@
-import pandas as pd
-import pandas_gbq
-from google.cloud import storage
-import openai
-import random
 import json
 from datetime import datetime
+import hmac
 import uuid
 import os
+import logging
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
+import clients
+from default_sets import DefaultSetCache
+from llm_cache import cache_from_env, hash_key
+from level_generator import generate_random_level_batch
+
+# pandas, pandas_gbq, openai and the Google Cloud SDKs are imported where they are used, so they don't add to
+# the cold start of requests that never need them
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = "gpt-4-0613"
 
 NUM_LEVELS_TO_SUGGEST = 3
 
@@ -23,20 +28,44 @@ COLLECTION_GOALS_PIECES_RANGE = (5, 15)
 filename_random = "000_random_default"
 filename_gpt = "000_gpt_default"
 
+# The prompt doesn't depend on the request, so one cached response serves every call until it expires
+llm_cache = cache_from_env()
+
+# The gpt default set is only generated again when its inputs change (see default_sets.py), after
+# DEFAULT_SET_MAX_AGE_SECONDS (0: never) or when a request has "forceRefresh": true and a "refreshToken" equal to
+# DEFAULT_SET_REFRESH_TOKEN (the endpoint is public, so without the token anyone could have gpt-4 called; with the
+# variable unset forceRefresh is ignored). With DEFAULT_SET_STALE_WHILE_REVALIDATE set, an outdated set is served
+# while the new one is generated.
+DEFAULT_SET_REFRESH_TOKEN = os.environ.get('DEFAULT_SET_REFRESH_TOKEN', '')
+gpt_default_set = DefaultSetCache(
+    'm3-levels', filename_gpt, lambda levels, metadata: levels_to_bucket(filename_gpt, levels, metadata),
+    max_age_seconds=float(os.environ.get('DEFAULT_SET_MAX_AGE_SECONDS', 0)),
+    stale_while_revalidate=os.environ.get('DEFAULT_SET_STALE_WHILE_REVALIDATE', '') == '1')
+
 
 def main(request):
     data = request.get_json()
     if data['levelsServingStrategy'] == "gpt":
-        response = call_to_openai()
-        levels = add_uid_and_date(response['levels'])
-        levels_to_bucket(filename_gpt, levels)
-        pass
+        force_refresh = bool(data.get('forceRefresh', False)) and refresh_allowed(data)
+        levels, source = gpt_default_set.get(default_set_key(), lambda: generate_gpt_levels(force_refresh),
+                                             force_refresh)
+        logging.info(f"{filename_gpt} served from {source}")
     else:
         levels = add_uid_and_date(generate_random_levels())
         levels_to_bucket(filename_random, levels)
     return levels
 
 
+def refresh_allowed(data):
+    # Only callers with DEFAULT_SET_REFRESH_TOKEN can force a refresh, compared in constant time
+    token = data.get('refreshToken')
+    if DEFAULT_SET_REFRESH_TOKEN and isinstance(token, str) and \
+            hmac.compare_digest(token.encode('utf-8'), DEFAULT_SET_REFRESH_TOKEN.encode('utf-8')):
+        return True
+    logging.warning("forceRefresh without a valid refreshToken, ignored")
+    return False
+
+
 json_function = """
 [
 {
@@ -106,37 +135,39 @@ Return the response in JSON format.
 """
 
 
-def generate_random_levels():
-    levels = []
-    for _ in range(NUM_LEVELS_TO_SUGGEST):
-        num_different_pieces = random.randint(*NUM_DIFFERENT_PIECES_RANGE)
-        num_different_goals = random.randint(NUM_DIFFERENT_GOALS[0], min(NUM_DIFFERENT_GOALS[1], num_different_pieces))
-        score_goal = random.choice([i for i in range(*SCORE_GOAL_RANGE) if i % 3 == 0])
-        num_moves = random.randint(*NUM_MOVES_RANGE)
-        board_width = random.randint(*BOARD_SIZE_RANGE)
-        board_height = random.randint(*BOARD_SIZE_RANGE)
-        collection_goals = [random.randint(*COLLECTION_GOALS_PIECES_RANGE) for _ in range(num_different_goals)]
-        levels.append({
-            "num_different_pieces": num_different_pieces,
-            "score_goal": score_goal,
-            "board_width": board_width,
-            "board_height": board_height,
-            "num_moves": num_moves,
-            "time_seconds": 0,
-            "collection_goals": collection_goals
-        })
-    return levels
+def default_set_key():
+    # Everything the gpt default set is generated from
+    return hash_key(OPENAI_MODEL, system_prompt, user_prompt, json_function, NUM_LEVELS_TO_SUGGEST,
+                    NUM_DIFFERENT_PIECES_RANGE, NUM_DIFFERENT_GOALS, SCORE_GOAL_RANGE, NUM_MOVES_RANGE,
+                    BOARD_SIZE_RANGE, COLLECTION_GOALS_PIECES_RANGE)
+
+
+def generate_gpt_levels(force_refresh=False):
+    # A forced refresh asks the LLM again instead of reusing its cached response
+    key = hash_key(OPENAI_MODEL, system_prompt, user_prompt, json_function)
+    if force_refresh:
+        response = call_to_openai()
+        llm_cache.put(key, response)
+    else:
+        response, _ = llm_cache.get_or_compute(key, call_to_openai)
+    return add_uid_and_date(response['levels'])
+
+
+def generate_random_levels(seed=None):
+    return generate_random_level_batch(NUM_LEVELS_TO_SUGGEST, NUM_DIFFERENT_PIECES_RANGE, NUM_DIFFERENT_GOALS,
+                                       SCORE_GOAL_RANGE, NUM_MOVES_RANGE, BOARD_SIZE_RANGE,
+                                       COLLECTION_GOALS_PIECES_RANGE, seed=seed)
 
 
-def levels_to_bucket(default_name, json_levels):
+def levels_to_bucket(default_name, json_levels, metadata=None):
     # Ensure json_levels is a Python object, not a string
     if isinstance(json_levels, str):
         json_levels = json.loads(json_levels)
 
-    client = storage.Client()
-    bucket = client.get_bucket('m3-levels')
+    bucket = clients.get_bucket('m3-levels')
     blob = bucket.blob(f'{default_name}.json')
     blob.cache_control = "public, max-age=0"
+    blob.metadata = metadata
     formatted_json_data = json.dumps(json_levels, indent=4)
 
     blob.upload_from_string(
@@ -146,10 +177,12 @@ def levels_to_bucket(default_name, json_levels):
 
 
 def call_to_openai():
+    import openai
+    openai.api_key = OPENAI_API_KEY
     functions = json.loads(json_function)
 
     _response = openai.ChatCompletion.create(
-        model="gpt-4-0613",
+        model=OPENAI_MODEL,
         temperature=0,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -178,6 +211,7 @@ def add_uid_and_date(levels):
             'created_time': dt,
             'collection_goals': levels[i]['collection_goals']
         }
+    import pandas as pd
     df_levels = pd.DataFrame(levels)
-    pandas_gbq.to_gbq(df_levels, 'match3.level_params', if_exists='append')
+    clients.pandas_gbq().to_gbq(df_levels, 'match3.level_params', if_exists='append')
     return json.dumps(levels)
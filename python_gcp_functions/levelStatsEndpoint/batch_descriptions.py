@@ -0,0 +1,97 @@
+import string
+
+import numpy as np
+
+# The descriptions of generate_sentence_per_row / generate_sentence_per_row_w_stats for many levels of many players
+# at once, for backfills and prompt replays, built column by column instead of with df.apply(..., axis=1) and a
+# print per row. The wording is the same, word for word; benchmarks/description_throughput.py checks that against
+# the row-wise functions and compares their speed.
+#
+#   descriptions_per_user(df, use_stats)  ->  {user_id: descriptions}  (like generate_descriptions without a budget)
+#
+# Values are written as the f-strings write them (str() of every value, so None, nan and floats come out the same).
+
+SENTENCE = "For level {level_in_row}, the user scored {score} where {score_goal} was the minimum to pass. " \
+           "They had {moves_left} moves left out of {num_moves}. They made {num_failed_moves} failed moves. " \
+           "They made {num_clicks_on_board} clicks on the board. They used {num_boosters_used} boosters." \
+           "Player rated the level as {user_rating} out of 5. " \
+           "The level contained {num_different_pieces} different pieces. " \
+           "Board width x height was {board_width} x {board_height}. {collection_goals_sentence}"
+
+SENTENCE_W_STATS = "For level {level_in_row} the user scored {score} compared to an average score of {avg_score}" \
+                   " (median: {median_score}, min: {min_score}, max: {max_score}). " \
+                   "They had {moves_left} moves left compared to an average of " \
+                   "{avg_moves_left} (median: {median_moves_left}, min: {min_moves_left}, " \
+                   "max: {max_moves_left}). They made {num_failed_moves} failed moves compared to an average of " \
+                   "{avg_num_failed_moves} (median: {median_num_failed_moves}, min: {min_num_failed_moves}, " \
+                   "max: {max_num_failed_moves}). They made {num_clicks_on_board} clicks on the board compared " \
+                   "to an average of {avg_num_clicks_on_board} (median: {median_num_clicks_on_board}, " \
+                   "min: {min_num_clicks_on_board}, max: {max_num_clicks_on_board}). " \
+                   "They used {num_boosters_used} boosters compared to an average of " \
+                   "{avg_num_boosters_used} (median: {median_num_boosters_used}, min: {min_num_boosters_used}, " \
+                   "max: {max_num_boosters_used}). Player rated the level as {user_rating} out of 5. " \
+                   "The level contained {num_different_pieces} different pieces, the passing score was " \
+                   "{score_goal}, Board width x height was {board_width} x {board_height} and the allowed nuber " \
+                   "of moves was {num_moves}.{collection_goals_sentence}"
+
+
+def collection_goals_sentences(collection_goals):
+    # handle_collection_goals for a whole column: goals without nans as integers, '' if there is no list
+    import pandas as pd
+    goals = pd.Series(collection_goals).reset_index(drop=True)
+    is_list = goals.map(type) == list
+    sentences = pd.Series('', index=goals.index, dtype=object)
+    if not is_list.any():
+        return sentences.to_numpy()
+    # One row per goal, then the goals of every level joined with ', ' by adding up the strings of its rows
+    exploded = goals[is_list].explode()
+    exploded = exploded[exploded.notna()]
+    rows = exploded.index.to_numpy()
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.array([], dtype=int)
+    values = exploded.to_numpy(dtype=float).astype(int).astype(str).astype(object)
+    separators = np.full(len(values), ', ', dtype=object)
+    separators[starts] = ''
+    joined = pd.Series('', index=goals.index[is_list], dtype=object)
+    if len(rows):
+        joined[rows[starts]] = np.add.reduceat(separators + values, starts)
+    sentences[is_list] = 'Collection goals were [' + joined + '].'
+    return sentences.to_numpy()
+
+
+def fill(template, column, collection_goals_sentence, rows=slice(None)):
+    # template's {column} fields filled with column(name)[rows], the values of a column as strings
+    text = None
+    for literal, field, _, _ in string.Formatter().parse(template):
+        text = literal if text is None else text + literal
+        if field == 'collection_goals_sentence':
+            text = text + collection_goals_sentence[rows]
+        elif field is not None:
+            text = text + column(field)[rows]
+    return text
+
+
+def describe_levels(df, use_stats=False):
+    # One description per row of df, in df's order (as a Series with df's index)
+    import pandas as pd
+    strings = {}
+
+    def column(name):
+        # Every column is turned into strings once, for both sentences
+        if name not in strings:
+            strings[name] = df[name].astype(object).map(str).to_numpy()
+        return strings[name]
+
+    collection_goals_sentence = collection_goals_sentences(df['collection_goals'])
+    # As in generate_descriptions: levels without stats of their cluster get the sentence without stats
+    with_stats = ~(df['max_score'] == 0).to_numpy() if use_stats else np.zeros(len(df), dtype=bool)
+    descriptions = np.empty(len(df), dtype=object)
+    for template, rows in ((SENTENCE, ~with_stats), (SENTENCE_W_STATS, with_stats)):
+        if rows.any():
+            descriptions[rows] = fill(template, column, collection_goals_sentence, rows)
+    return pd.Series(descriptions, index=df.index, dtype=object)
+
+
+def descriptions_per_user(df, use_stats=False, user_column='user_id'):
+    # The descriptions of every user's levels (in df's order) joined as generate_descriptions joins them
+    descriptions = describe_levels(df, use_stats)
+    return descriptions.groupby(df[user_column].to_numpy(), sort=False).agg('\n'.join).to_dict()
@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import clients
+
+# Writes the per-user level files the app fetches on every level. The JSON is compact and, by default, gzipped
+# with Content-Encoding: gzip. Clients that don't send Accept-Encoding: gzip (like the game's HttpClient) still get
+# plain JSON, because Cloud Storage decompresses for them; that's why Cache-Control never has no-transform.
+#
+# An upload is skipped when the levels are the same as the last ones this instance wrote to that object, apart from
+# VOLATILE_LEVEL_FIELDS: every set gets new level_uids, created_time and starting boards, so comparing whole files
+# would never find a match. The object then keeps the earlier set, and publish() copies that set's
+# VOLATILE_LEVEL_FIELDS into the levels it was given: the caller serves, records and logs the level_uids the app
+# reads from the file, whose rows in match3.level_params have the same parameters.
+#
+# With versioned set, every set of levels also goes to an immutable object named after its hash, which CDNs and
+# clients can cache forever, and <name>.pointer.json (a few bytes, not cached) says which one is current:
+#
+#   {"object": "levels/<name>/<hash>.json", "hash": "<hash>"}
+#
+# <name>.json is still written for clients that don't read the pointer, unless keep_plain_object is off. The
+# generation returned by publish(), and the one if_generation_match refers to, is then the pointer's.
+
+HASH_LENGTH = 16
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CURRENT_CACHE_CONTROL = "public, max-age=0"
+VOLATILE_LEVEL_FIELDS = ('level_uid', 'created_time', 'starting_board')
+
+
+def content_hash(levels):
+    # Hash of the levels without the fields that are new for every set
+    if isinstance(levels, list):
+        levels = [{key: value for key, value in level.items() if key not in VOLATILE_LEVEL_FIELDS}
+                  if isinstance(level, dict) else level for level in levels]
+    body = json.dumps(levels, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+
+
+def volatile_fields(levels):
+    # The VOLATILE_LEVEL_FIELDS of every level, None if the levels aren't a list of dicts
+    if not isinstance(levels, list) or not all(isinstance(level, dict) for level in levels):
+        return None
+    return [{key: level[key] for key in VOLATILE_LEVEL_FIELDS if key in level} for level in levels]
+
+
+class BucketPublisher:
+    def __init__(self, bucket_name, content_encoding='gzip', versioned=False, keep_plain_object=True,
+                 max_entries=10000):
+        self.bucket_name = bucket_name
+        self.content_encoding = content_encoding
+        self.versioned = versioned
+        self.keep_plain_object = keep_plain_object
+        self.max_entries = max_entries
+        # content_hash, generation and VOLATILE_LEVEL_FIELDS of the last write per name
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.skipped = 0
+        self.bytes_uploaded = 0
+
+    def publish(self, name, levels, if_generation_match=None):
+        # Returns the generation of the current object; raises if the upload fails. When the upload is skipped, the
+        # levels are changed in place to the ones in the object.
+        body = json.dumps(levels, separators=(',', ':')).encode('utf-8')
+        content = content_hash(levels)
+        with self._lock:
+            last = self._last.get(name)
+        if last is not None and last[0] == content and if_generation_match in (None, last[1]):
+            for level, volatile in zip(levels, last[2] or []):
+                for key in VOLATILE_LEVEL_FIELDS:
+                    level.pop(key, None)
+                level.update(volatile)
+            with self._lock:
+                self.skipped += 1
+            return last[1]
+
+        bucket = clients.get_bucket(self.bucket_name)
+        try:
+            if self.versioned:
+                # The immutable object is named after the exact bytes
+                digest = hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+                version_name = f'levels/{name}/{digest}.json'
+                self._upload(bucket.blob(version_name), body, IMMUTABLE_CACHE_CONTROL)
+                pointer = json.dumps({'object': version_name, 'hash': digest}, separators=(',', ':')).encode('utf-8')
+                generation = self._upload(bucket.blob(f'{name}.pointer.json'), pointer, CURRENT_CACHE_CONTROL,
+                                          if_generation_match, compress=False)
+                if self.keep_plain_object:
+                    self._upload(bucket.blob(f'{name}.json'), body, CURRENT_CACHE_CONTROL)
+            else:
+                generation = self._upload(bucket.blob(f'{name}.json'), body, CURRENT_CACHE_CONTROL,
+                                          if_generation_match)
+        except Exception:
+            # Someone else may have written the object, what this instance wrote last doesn't say anything anymore
+            self.forget(name)
+            raise
+
+        with self._lock:
+            self._last[name] = (content, generation, volatile_fields(levels))
+            self._last.move_to_end(name)
+            while len(self._last) > self.max_entries:
+                self._last.popitem(last=False)
+        return generation
+
+    def _upload(self, blob, body, cache_control, if_generation_match=None, compress=True):
+        blob.cache_control = cache_control
+        if compress and self.content_encoding == 'gzip':
+            # mtime=0 keeps the bytes the same for the same content
+            body = gzip.compress(body, compresslevel=6, mtime=0)
+            blob.content_encoding = 'gzip'
+        preconditions = {'if_generation_match': if_generation_match} if if_generation_match is not None else {}
+        blob.upload_from_string(data=body, content_type='application/json', **preconditions)
+        with self._lock:
+            self.uploads += 1
+            self.bytes_uploaded += len(body)
+        return blob.generation
+
+    def forget(self, name):
+        # The next publish of name uploads even if the content is the same
+        with self._lock:
+            self._last.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return {'uploads': self.uploads, 'skipped': self.skipped, 'bytes_uploaded': self.bytes_uploaded}
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+
+# Google Cloud clients shared by all requests of a warm instance. They are created on first use and keep their
+# HTTP connections open, table and bucket handles are cached so they aren't fetched again on every request.
+# The SDKs (and pandas_gbq) are imported on first use as well, so they don't add to the cold start of requests
+# that never need them.
+#
+# Every function folder that uses this module has its own copy of it (each folder is deployed on its own),
+# tests/test_shared_modules.py checks the copies are the same.
+
+HANDLE_TTL_SECONDS = int(os.environ.get('CLIENT_HANDLE_TTL_SECONDS', 600))
+HTTP_POOL_SIZE = int(os.environ.get('CLIENT_HTTP_POOL_SIZE', 16))
+
+_lock = threading.Lock()
+_credentials = None
+_project = None
+_bigquery_client = None
+_storage_client = None
+_tables = {}
+_buckets = {}
+
+
+def _authorized_session():
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    session = AuthorizedSession(_credentials)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    return session
+
+
+def credentials():
+    global _credentials, _project
+    with _lock:
+        if _credentials is None:
+            import google.auth
+            _credentials, _project = google.auth.default()
+    return _credentials, _project
+
+
+def bigquery_client():
+    global _bigquery_client
+    if _bigquery_client is None:
+        from google.cloud import bigquery
+        creds, project = credentials()
+        with _lock:
+            if _bigquery_client is None:
+                _bigquery_client = bigquery.Client(project=project, credentials=creds, _http=_authorized_session())
+    return _bigquery_client
+
+
+def storage_client():
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+        creds, project = credentials()
+        with _lock:
+            if _storage_client is None:
+                _storage_client = storage.Client(project=project, credentials=creds, _http=_authorized_session())
+    return _storage_client
+
+
+def _cached(cache, key, fetch):
+    found = cache.get(key)
+    if found is not None and time.time() - found[0] < HANDLE_TTL_SECONDS:
+        return found[1]
+    value = fetch()
+    cache[key] = (time.time(), value)
+    return value
+
+
+def get_table(table_id):
+    # table_id is 'dataset.table', the table (with its schema) is fetched again after HANDLE_TTL_SECONDS
+    return _cached(_tables, table_id, lambda: bigquery_client().get_table(table_id))
+
+
+def get_bucket(bucket_name):
+    return _cached(_buckets, bucket_name, lambda: storage_client().get_bucket(bucket_name))
+
+
+def query_rows(query, params=None):
+    # Small query results as a list of dicts, without pandas. Values that come from requests are never pasted into
+    # the query, they are passed as params ({name: string value}) and referenced as @name.
+    from google.cloud import bigquery
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter(name, 'STRING', value) for name, value in (params or {}).items()])
+    return [dict(row.items()) for row in bigquery_client().query(query, job_config=job_config).result()]
+
+
+def pandas_gbq():
+    # pandas_gbq with the shared credentials, it would otherwise look them up again on every call
+    import pandas_gbq as module
+    if module.context.credentials is None:
+        module.context.credentials, module.context.project = credentials()
+    return module
@@ -0,0 +1,207 @@
+import base64
+import bisect
+import json
+import logging
+import os
+import struct
+import threading
+
+import clients
+
+# Per level cluster stats for the gpt-stats descriptions, updated on every completion instead of being
+# recomputed with exact medians over the whole table on every request.
+
+STAT_COLUMNS = ['score', 'moves_left', 'num_failed_moves', 'num_clicks_on_board', 'num_boosters_used']
+# Values are exact until a cluster has seen more distinct values than this, then neighbouring ones are merged
+MAX_BINS = 128
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def cluster_key(row):
+    # Levels with the same number of pieces and board size are considered similar
+    values = (row.get('num_different_pieces'), row.get('board_width'), row.get('board_height'))
+    if any(value is None for value in values):
+        return None
+    return '{}:{}x{}'.format(*(int(value) for value in values))
+
+
+class QuantileSketch:
+    # Streaming histogram (Ben-Haim & Tom-Tov): a bounded list of (value, count) centroids plus exact moments.
+    # Two sketches can be merged, so per-instance sketches can be combined.
+    def __init__(self, max_bins=MAX_BINS):
+        self.max_bins = max_bins
+        self.values = []
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        value = float(value)
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        i = bisect.bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            self.counts[i] += count
+            return
+        self.values.insert(i, value)
+        self.counts.insert(i, count)
+        self._compress()
+
+    def _compress(self):
+        while len(self.values) > self.max_bins:
+            # Merge the two closest centroids into their weighted mean
+            gaps = [self.values[i + 1] - self.values[i] for i in range(len(self.values) - 1)]
+            i = gaps.index(min(gaps))
+            count = self.counts[i] + self.counts[i + 1]
+            self.values[i] = (self.values[i] * self.counts[i] + self.values[i + 1] * self.counts[i + 1]) / count
+            self.counts[i] = count
+            del self.values[i + 1]
+            del self.counts[i + 1]
+
+    def merge(self, other):
+        for value, count in zip(other.values, other.counts):
+            i = bisect.bisect_left(self.values, value)
+            if i < len(self.values) and self.values[i] == value:
+                self.counts[i] += count
+            else:
+                self.values.insert(i, value)
+                self.counts.insert(i, count)
+        self._compress()
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def _value_at(self, rank):
+        seen = 0
+        for value, count in zip(self.values, self.counts):
+            seen += count
+            if rank < seen:
+                return value
+        return self.values[-1]
+
+    def quantile(self, q):
+        # Same linear interpolation as pandas / numpy, exact while no centroids were merged
+        if not self.count:
+            return 0
+        rank = q * (self.count - 1)
+        low = int(rank)
+        low_value = self._value_at(low)
+        if rank == low:
+            return low_value
+        return low_value + (self._value_at(low + 1) - low_value) * (rank - low)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_bytes(self):
+        header = struct.pack('<HQd', self.max_bins, self.count, self.total)
+        bounds = struct.pack('<dd', self.min or 0.0, self.max or 0.0)
+        centroids = struct.pack(f'<{len(self.values)}d{len(self.counts)}Q', *self.values, *self.counts)
+        return header + bounds + centroids
+
+    @classmethod
+    def from_bytes(cls, data):
+        max_bins, count, total = struct.unpack_from('<HQd', data)
+        minimum, maximum = struct.unpack_from('<dd', data, struct.calcsize('<HQd'))
+        offset = struct.calcsize('<HQddd')
+        num_bins = (len(data) - offset) // 16
+        centroids = struct.unpack_from(f'<{num_bins}d{num_bins}Q', data, offset)
+        sketch = cls(max_bins)
+        sketch.values = list(centroids[:num_bins])
+        sketch.counts = list(centroids[num_bins:])
+        sketch.count = count
+        sketch.total = total
+        if count:
+            sketch.min = minimum
+            sketch.max = maximum
+        return sketch
+
+
+class ClusterStats:
+    def __init__(self, max_bins=MAX_BINS):
+        self.max_bins = max_bins
+        self.sketches = {}
+        self._lock = threading.Lock()
+
+    def add(self, row):
+        key = cluster_key(row)
+        if key is None:
+            return
+        with self._lock:
+            sketches = self.sketches.setdefault(key, {column: QuantileSketch(self.max_bins) for column in STAT_COLUMNS})
+            for column in STAT_COLUMNS:
+                if row.get(column) is not None:
+                    sketches[column].add(row[column])
+
+    def merge(self, other):
+        with self._lock:
+            for key, other_sketches in other.sketches.items():
+                sketches = self.sketches.setdefault(key, {column: QuantileSketch(self.max_bins)
+                                                          for column in STAT_COLUMNS})
+                for column in STAT_COLUMNS:
+                    sketches[column].merge(other_sketches[column])
+        return self
+
+    def describe(self, row):
+        # avg / median / min / max per column as used by generate_sentence_per_row_w_stats, zeros if unknown
+        sketches = self.sketches.get(cluster_key(row), {})
+        stats = {}
+        for column in STAT_COLUMNS:
+            sketch = sketches.get(column)
+            has_data = sketch is not None and sketch.count > 0
+            stats[f'avg_{column}'] = _number(round(sketch.mean(), 2)) if has_data else 0
+            stats[f'median_{column}'] = _number(round(sketch.quantile(0.5), 2)) if has_data else 0
+            stats[f'min_{column}'] = _number(sketch.min) if has_data else 0
+            stats[f'max_{column}'] = _number(sketch.max) if has_data else 0
+        return stats
+
+    def is_empty(self):
+        return not self.sketches
+
+    def to_json(self):
+        return json.dumps({key: {column: base64.b64encode(sketch.to_bytes()).decode('ascii')
+                                 for column, sketch in sketches.items()}
+                           for key, sketches in self.sketches.items()})
+
+    @classmethod
+    def from_json(cls, data, max_bins=MAX_BINS):
+        stats = cls(max_bins)
+        for key, sketches in json.loads(data).items():
+            stats.sketches[key] = {column: QuantileSketch.from_bytes(base64.b64decode(encoded))
+                                   for column, encoded in sketches.items()}
+        return stats
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path, max_bins=MAX_BINS):
+        if not os.path.exists(path):
+            return cls(max_bins)
+        with open(path) as f:
+            return cls.from_json(f.read(), max_bins)
+
+
+def backfill_cluster_stats(stats):
+    import pandas as pd
+    df = clients.pandas_gbq().read_gbq("""
+        SELECT l.num_different_pieces, l.board_width, l.board_height, p.score, p.moves_left, p.num_failed_moves,
+               p.num_clicks_on_board, p.num_boosters_used
+        FROM match3.player_data p
+        JOIN match3.level_params l ON p.level_compl_id = l.level_uid
+    """)
+    for row in df.to_dict('records'):
+        stats.add({key: (None if pd.isna(value) else value) for key, value in row.items()})
+    logging.info(f"Cluster stats backfilled from {len(df)} completions")
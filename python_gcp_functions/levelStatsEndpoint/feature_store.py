@@ -0,0 +1,336 @@
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import clients
+from move_features import MOVE_FEATURE_COLUMNS
+
+# Per-player history kept up to date on every level completion, so descriptions don't need to rescan
+# the player's whole history with match3.player_levels() on every request.
+#
+# A player's requests can land on any instance, and each instance has its own store, so a cached history may miss
+# completions other instances handled. The level a player completes was served by the request that handled their
+# previous completion, so when the store doesn't know the level, another instance served it and sync_user checks
+# the player: it compares the number of their rows in match3.player_data with the number the store has accounted
+# for and backfills the player again when they differ. Otherwise the store is trusted, unless verify asks for the
+# check on every completion. Both backends keep at most max_users players (the ones used least recently are
+# dropped and backfilled when they come back).
+
+LEVEL_PARAM_COLUMNS = ['num_different_pieces', 'score_goal', 'num_moves', 'board_width', 'board_height',
+                       'collection_goals']
+COMPLETION_COLUMNS = ['level_compl_id', 'level_passed', 'score', 'moves_left', 'num_failed_moves',
+                      'num_clicks_on_board', 'num_boosters_used', 'user_rating'] + MOVE_FEATURE_COLUMNS
+HISTORY_COLUMNS = ['level_in_row'] + COMPLETION_COLUMNS + LEVEL_PARAM_COLUMNS
+ROLLING_COLUMNS = ['score', 'moves_left', 'num_failed_moves', 'num_clicks_on_board', 'num_boosters_used',
+                   'user_rating']
+
+
+def _to_builtin(value):
+    # BigQuery results come back as numpy / pandas scalars, the store keeps plain Python values
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_builtin(v) for v in value]
+    # pd.NA / pd.NaT, checked by type so this module doesn't need to import pandas
+    if value is None or type(value).__name__ in ('NAType', 'NaTType'):
+        return None
+    if isinstance(value, (np.bool_, bool)):
+        return bool(value)
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return None if math.isnan(value) else float(value)
+    return value
+
+
+def clean_collection_goals(collection_goals):
+    if collection_goals is None or isinstance(collection_goals, str):
+        return None
+    return [int(goal) for goal in _to_builtin(list(collection_goals)) if goal is not None]
+
+
+class MemoryBackend:
+    def __init__(self, max_users=10000, max_levels=100000):
+        self.max_users = max_users
+        self.max_levels = max_levels
+        self._history = {}
+        self._rolling = OrderedDict()
+        self._levels = OrderedDict()
+
+    def has_user(self, user_id):
+        return user_id in self._rolling
+
+    def history(self, user_id):
+        return list(self._history.get(user_id, []))
+
+    def rolling(self, user_id):
+        return self._rolling.get(user_id)
+
+    def append(self, user_id, row, rolling):
+        self._history.setdefault(user_id, []).append(row)
+        self.put_rolling(user_id, rolling)
+
+    def put_rolling(self, user_id, rolling):
+        self._rolling[user_id] = rolling
+        self._rolling.move_to_end(user_id)
+        while len(self._rolling) > self.max_users:
+            evicted, _ = self._rolling.popitem(last=False)
+            self._history.pop(evicted, None)
+
+    def remove_user(self, user_id):
+        self._rolling.pop(user_id, None)
+        self._history.pop(user_id, None)
+
+    def get_level(self, level_uid):
+        return self._levels.get(level_uid)
+
+    def put_levels(self, levels):
+        for level in levels:
+            self._levels[level['level_uid']] = level
+            self._levels.move_to_end(level['level_uid'])
+        while len(self._levels) > self.max_levels:
+            self._levels.popitem(last=False)
+
+
+class SqliteBackend:
+    def __init__(self, path, max_users=100000, max_levels=1000000):
+        self.path = path
+        self.max_users = max_users
+        self.max_levels = max_levels
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS history (user_id TEXT, level_in_row INTEGER, payload TEXT, "
+                     "PRIMARY KEY (user_id, level_in_row))")
+        conn.execute("CREATE TABLE IF NOT EXISTS rolling (user_id TEXT PRIMARY KEY, payload TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS levels (level_uid TEXT PRIMARY KEY, payload TEXT)")
+        # Files written before the size limits have no times to evict by
+        for table in ('rolling', 'levels'):
+            columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]
+            if 'updated_at' not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at REAL DEFAULT 0")
+        conn.commit()
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(self.path)
+        return self._local.conn
+
+    def has_user(self, user_id):
+        return self.rolling(user_id) is not None
+
+    def history(self, user_id):
+        cursor = self._conn().execute("SELECT payload FROM history WHERE user_id = ? ORDER BY level_in_row",
+                                      (user_id,))
+        return [json.loads(payload) for (payload,) in cursor]
+
+    def rolling(self, user_id):
+        found = self._conn().execute("SELECT payload FROM rolling WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def append(self, user_id, row, rolling):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?)",
+                     (user_id, row['level_in_row'], json.dumps(row)))
+        self.put_rolling(user_id, rolling)
+
+    def put_rolling(self, user_id, rolling):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO rolling VALUES (?, ?, ?)", (user_id, json.dumps(rolling), time.time()))
+        evicted = conn.execute("SELECT user_id FROM rolling ORDER BY updated_at DESC LIMIT -1 OFFSET ?",
+                               (self.max_users,)).fetchall()
+        for (evicted_user,) in evicted:
+            self._delete_user(conn, evicted_user)
+        conn.commit()
+
+    def remove_user(self, user_id):
+        conn = self._conn()
+        self._delete_user(conn, user_id)
+        conn.commit()
+
+    def _delete_user(self, conn, user_id):
+        conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM rolling WHERE user_id = ?", (user_id,))
+
+    def get_level(self, level_uid):
+        found = self._conn().execute("SELECT payload FROM levels WHERE level_uid = ?", (level_uid,)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def put_levels(self, levels):
+        conn = self._conn()
+        now = time.time()
+        conn.executemany("INSERT OR REPLACE INTO levels VALUES (?, ?, ?)",
+                         [(level['level_uid'], json.dumps(level), now) for level in levels])
+        conn.execute("DELETE FROM levels WHERE level_uid IN (SELECT level_uid FROM levels ORDER BY updated_at DESC "
+                     "LIMIT -1 OFFSET ?)", (self.max_levels,))
+        conn.commit()
+
+
+def empty_rolling():
+    return {
+        'count': 0,
+        'passed': 0,
+        'sum': {column: 0 for column in ROLLING_COLUMNS},
+        'num_values': {column: 0 for column in ROLLING_COLUMNS},
+        'last': {column: None for column in ROLLING_COLUMNS}
+    }
+
+
+def update_rolling(rolling, row):
+    rolling['count'] += 1
+    rolling['passed'] += int(bool(row.get('level_passed')))
+    for column in ROLLING_COLUMNS:
+        value = row.get(column)
+        if value is None:
+            continue
+        rolling['sum'][column] += value
+        rolling['num_values'][column] += 1
+        rolling['last'][column] = value
+    return rolling
+
+
+class FeatureStore:
+    def __init__(self, backend, level_params_loader=None):
+        self.backend = backend
+        # Called with a level_uid when the level wasn't generated by this store's instance
+        self.level_params_loader = level_params_loader
+        self._lock = threading.Lock()
+
+    def has_user(self, user_id):
+        return self.backend.has_user(user_id)
+
+    def add_levels(self, levels):
+        self.backend.put_levels([{'level_uid': level['level_uid'], **{column: level.get(column) for column in
+                                                                      LEVEL_PARAM_COLUMNS}}
+                                 for level in levels])
+
+    def has_level(self, level_uid):
+        # Whether the level was served by this store's instance (or loaded into the store), without loading it
+        return self.backend.get_level(level_uid) is not None
+
+    def level_params(self, level_uid):
+        level = self.backend.get_level(level_uid)
+        if level is None and self.level_params_loader is not None:
+            level = self.level_params_loader(level_uid)
+            if level is not None:
+                self.add_levels([level])
+        return level or {}
+
+    def completion_row(self, completion):
+        # completion holds the COMPLETION_COLUMNS, the level's parameters are joined in by level_compl_id
+        level = self.level_params(completion['level_compl_id'])
+        row = {column: level.get(column) for column in LEVEL_PARAM_COLUMNS}
+        row.update({column: completion.get(column) for column in COMPLETION_COLUMNS})
+        return row
+
+    def add_completion(self, user_id, completion):
+        return self.add_completion_row(user_id, self.completion_row(completion))
+
+    def add_completion_row(self, user_id, row):
+        with self._lock:
+            rolling = self.backend.rolling(user_id) or empty_rolling()
+            stored = {column: _to_builtin(row.get(column)) for column in HISTORY_COLUMNS}
+            stored['collection_goals'] = clean_collection_goals(row.get('collection_goals'))
+            stored['level_in_row'] = rolling['count'] + 1
+            self.backend.append(user_id, stored, update_rolling(rolling, stored))
+        return stored
+
+    def load_history(self, user_id, rows):
+        # Seeds the store from rows shaped like player_levels() (or player_data joined with level_params). A player
+        # without rows is kept too, so they aren't backfilled again.
+        for row in rows:
+            self.add_completion_row(user_id, row)
+        if not rows:
+            with self._lock:
+                self.backend.put_rolling(user_id, self.backend.rolling(user_id) or empty_rolling())
+
+    def history(self, user_id):
+        return self.backend.history(user_id)
+
+    def player_data_count(self, user_id):
+        # Rows of the player in match3.player_data the store has accounted for, None if it was never synced
+        rolling = self.backend.rolling(user_id)
+        return rolling.get('player_data_count') if rolling else None
+
+    def set_player_data_count(self, user_id, count):
+        with self._lock:
+            rolling = self.backend.rolling(user_id) or empty_rolling()
+            rolling['player_data_count'] = count
+            self.backend.put_rolling(user_id, rolling)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            self.backend.remove_user(user_id)
+
+    def history_df(self, user_id):
+        import pandas as pd
+        # object dtype keeps integers printing as integers in the descriptions, even next to missing values
+        return pd.DataFrame(self.history(user_id), columns=HISTORY_COLUMNS, dtype=object)
+
+    def rolling(self, user_id):
+        rolling = self.backend.rolling(user_id) or empty_rolling()
+        averages = {column: rolling['sum'][column] / rolling['num_values'][column]
+                    for column in ROLLING_COLUMNS if rolling['num_values'][column]}
+        return {**rolling, 'avg': averages}
+
+
+def load_level_params_from_bigquery(level_uid):
+    rows = clients.query_rows("SELECT * FROM match3.level_params WHERE level_uid = @level_uid LIMIT 1",
+                              {'level_uid': level_uid})
+    return rows[0] if rows else None
+
+
+def backfill_user(store, user_id):
+    # Used the first time an instance sees a player, the store is then kept up to date incrementally
+    rows = clients.query_rows("SELECT * FROM match3.player_levels(@user_id)", {'user_id': user_id})
+    if rows and 'level_in_row' in rows[0]:
+        rows.sort(key=lambda row: row['level_in_row'])
+    store.load_history(user_id, rows)
+    logging.info(f"{user_id} - Feature store backfilled with {len(rows)} levels")
+
+
+def count_player_data(user_id):
+    rows = clients.query_rows("SELECT COUNT(*) AS completions FROM match3.player_data WHERE user_id = @user_id",
+                              {'user_id': user_id})
+    return int(rows[0]['completions']) if rows else 0
+
+
+def sync_user(store, user_id, verify=True, level_uid=None):
+    # Makes sure the player's history has every completion in match3.player_data before new ones are added, returns
+    # the number of their rows in match3.player_data (None if it isn't known). Without verify, a player the store has
+    # is trusted as is unless level_uid, the level they completed, isn't one the store knows.
+    if not store.has_user(user_id) and not verify:
+        backfill_user(store, user_id)
+        return None
+    if store.has_user(user_id) and not verify and (level_uid is None or store.has_level(level_uid)):
+        return store.player_data_count(user_id)
+    count = count_player_data(user_id)
+    if store.player_data_count(user_id) != count:
+        if store.has_user(user_id):
+            logging.info(f"{user_id} - Feature store is missing completions, backfilling again")
+        store.remove_user(user_id)
+        backfill_user(store, user_id)
+        store.set_player_data_count(user_id, count)
+    return count
+
+
+def backfill_from_player_data(store):
+    # Bulk backfill of every player from player_data joined with the parameters of the played levels
+    df = clients.pandas_gbq().read_gbq("""
+        SELECT p.user_id, p.level_compl_id, p.level_passed, p.score, p.moves_left, p.num_failed_moves,
+               p.num_clicks_on_board, p.num_boosters_used, p.user_rating, p.think_time_p50, p.think_time_p90,
+               p.max_illegal_streak, p.score_per_move, p.direction_entropy, l.num_different_pieces, l.score_goal,
+               l.num_moves, l.board_width, l.board_height, l.collection_goals
+        FROM match3.player_data p
+        LEFT JOIN match3.level_params l ON p.level_compl_id = l.level_uid
+        ORDER BY p.user_id, p.date
+    """)
+    for user_id, df_user in df.groupby('user_id', sort=False):
+        if not store.has_user(user_id):
+            store.load_history(user_id, df_user.to_dict('records'))
+            store.set_player_data_count(user_id, len(df_user))
+    logging.info(f"Feature store backfilled with {df['user_id'].nunique()} players")
@@ -0,0 +1,65 @@
+# Batch version of the random level generator. Draws every field for all levels at once with NumPy,
+# under the same rules as the original loop:
+#   num_different_goals is in NUM_DIFFERENT_GOALS but never more than num_different_pieces
+#   score_goal is a multiple of 3 in SCORE_GOAL_RANGE (end excluded, like range())
+#   the other fields are uniform over their inclusive ranges (like random.randint)
+#
+# Every function folder that uses this module has its own copy of it (each folder is deployed on its own),
+# tests/test_shared_modules.py checks the copies are the same. NumPy is imported by the functions, gpt default sets
+# never need it.
+
+LEVEL_FIELDS = ['num_different_pieces', 'score_goal', 'board_width', 'board_height', 'num_moves', 'time_seconds']
+
+
+def _randint(rng, low, high, size):
+    # Inclusive on both ends, like random.randint; low / high may be arrays
+    import numpy as np
+    return rng.integers(low, np.asarray(high) + 1, size=size)
+
+
+def generate_level_columns(n, num_different_pieces_range, num_different_goals_range, score_goal_range,
+                           num_moves_range, board_size_range, collection_goals_pieces_range, seed=None):
+    # Returns a dict of arrays of length n. collection_goals is an (n, max goals) matrix padded with 0 where
+    # a level has fewer goals, num_different_goals says how many of the columns are used.
+    import numpy as np
+    rng = np.random.default_rng(seed)
+
+    num_different_pieces = _randint(rng, *num_different_pieces_range, n)
+    max_goals = np.minimum(num_different_goals_range[1], num_different_pieces)
+    num_different_goals = _randint(rng, num_different_goals_range[0], max_goals, n)
+
+    lowest_multiple = -(-score_goal_range[0] // 3)
+    highest_multiple = (score_goal_range[1] - 1) // 3
+    score_goal = 3 * _randint(rng, lowest_multiple, highest_multiple, n)
+
+    goals = _randint(rng, *collection_goals_pieces_range, (n, num_different_goals_range[1]))
+    goals[np.arange(num_different_goals_range[1]) >= num_different_goals[:, None]] = 0
+
+    return {
+        'num_different_pieces': num_different_pieces,
+        'score_goal': score_goal,
+        'board_width': _randint(rng, *board_size_range, n),
+        'board_height': _randint(rng, *board_size_range, n),
+        'num_moves': _randint(rng, *num_moves_range, n),
+        'time_seconds': np.zeros(n, dtype=np.int64),
+        'num_different_goals': num_different_goals,
+        'collection_goals': goals
+    }
+
+
+def columns_to_levels(columns):
+    # Converts the arrays into the list of dicts the rest of the code (and the bucket JSON) uses
+    fields = [columns[field].tolist() for field in LEVEL_FIELDS]
+    goals = columns['collection_goals'].tolist()
+    num_goals = columns['num_different_goals'].tolist()
+    levels = []
+    for i, values in enumerate(zip(*fields)):
+        level = dict(zip(LEVEL_FIELDS, values))
+        level['collection_goals'] = goals[i][:num_goals[i]]
+        levels.append(level)
+    return levels
+
+
+def generate_random_level_batch(n, *ranges, seed=None, columnar=False):
+    columns = generate_level_columns(n, *ranges, seed=seed)
+    return columns if columnar else columns_to_levels(columns)
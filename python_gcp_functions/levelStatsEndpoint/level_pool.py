@@ -0,0 +1,136 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Ready-made level sets per (player, serving strategy). A completion takes a set right away and the pool is
+# refilled in the background, so the LLM call is not part of the request any more.
+#
+# Sets are made from the player's data up to the completion that queued the refill, so sets older than
+# max_age_seconds are thrown away instead of served. The only refill queue is LocalRefillQueue, a thread in the
+# instance: refills that are still queued when the instance is stopped are lost, and the player's next
+# completion is served without a pooled set (and queues the refill again).
+
+
+class MemoryPoolBackend:
+    def __init__(self):
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def push(self, user_id, strategy, entry):
+        with self._lock:
+            self._sets.setdefault((user_id, strategy), deque()).append(entry)
+
+    def pop(self, user_id, strategy):
+        with self._lock:
+            sets = self._sets.get((user_id, strategy))
+            return sets.popleft() if sets else None
+
+    def size(self, user_id, strategy):
+        with self._lock:
+            return len(self._sets.get((user_id, strategy), ()))
+
+
+class SqlitePoolBackend:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS level_sets (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "user_id TEXT, strategy TEXT, payload TEXT)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def push(self, user_id, strategy, entry):
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT INTO level_sets (user_id, strategy, payload) VALUES (?, ?, ?)",
+                         (user_id, strategy, json.dumps(entry)))
+
+    def pop(self, user_id, strategy):
+        with self._lock, self._connect() as conn:
+            found = conn.execute("SELECT id, payload FROM level_sets WHERE user_id = ? AND strategy = ? "
+                                 "ORDER BY id LIMIT 1", (user_id, strategy)).fetchone()
+            if found is None:
+                return None
+            conn.execute("DELETE FROM level_sets WHERE id = ?", (found[0],))
+        return json.loads(found[1])
+
+    def size(self, user_id, strategy):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM level_sets WHERE user_id = ? AND strategy = ?",
+                                (user_id, strategy)).fetchone()[0]
+
+
+class LocalRefillQueue:
+    # Stand-in for a task queue: refills run one at a time on a worker thread, duplicates are dropped
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self.handler = None
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def enqueue(self, user_id, strategy):
+        with self._lock:
+            if (user_id, strategy) in self._queued:
+                return
+            self._queued.add((user_id, strategy))
+        self._jobs.put((user_id, strategy))
+
+    def _work(self):
+        while True:
+            user_id, strategy = self._jobs.get()
+            with self._lock:
+                self._queued.discard((user_id, strategy))
+            try:
+                self.handler(user_id, strategy)
+            except Exception as e:
+                logging.error(f"{user_id} - Refilling the {strategy} level pool failed: {e}")
+            finally:
+                self._jobs.task_done()
+
+    def join(self):
+        self._jobs.join()
+
+
+class LevelPool:
+    # generate(user_id, strategy, variant=...) returns (descriptions, response_json, classification) for one level
+    # set. Sets made while the pool still has sets get a variant number, so they are not the same as those.
+    def __init__(self, backend, generate, refill_queue, size=1, max_age_seconds=None):
+        self.backend = backend
+        self.generate = generate
+        self.refill_queue = refill_queue
+        self.refill_queue.handler = self.refill
+        self.size = size
+        self.max_age_seconds = max_age_seconds
+        self.served_from_pool = 0
+        self.served_empty = 0
+        self.expired = 0
+
+    def take(self, user_id, strategy):
+        entry = self.backend.pop(user_id, strategy)
+        while entry is not None and self.max_age_seconds and time.time() - entry['created_at'] > self.max_age_seconds:
+            self.expired += 1
+            entry = self.backend.pop(user_id, strategy)
+        if entry is None:
+            self.served_empty += 1
+        else:
+            self.served_from_pool += 1
+        self.refill_queue.enqueue(user_id, strategy)
+        return entry
+
+    def refill(self, user_id, strategy):
+        while self.backend.size(user_id, strategy) < self.size:
+            descriptions, response_json, classification = self.generate(
+                user_id, strategy, variant=self.backend.size(user_id, strategy))
+            self.backend.push(user_id, strategy, {
+                'descriptions': descriptions,
+                'response_json': response_json,
+                'classification': classification,
+                'created_at': time.time()
+            })
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Cache for LLM responses. Values are stored as JSON text, so every hit returns a fresh copy that the caller
+# may modify (levels get their uids assigned in place).
+#
+# Every function folder that uses this module has its own copy of it (each folder is deployed on its own),
+# tests/test_shared_modules.py checks the copies are the same.
+
+
+def hash_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class MemoryStorage:
+    # In-process LRU
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+
+class FileStorage:
+    # One file per key, so the cache survives restarts and can be shared through a mounted directory.
+    # A file's mtime is its last use, the least recently used files are removed first.
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry['stored_at'], entry['value']
+
+    def put(self, key, stored_at, value):
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'stored_at': stored_at, 'value': value}, f)
+        os.replace(tmp_path, path)
+
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(files) <= self.max_entries:
+            return 0
+        files.sort(key=os.path.getmtime)
+        for stale_path in files[:len(files) - self.max_entries]:
+            self.delete_path(stale_path)
+        return len(files) - self.max_entries
+
+    def delete(self, key):
+        self.delete_path(self._path(key))
+
+    @staticmethod
+    def delete_path(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    def __init__(self, storage, ttl_seconds=3600):
+        self.storage = storage
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self.storage.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+                self.storage.delete(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def put(self, key, value):
+        with self._lock:
+            self.evictions += self.storage.put(key, time.time(), json.dumps(value))
+
+    def get_or_compute(self, key, compute):
+        cached = self.get(key)
+        if cached is not None:
+            logging.info(f"LLM cache hit for {key[:12]}")
+            return cached, True
+        value = compute()
+        self.put(key, value)
+        return json.loads(json.dumps(value)), False
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+def cache_from_env():
+    # LLM_CACHE_DIR switches from the in-process cache to files, LLM_CACHE_TTL_SECONDS=0 disables caching
+    max_entries = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 1000))
+    ttl_seconds = float(os.environ.get('LLM_CACHE_TTL_SECONDS', 3600))
+    if os.environ.get('LLM_CACHE_DIR'):
+        storage = FileStorage(os.environ['LLM_CACHE_DIR'], max_entries)
+    else:
+        storage = MemoryStorage(max_entries)
+    return ResponseCache(storage, ttl_seconds)
@@ -1,19 +1,45 @@
 from datetime import datetime
-from google.cloud import bigquery
-import pandas as pd
-import pandas_gbq
-import openai
 import json
 import uuid
-from google.cloud import storage
 import logging
-import numpy as np
-import random
+import math
 import time
 import os
-
-openai.api_key = os.getenv('OPENAI_API_KEY')
+import atexit
+import threading
+import concurrent.futures
+
+import stages
+import tracing
+import clients
+from feature_store import HISTORY_COLUMNS, FeatureStore, MemoryBackend, SqliteBackend, sync_user, \
+    load_level_params_from_bigquery
+from cluster_stats import ClusterStats, backfill_cluster_stats
+from llm_cache import cache_from_env, hash_key
+from level_generator import generate_random_level_batch
+from starting_boards import StartingBoardCache, attach_starting_boards
+from streaming_levels import LevelsStreamParser, is_complete_level
+from level_pool import LevelPool, LocalRefillQueue, MemoryPoolBackend, SqlitePoolBackend
+from player_classifier import PlayerClassifier, features_json, history_features
+from bucket_publisher import BucketPublisher
+from prompt_builder import build_descriptions
+from single_flight import MemoryFlightStore, SingleFlight, SqliteFlightStore
+from move_features import MOVE_FEATURE_COLUMNS, move_features
+
+# pandas, pandas_gbq, openai and the Google Cloud SDKs are imported where they are used, so a cold start doesn't
+# pay for the ones the request never needs (the random strategy needs neither pandas nor openai to respond).
+# NumPy is the exception: move_features needs it for every completion, and the modules built on it import it at
+# the top, deferring it would only move its import from the cold start to the first request.
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = "gpt-4-0613"
 NUM_LEVELS_TO_SUGGEST = 3
+# How many of the player's latest levels make up the profile the LLM responses are cached under
+PROFILE_LEVELS = 3
+
+# The player's data in the prompt is kept within PROMPT_TOKEN_BUDGET tokens (0: no limit): the latest
+# PROMPT_RECENT_LEVELS levels are described one by one, older ones are summarised (see prompt_builder.py)
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', 3000))
+PROMPT_RECENT_LEVELS = int(os.environ.get('PROMPT_RECENT_LEVELS', 10))
 
 # Define ranges as global variables
 NUM_DIFFERENT_PIECES_RANGE = (3, 5)
@@ -25,40 +51,272 @@ COLLECTION_GOALS_PIECES_RANGE = (5, 15)
 
 FLAG_RANDOM = "Data was randomly generated"
 
+# Player histories are kept per instance (or in the SQLite file at FEATURE_STORE_PATH) and updated on every completion,
+# for at most FEATURE_STORE_MAX_USERS players, of the strategies that read them (HISTORY_STRATEGIES; level pool
+# refills and the player classifier only run for those). Other instances may have handled some of a player's
+# completions: when the completed level wasn't served by this instance, the history is checked against the player's
+# rows in match3.player_data (see feature_store.sync_user). FEATURE_STORE_VERIFY=1 checks it on every completion.
+FEATURE_STORE_MAX_USERS = int(os.environ.get('FEATURE_STORE_MAX_USERS', 10000))
+FEATURE_STORE_VERIFY = os.environ.get('FEATURE_STORE_VERIFY', '') == '1'
+HISTORY_STRATEGIES = ['gpt', 'gpt-stats']
+if os.environ.get('FEATURE_STORE_PATH'):
+    feature_store_backend = SqliteBackend(os.environ['FEATURE_STORE_PATH'], max_users=FEATURE_STORE_MAX_USERS)
+else:
+    feature_store_backend = MemoryBackend(max_users=FEATURE_STORE_MAX_USERS)
+feature_store = FeatureStore(feature_store_backend, level_params_loader=load_level_params_from_bigquery)
+
+# gpt-stats compares the player's levels with the levels of their cluster. By default the stats come from
+# match3.player_levels() as they always have, its clusters are part of the experiment's treatment.
+# CLUSTER_STATS_SOURCE=sketches serves them from the streaming sketches of cluster_stats.py instead, which cluster
+# levels by (num_different_pieces, board_width, board_height): a different cluster definition, so only for runs that
+# change the treatment on purpose. The sketches are loaded from the snapshot at CLUSTER_STATS_PATH, or backfilled
+# from BQ in the background (levels get the sentence without stats until that is done).
+CLUSTER_STATS_SOURCE = os.environ.get('CLUSTER_STATS_SOURCE', 'player_levels')
+CLUSTER_STATS_PATH = os.environ.get('CLUSTER_STATS_PATH')
+if CLUSTER_STATS_PATH and os.path.exists(CLUSTER_STATS_PATH):
+    cluster_stats = ClusterStats.load(CLUSTER_STATS_PATH)
+    cluster_stats_ready = True
+else:
+    cluster_stats = ClusterStats()
+    cluster_stats_ready = False
+cluster_stats_lock = threading.Lock()
+cluster_stats_backfill = None
+if CLUSTER_STATS_PATH:
+    atexit.register(lambda: cluster_stats.save(CLUSTER_STATS_PATH))
+
+# Generated levels are reused for players with a near-identical profile, see player_profile
+llm_cache = cache_from_env()
+
+# With LEVEL_POOL_SIZE > 0, every player keeps that many level sets per strategy ready. They are generated in the
+# background after a completion, from the data up to that completion, and not served once they are older than
+# LEVEL_POOL_MAX_AGE_SECONDS (0 keeps them). Refills run on a thread of the instance, see level_pool.py.
+LEVEL_POOL_SIZE = int(os.environ.get('LEVEL_POOL_SIZE', 0))
+LEVEL_POOL_MAX_AGE_SECONDS = float(os.environ.get('LEVEL_POOL_MAX_AGE_SECONDS', 3600))
+level_pool = None
+
+# With ATTACH_STARTING_BOARDS set, every served level carries a ready deadlock-free board (see starting_boards.py)
+ATTACH_STARTING_BOARDS = os.environ.get('ATTACH_STARTING_BOARDS', '') == '1'
+starting_board_cache = StartingBoardCache()
+
+# With STREAM_LEVELS set, the LLM response is streamed and every level is published to the bucket as soon as it
+# is complete, the player can start the next level before the whole response is generated
+STREAM_LEVELS = os.environ.get('STREAM_LEVELS', '') == '1'
+
+# Latency budget for level generation. When it runs out (or generation fails) the player gets random levels right
+# away; the LLM levels still finish in the background and replace them unless the file has changed since.
+LEVEL_GENERATION_DEADLINE_SECONDS = float(os.environ.get('LEVEL_GENERATION_DEADLINE_SECONDS', 0))
+FALLBACK_TIMEOUT = "timeout"
+FALLBACK_ERROR = "error"
+
+# With PLAYER_CLASSIFIER_PATH (a model trained by player_classifier.py) the player type is classified locally from
+# the player's feature store history. In "prompt" mode the LLM is told the type and only designs the levels, in
+# "shadow" mode the type is only logged, to compare it with the LLM's. Below PLAYER_CLASSIFIER_MIN_CONFIDENCE the
+# LLM classifies the player as before. The classifier's type is logged in its own column (classifier_player_type),
+# resp_player_type is always the LLM's, and player_type_source says whether the LLM was told the type.
+PLAYER_CLASSIFIER_PATH = os.environ.get('PLAYER_CLASSIFIER_PATH')
+PLAYER_CLASSIFIER_MODE = os.environ.get('PLAYER_CLASSIFIER_MODE', 'prompt')
+PLAYER_CLASSIFIER_MIN_CONFIDENCE = float(os.environ.get('PLAYER_CLASSIFIER_MIN_CONFIDENCE', 0.6))
+player_classifier = PlayerClassifier.load(PLAYER_CLASSIFIER_PATH) if PLAYER_CLASSIFIER_PATH else None
+
+# Level files are written compact and gzipped (BUCKET_CONTENT_ENCODING=identity for plain JSON) and not uploaded again
+# when nothing changed. BUCKET_VERSIONED_OBJECTS adds immutable per-version objects and a pointer, see bucket_publisher.
+bucket_publisher = BucketPublisher('m3-levels', content_encoding=os.environ.get('BUCKET_CONTENT_ENCODING', 'gzip'),
+                                   versioned=os.environ.get('BUCKET_VERSIONED_OBJECTS', '') == '1',
+                                   keep_plain_object=os.environ.get('BUCKET_KEEP_PLAIN_OBJECT', '1') == '1')
+
+# With SINGLE_FLIGHT_TTL_SECONDS set, a retried or double-submitted POST (same user, levelGuid and dateSent) is
+# processed once: duplicates that come in while it runs wait for its response, later ones get the stored response
+# for that long. A replay of the same levelGuid after a loss has a new dateSent and is processed as a new play.
+# Off by default: the in-memory store only catches duplicates that land on the same instance, SINGLE_FLIGHT_PATH
+# (a SQLite file) shares it between the processes that can reach the file.
+SINGLE_FLIGHT_TTL_SECONDS = float(os.environ.get('SINGLE_FLIGHT_TTL_SECONDS', 0))
+if SINGLE_FLIGHT_TTL_SECONDS:
+    single_flight = SingleFlight(
+        SqliteFlightStore(os.environ['SINGLE_FLIGHT_PATH']) if os.environ.get('SINGLE_FLIGHT_PATH')
+        else MemoryFlightStore(), ttl_seconds=SINGLE_FLIGHT_TTL_SECONDS,
+        lease_seconds=float(os.environ.get('SINGLE_FLIGHT_LEASE_SECONDS', 300)))
+else:
+    single_flight = None
+
+# With MOVES_STAGING_URI (a local directory or gs://bucket/prefix), moves are staged as Parquet and loaded in bulk
+if os.environ.get('MOVES_STAGING_URI'):
+    from moves_staging import MOVES_SCHEMA, ParquetStager, moves_to_record_batch
+    moves_stager = ParquetStager(os.environ['MOVES_STAGING_URI'], "match3.moves", MOVES_SCHEMA,
+                                 max_rows=int(os.environ.get('MOVES_STAGING_MAX_ROWS', 5000)),
+                                 load_interval_seconds=int(os.environ.get('MOVES_LOAD_INTERVAL_SECONDS', 300)))
+else:
+    moves_stager = None
+
 
 def main(request):
+    error = batch_error(request.get_json())
+    if error:
+        logging.warning(f"Rejected request: {error}")
+        return error, 400
+    key = completion_key(request.get_json())
+    if single_flight is None or key is None:
+        return process_completion(request)
+    response_json, how = single_flight.run(key, lambda: process_completion(request))
+    if how != 'ran':
+        logging.info(f"{key} - Duplicate completion, response {how}, {single_flight.stats()}")
+    return response_json
+
+
+def batch_error(data):
+    # Why a batch of completions can't be processed, None if it can: a batch holds at least one play, all of one player
+    if 'completions' not in data:
+        return None
+    completions = data['completions']
+    if not isinstance(completions, list) or not completions:
+        return "completions is empty"
+    try:
+        user_ids = {completion['level']['userId'] for completion in completions}
+    except (KeyError, TypeError):
+        return "every completion needs level.userId"
+    if len(user_ids) > 1:
+        return "completions of more than one userId"
+    return None
+
+
+def completion_key(data):
+    # The user, levelGuid and dateSent of the completion the levels are generated for (the latest one of a batch)
+    try:
+        latest = sorted(data['completions'], key=lambda c: c['level']['dateSent'])[-1] if 'completions' in data \
+            else data
+        return f"{latest['level']['userId']}:{latest['level']['levelGuid']}:{latest['level']['dateSent']}"
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+@tracing.traced_request
+def process_completion(request):
     start_time = time.time()
+    # Spans of every stage below add their time to this trace, it goes into the logs row
+    trace = tracing.current_trace()
     # We get the level data
     data = request.get_json()
+    # Plays the client queued while offline come in one request as {"completions": [...]}, in the order played.
+    # They are all stored, the levels are generated once, for the latest one.
+    completions = sorted(data['completions'], key=lambda c: c['level']['dateSent']) if 'completions' in data \
+        else [data]
+    data = completions[-1]
     # We extract the level's GUID and LevelServingStrategy to use in different functions
     level_compl_id = data["level"]["levelGuid"]
     level_serv_strat = data["level"]["worldServed"]
-    # The data on the level completion is sent to BQ with the unique id
-    user_id = level_to_bq(data, level_compl_id)
-    # Data on individual moves is saved to BQ (not used currently though)
-    moves_to_bq(data, level_compl_id)
+    # Data on individual moves is saved to BQ (skill signals from them are stored with the completion by
+    # level_to_bq), nothing below depends on it
+    moves_stage = stages.run_stage(moves_to_bq, completions)
+    # The data on the level completions is sent to BQ with their unique ids
+    user_id = level_to_bq(completions)
+    # Levels are taken from the player's pool of pre-generated sets if there is one ready
+    pooled = level_pool.take(user_id, level_serv_strat) if level_pool else None
+    published = []
+    fallback = None
+    if pooled:
+        descriptions, response_json = pooled['descriptions'], pooled['response_json']
+        classification = pooled.get('classification')
+    else:
+        on_level, published, stop_publishing = early_publisher(user_id) if STREAM_LEVELS else (None, [], None)
+        generation = stages.run_generation(generate_levels, user_id, level_serv_strat, on_level)
+        try:
+            descriptions, response_json, classification = generation.result(
+                timeout=LEVEL_GENERATION_DEADLINE_SECONDS or None)
+        except concurrent.futures.TimeoutError:
+            fallback = FALLBACK_TIMEOUT
+        except Exception as e:
+            logging.error(f"{user_id} - Level generation failed, serving random levels: {e}")
+            fallback = FALLBACK_ERROR
+        if fallback:
+            # Levels published while streaming may have been fetched already, they stay and random ones follow
+            if stop_publishing:
+                stop_publishing()
+            descriptions, response_json, classification = FLAG_RANDOM, generate_response_for_random(), None
+
+    # Levels are asigned unique IDs, the ones published while streaming keep the ids (and boards) they went out with
+    levels = add_uid_and_date(response_json['levels'])
+    levels[:len(published)] = published
+    if ATTACH_STARTING_BOARDS:
+        attach_starting_boards(levels, starting_board_cache)
+    # Levels are finally written to bucket as a JSON file for the app to fetch them. If the file already holds the
+    # same levels, levels now have its level_uids, which the app sends back with the next completion.
+    new_uids = {level['level_uid'] for level in levels}
+    uploaded_generation = levels_to_bucket(user_id, levels)
+    feature_store.add_levels(levels)
+    if fallback == FALLBACK_TIMEOUT:
+        generation.add_done_callback(lambda done: stages.defer(
+            replace_fallback_levels, user_id, level_compl_id, done, uploaded_generation, published, start_time, data))
+    # Their parameters are writen to BQ for future reference and the data is saved for further analysis,
+    # the player doesn't need to wait for either. Levels of the file are in match3.level_params already.
+    levels_written = stages.defer(level_params_to_bq, [level for level in levels if level['level_uid'] in new_uids])
+    moves_stage.result()
+    tracing.finish_trace(trace, user_id)
+    stages.defer(log_all_data, user_id, level_compl_id, descriptions, response_json, start_time, data, time.time(),
+                 trace, levels_written, fallback, classification)
+    return response_json
+
+
+def replace_fallback_levels(user_id, level_compl_id, generation, fallback_generation, published, start_time, data):
+    # The LLM levels that missed the deadline. They replace the random ones in the bucket only if the file is
+    # still the one written with them (a newer completion writes a new file), and are logged either way.
+    try:
+        descriptions, response_json, classification = generation.result()
+    except Exception as e:
+        logging.error(f"{user_id} - Level generation failed after the deadline: {e}")
+        return
+    levels = add_uid_and_date(response_json['levels'])
+    levels[:len(published)] = published
+    if ATTACH_STARTING_BOARDS:
+        attach_starting_boards(levels, starting_board_cache)
+    replaced = fallback_generation is not None and \
+        levels_to_bucket(user_id, levels, if_generation_match=fallback_generation) is not None
+    logging.info(f"{user_id} - Late levels {'replaced the random ones' if replaced else 'were not served'}")
+    # The streamed levels were recorded with the random ones
+    new_levels = levels[len(published):]
+    if replaced:
+        feature_store.add_levels(new_levels)
+    level_params_to_bq(new_levels)
+    log_all_data(user_id, level_compl_id, descriptions, response_json, start_time, data,
+                 fallback='late_replaced' if replaced else 'late_not_served', classification=classification)
+
+
+def generate_levels(user_id, level_serv_strat, on_level=None, variant=0):
     # We determine the strategy for level generation for testing purposes
     if level_serv_strat == "gpt":
         # Player's stats are listed against the level requirements
         descriptions = get_stats_from_bigquery(user_id, False)
+        classification = classify_player(user_id)
         logging.info(f"{user_id} - {level_serv_strat} Calling OpenAI ...")
-        response_json = call_to_openai(descriptions)
+        response_json, classification['llm_cache_hit'] = cached_call_to_openai(
+            user_id, descriptions, False, on_level, classification['player_type'], variant)
     elif level_serv_strat == "gpt-stats":
         # This level's stats are compared against the stats for levels in the similar cluster
         descriptions = get_stats_from_bigquery(user_id, True)
+        classification = classify_player(user_id)
         logging.info(f"{user_id} - {level_serv_strat} Calling OpenAI ...")
-        response_json = call_to_openai(descriptions)
+        response_json, classification['llm_cache_hit'] = cached_call_to_openai(
+            user_id, descriptions, True, on_level, classification['player_type'], variant)
     else:
         descriptions = FLAG_RANDOM
         response_json = generate_response_for_random()
-
-    # Levels are asigned unique IDs and their parameters writen to BQ for future reference
-    json_levels = levels_to_bq(response_json['levels'])
-    # Levels are finally written to bucket as a JSON file for the app to fetch them
-    levels_to_bucket(user_id, json_levels)
-    # Saves the data for further analysis
-    log_all_data(user_id, level_compl_id, descriptions, response_json, start_time, data)
-    return response_json
+        classification = None
+    return descriptions, response_json, classification
+
+
+@tracing.traced('classify_player')
+def classify_player(user_id):
+    # The classifier's features of the player (logged, they are what it is trained on), its type for the player and
+    # the player type for the prompt, None if the LLM should determine it
+    history = feature_store.history(user_id)
+    classification = {'features': features_json(history_features(history)) if history else None,
+                      'label': None, 'player_type': None}
+    if player_classifier is None or not history:
+        return classification
+    label, probability = player_classifier.classify(history)
+    logging.info(f"{user_id} - Classified as {label} ({probability:.2f}), mode {PLAYER_CLASSIFIER_MODE}")
+    classification['label'] = label
+    if PLAYER_CLASSIFIER_MODE == 'prompt' and probability >= PLAYER_CLASSIFIER_MIN_CONFIDENCE:
+        classification['player_type'] = label
+    return classification
 
 
 system_prompt = """
@@ -98,6 +356,19 @@ Your task is to:
 Return the response in JSON format.
 """
 
+# Added to user_prompt for the level pool's later sets made from the same data, the responses are deterministic
+# (temperature 0) and would otherwise repeat the first set
+variant_prompt = """
+This is alternative set number {variant} for the same player. Keep the parameters suited to the player, but make the
+levels noticeably different from the set you would design first.
+"""
+
+# Added to user_prompt when the player was already classified locally
+classified_prompt = """
+The TYPE_OF_GAMER of this player is already known: {player_type}. Use it as the player_type, don't determine it again.
+Explain the selection of the parameters for the next levels.
+"""
+
 json_function = """
 [
 {
@@ -154,93 +425,165 @@ json_function = """
 """
 
 
-def log_all_data(user_id, level_compl_id, descriptions, response_json, start_time, data):
-    current_datetime = pd.to_datetime(datetime.now())
+def log_all_data(user_id, level_compl_id, descriptions, response_json, start_time, data, end_time=None,
+                 trace=None, levels_written=None, fallback=None, classification=None):
+    current_datetime = datetime.now()
     player_type = response_json.get('player_type', '')
     type_explanation = response_json.get('type_explanation', '')
     levels = json.dumps(response_json.get('levels', {}))
     differences = compare_all_levels(response_json.get('levels', {}))
-    execution_seconds = int(time.time() - start_time)
+    # Logs are written in the background, so the request's own end time is passed in
+    execution_seconds = int((end_time or time.time()) - start_time)
+    execution_ms = int(((end_time or time.time()) - start_time) * 1000)
+    # The level_params insert is part of the stage timings, so the row waits for it
+    if levels_written is not None:
+        levels_written.result()
     game_version = int(data["level"].get("gameVersion", 0))
 
-    data_dict = {
-        'date': [current_datetime],
-        'user_id': [user_id],
-        'level_compl_id': [level_compl_id],
-        'description': [descriptions],
-        'resp_player_type': [player_type],
-        'resp_type_explanation': [type_explanation],
-        'resp_type_levels': [levels],
-        'differences': [differences],
-        'execution_seconds': [execution_seconds],
-        'game_version': [game_version]
+    row = {
+        'date': current_datetime,
+        'user_id': user_id,
+        'level_compl_id': level_compl_id,
+        'description': descriptions,
+        'resp_player_type': player_type,
+        'resp_type_explanation': type_explanation,
+        'resp_type_levels': levels,
+        'differences': differences,
+        'execution_seconds': execution_seconds,
+        'game_version': game_version,
+        'execution_ms': execution_ms,
+        'stage_timings': trace.to_json() if trace else None,
+        # Set when random levels were served because generation missed the deadline or failed, and on the row
+        # of the late LLM levels
+        'generation_fallback': fallback,
+        # The classifier's type, kept apart from the LLM's so it is never trained on its own predictions
+        'classifier_player_type': classification['label'] if classification else None,
+        'player_type_source': ('classifier' if classification['player_type'] else 'llm') if classification else None,
+        'classifier_features': classification['features'] if classification else None,
+        # Set for LLM levels: whether the response was generated for another player with the same profile, it then
+        # has no type_explanation
+        'llm_cache_hit': classification.get('llm_cache_hit') if classification else None
     }
 
-    df_logs = pd.DataFrame(data_dict)
-    pandas_gbq.to_gbq(df_logs, "match3.logs", if_exists='append')
+    # A single row goes in like the player_data row, without building a DataFrame for it
+    errors = clients.bigquery_client().insert_rows(clients.get_table('match3.logs'), [row])
+    assert errors == []
     logging.info(f"{user_id} - {player_type} Writing logs ...")
 
 
-def level_to_bq(data, level_compl_id):
-    level = data["level"]
-
-    user_id = level["userId"]
-    current_level = int(level["currentLevel"])
-    level_passed = level["isLevelPassed"]
-    score = int(level["score"])
-    moves_left = int(level["movesLeft"])
-    num_failed_moves = int(level["numFailedMoves"])
-    date = datetime.strptime(level["dateSent"], '%Y-%m-%d %H:%M:%S')
-    device_model = level["deviceModel"]
-    timePlaying = float(level["timePlaying"])
-    num_clicks_on_board = level["numBoardClicksOverall"]
-    user_rating = level["userRating"]
-    world_serverd = level["worldServed"]
-    num_boosters_used = level["numBoostersUsed"]
-    game_version = int(level.get("gameVersion", 0))
-    function_version = int(os.environ.get('K_REVISION', 0))
-
-    # Instantiates a client
-    bigquery_client = bigquery.Client()
-
-    # Prepares a reference to the dataset
-    dataset_ref = bigquery_client.dataset('match3')
-
-    table_ref = dataset_ref.table('player_data')
-    table = bigquery_client.get_table(table_ref)  # API call
-
-    rows_to_insert = [
-        (user_id, current_level, level_passed, score, moves_left, num_failed_moves, date, device_model, timePlaying,
-         num_clicks_on_board, user_rating, world_serverd, level_compl_id, num_boosters_used, game_version,
-         function_version)
-    ]
-
-    errors = bigquery_client.insert_rows(table, rows_to_insert)  # API request
+def level_to_bq(completions):
+    # All completions go in with one insert, returns the user of the last one
+    rows_to_insert = []
+    new_completions = []
+    # Skill signals from the moves of all completions, computed before the moves are written away
+    with tracing.span('move_features'):
+        completion_move_features = move_features([data.get('moves') or [] for data in completions])
+    for data, features in zip(completions, completion_move_features):
+        level = data["level"]
+
+        user_id = level["userId"]
+        level_compl_id = level["levelGuid"]
+        current_level = int(level["currentLevel"])
+        level_passed = level["isLevelPassed"]
+        score = int(level["score"])
+        moves_left = int(level["movesLeft"])
+        num_failed_moves = int(level["numFailedMoves"])
+        date = datetime.strptime(level["dateSent"], '%Y-%m-%d %H:%M:%S')
+        device_model = level["deviceModel"]
+        timePlaying = float(level["timePlaying"])
+        num_clicks_on_board = level["numBoardClicksOverall"]
+        user_rating = level["userRating"]
+        world_serverd = level["worldServed"]
+        num_boosters_used = level["numBoostersUsed"]
+        game_version = int(level.get("gameVersion", 0))
+        function_version = int(os.environ.get('K_REVISION', 0))
+
+        rows_to_insert.append(
+            (user_id, current_level, level_passed, score, moves_left, num_failed_moves, date, device_model,
+             timePlaying, num_clicks_on_board, user_rating, world_serverd, level_compl_id, num_boosters_used,
+             game_version, function_version) + tuple(features[column] for column in MOVE_FEATURE_COLUMNS)
+        )
+        new_completions.append((user_id, {
+            'level_compl_id': level_compl_id,
+            'level_passed': level_passed,
+            'score': score,
+            'moves_left': moves_left,
+            'num_failed_moves': num_failed_moves,
+            'num_clicks_on_board': num_clicks_on_board,
+            'num_boosters_used': num_boosters_used,
+            'user_rating': user_rating,
+            **features
+        }))
+
+    # The client and the table (with its schema) are shared by the requests of a warm instance
+    bigquery_client = clients.bigquery_client()
+    table = clients.get_table('match3.player_data')  # API call only when the cached table has expired
+
+    # The history of a player whose levels are generated from it is (re)loaded when this instance may not have all
+    # of it, before the new completions are added. The first completion of a batch is the one played on the levels
+    # of the previous response.
+    player_data_counts = {}
+    for user_id, data in {data['level']['userId']: data for data in reversed(completions)}.items():
+        if data['level']['worldServed'] in HISTORY_STRATEGIES or feature_store.has_user(user_id):
+            with tracing.span('history_backfill'):
+                player_data_counts[user_id] = sync_user(feature_store, user_id, FEATURE_STORE_VERIFY,
+                                                        data['level']['levelGuid'])
+
+    with tracing.span('player_data_insert'):
+        errors = bigquery_client.insert_rows(table, rows_to_insert)  # API request
     assert errors == []
 
+    for user_id, completion in new_completions:
+        if user_id in player_data_counts:
+            row = feature_store.add_completion(user_id, completion)
+        elif cluster_stats_ready:
+            row = feature_store.completion_row(completion)
+        else:
+            continue
+        # Until the stats are backfilled the new completion is picked up by the backfill itself
+        if cluster_stats_ready:
+            cluster_stats.add(row)
+    for user_id, count in player_data_counts.items():
+        if count is not None:
+            feature_store.set_player_data_count(
+                user_id, count + sum(1 for completion_user_id, _ in new_completions if completion_user_id == user_id))
+
     return user_id
 
 
-def moves_to_bq(data, level_compl_id):
-    if not data['moves']:
+@tracing.traced('moves_insert')
+def moves_to_bq(completions):
+    completions = [data for data in completions if data.get('moves')]
+    if not completions:
         logging.warning("No data for moves, skipping.")
         return
 
-    df_moves = pd.DataFrame.from_records(data['moves'])
-    df_moves['moveNumber'] = df_moves['moveNumber'].astype('int64')
-    df_moves['durationInSeconds'] = df_moves['durationInSeconds'].astype('float')
-    df_moves['isMoveLegal'] = df_moves['isMoveLegal'].astype('bool')
-    df_moves['scoreForMove'] = df_moves['scoreForMove'].astype('int64')
-    df_moves['starsForMove'] = df_moves['starsForMove'].astype('int64')
-    df_moves['levelCompletitionId'] = level_compl_id
-    df_moves['createTime'] = pd.to_datetime(df_moves['createTime'], format='%Y-%m-%d %H:%M:%S')
+    if moves_stager:
+        for data in completions:
+            moves_stager.add(moves_to_record_batch(data['moves'], data['level']['levelGuid']))
+        return
 
-    pandas_gbq.to_gbq(df_moves, "match3.moves", if_exists='append')
+    # The moves of all completions go in with one load job from JSON rows, typed like the match3.moves columns,
+    # without pandas
+    from google.cloud import bigquery
+    rows = [{
+        'moveNumber': int(move['moveNumber']),
+        'createTime': move['createTime'],
+        'durationInSeconds': float(move['durationInSeconds']),
+        'isMoveLegal': bool(move['isMoveLegal']),
+        'scoreForMove': int(move['scoreForMove']),
+        'starsForMove': int(move['starsForMove']),
+        'swipeDirection': move.get('swipeDirection'),
+        'levelCompletitionId': data['level']['levelGuid']
+    } for data in completions for move in data['moves']]
+    job_config = bigquery.LoadJobConfig(schema=clients.get_table("match3.moves").schema,
+                                        write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+    clients.bigquery_client().load_table_from_json(rows, "match3.moves", job_config=job_config).result()
 
 
 def handle_collection_goals(collection_goals):
     if isinstance(collection_goals, list):
-        cleaned_goals = [int(goal) for goal in collection_goals if not np.isnan(goal)]
+        cleaned_goals = [int(goal) for goal in collection_goals if not math.isnan(goal)]
         return f"Collection goals were {cleaned_goals}."
     else:
         return ""
@@ -282,7 +625,15 @@ def generate_sentence_per_row_w_stats(row):
     return sentence
 
 
+@tracing.traced('descriptions')
 def generate_descriptions(df, use_stats):
+    if PROMPT_TOKEN_BUDGET:
+        describe_level = generate_sentence_per_row
+        if use_stats:
+            def describe_level(row):
+                return generate_sentence_per_row(row) if row['max_score'] == 0 \
+                    else generate_sentence_per_row_w_stats(row)
+        return build_descriptions(df, describe_level, PROMPT_RECENT_LEVELS, PROMPT_TOKEN_BUDGET, model=OPENAI_MODEL)
     if use_stats:
         df['description'] = df.apply(
             lambda row: generate_sentence_per_row(row) if row['max_score'] == 0
@@ -293,27 +644,116 @@ def generate_descriptions(df, use_stats):
 
 
 def get_stats_from_bigquery(_user_id, use_stats):
-    df = pandas_gbq.read_gbq(f"SELECT * FROM match3.player_levels('{_user_id}')")
+    with tracing.span('stats_query'):
+        if use_stats and CLUSTER_STATS_SOURCE == 'player_levels':
+            df = player_levels_df(_user_id)
+        else:
+            df = feature_store.history_df(_user_id)
+        if use_stats and CLUSTER_STATS_SOURCE == 'sketches':
+            import pandas as pd
+            ensure_cluster_stats()
+            # Only the levels described one by one need the stats of their cluster
+            described = df.tail(PROMPT_RECENT_LEVELS) if PROMPT_TOKEN_BUDGET else df
+            df_stats = pd.DataFrame([cluster_stats.describe(row) for row in described.to_dict('records')],
+                                    index=described.index, dtype=object)
+            df = pd.concat([df, df_stats], axis=1)
     return generate_descriptions(df, use_stats)
 
 
-def call_to_openai(data_on_the_player):
+def player_levels_df(user_id):
+    # The player's levels with the stats of their clusters, as match3.player_levels() computes them
+    import pandas as pd
+    rows = clients.query_rows("SELECT * FROM match3.player_levels(@user_id)", {'user_id': user_id})
+    if rows and 'level_in_row' in rows[0]:
+        rows.sort(key=lambda row: row['level_in_row'])
+    # object dtype keeps integers printing as integers, as in FeatureStore.history_df
+    columns = list(rows[0]) if rows else []
+    return pd.DataFrame(rows, columns=columns + [column for column in HISTORY_COLUMNS if column not in columns],
+                        dtype=object)
+
+
+def ensure_cluster_stats():
+    # Starts the backfill of the sketches once, without waiting for it: it reads all of player_data x level_params
+    global cluster_stats_backfill
+    with cluster_stats_lock:
+        if not cluster_stats_ready and cluster_stats_backfill is None:
+            cluster_stats_backfill = stages.defer(backfill_cluster_stats_once)
+
+
+def backfill_cluster_stats_once():
+    global cluster_stats_ready, cluster_stats_backfill
+    try:
+        backfill_cluster_stats(cluster_stats)
+        cluster_stats_ready = True
+    finally:
+        # A failed backfill is tried again on the next gpt-stats request
+        cluster_stats_backfill = None
+
+
+@tracing.traced('openai_call')
+def call_to_openai(data_on_the_player, on_level=None, player_type=None, variant=0):
+    import openai
+    openai.api_key = OPENAI_API_KEY
     functions = json.loads(json_function)
     _response = openai.ChatCompletion.create(
-        model="gpt-4-0613",
+        model=OPENAI_MODEL,
         temperature=0,
         messages=[
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": data_on_the_player + user_prompt}],
+            {"role": "user", "content": data_on_the_player + user_prompt +
+             (classified_prompt.format(player_type=player_type) if player_type else '') +
+             (variant_prompt.format(variant=variant + 1) if variant else '')}],
         functions=functions,
-        function_call={"name": "next_levels"}
+        function_call={"name": "next_levels"},
+        stream=on_level is not None
     )
-    response_json = json.loads(_response['choices'][0]['message']['function_call']['arguments'])
+    if on_level is None:
+        return json.loads(_response['choices'][0]['message']['function_call']['arguments'])
+
+    # Streamed: the arguments arrive in pieces, every level is handed to on_level as soon as it is complete
+    parser = LevelsStreamParser()
+    arguments = []
+    for chunk in _response:
+        piece = chunk['choices'][0]['delta'].get('function_call', {}).get('arguments')
+        if piece:
+            arguments.append(piece)
+            for level in parser.feed(piece):
+                on_level(level)
+    response_json = json.loads(''.join(arguments))
 
     return response_json
 
 
-def levels_to_bq(levels):
+def early_publisher(user_id):
+    # Returns the on_level callback for a streamed response, the list of levels it has published and a function
+    # that stops publishing. Levels are published in order, with their ids, and the bucket file always holds every
+    # level published so far.
+    published = []
+    num_seen = 0
+    stopped = False
+    lock = threading.Lock()
+
+    def on_level(level):
+        nonlocal num_seen
+        with lock:
+            # Only an unbroken run of valid levels from the first one is published
+            if not stopped and len(published) == num_seen and is_complete_level(level):
+                published.extend(add_uid_and_date([level]))
+                if ATTACH_STARTING_BOARDS:
+                    attach_starting_boards(published[-1:], starting_board_cache)
+                levels_to_bucket(user_id, published)
+                logging.info(f"{user_id} - Level {len(published)} published while streaming")
+            num_seen += 1
+
+    def stop():
+        nonlocal stopped
+        # Waits for an upload in progress, nothing is published after this returns
+        with lock:
+            stopped = True
+    return on_level, published, stop
+
+
+def add_uid_and_date(levels):
     for i in range(len(levels)):
         guid = "LUID-" + str(uuid.uuid4())
         dt = int(datetime.now().timestamp() * 1e6)
@@ -329,31 +769,93 @@ def levels_to_bq(levels):
             'created_time': dt,
             'collection_goals': levels[i]['collection_goals']
         }
+    return levels
+
 
-    df_levels = pd.DataFrame(levels)
-    pandas_gbq.to_gbq(df_levels, 'match3.level_params', if_exists='append')
-    return json.dumps(levels)
+@tracing.traced('level_params_insert')
+def level_params_to_bq(levels):
+    if not levels:
+        return
+    import pandas as pd
+    # Starting boards only go to the bucket, level_params keeps the level parameters
+    df_levels = pd.DataFrame(levels).drop(columns=['starting_board'], errors='ignore')
+    clients.pandas_gbq().to_gbq(df_levels, 'match3.level_params', if_exists='append')
 
 
-def levels_to_bucket(user_id, json_levels):
+def bucket(value, step):
+    if value is None:
+        return None
+    return int(value // step)
+
+
+# Fields of an LLM response about the player it was generated for, not cached for other players
+PLAYER_SPECIFIC_FIELDS = ['type_explanation']
+
+
+def player_profile(user_id, use_stats, player_type=None):
+    # Players whose latest levels fall into the same buckets get the same cached response
+    history = feature_store.history(user_id)
+    levels = []
+    for row in history[-PROFILE_LEVELS:]:
+        score_ratio = row['score'] / row['score_goal'] if row['score'] is not None and row['score_goal'] else None
+        moves_ratio = row['moves_left'] / row['num_moves'] if row['moves_left'] is not None and row['num_moves'] else None
+        levels.append((
+            bool(row['level_passed']),
+            bucket(score_ratio, 0.1),
+            bucket(moves_ratio, 0.1),
+            min(row['num_failed_moves'] or 0, 6) // 2,
+            bucket(row['num_clicks_on_board'], 10),
+            row['num_boosters_used'],
+            row['user_rating'],
+            row['num_different_pieces'],
+            row['board_width'],
+            row['board_height'],
+            bucket(row['num_moves'], 5),
+            bucket(row['score_goal'], 250),
+            len(row['collection_goals'] or [])
+        ))
+    # Longer histories make longer prompts, so the rough amount of levels played is part of the profile too
+    levels_played = len(history).bit_length()
+    # The type the LLM is told is part of the prompt
+    return hash_key(OPENAI_MODEL, system_prompt, user_prompt, json_function, use_stats, levels_played, levels,
+                    player_type)
+
+
+def cached_call_to_openai(user_id, descriptions, use_stats, on_level=None, player_type=None, variant=0):
+    # Returns the response and whether it was made for another player (a cache hit).
+    # Another set for data a set was already made for (see variant_prompt) is never the cached one
+    if variant:
+        return call_to_openai(descriptions, on_level, player_type, variant), False
+    # Responses are shared by players with the same profile, the text the LLM wrote about this player isn't:
+    # it is left out of what is cached (and of entries cached before it was)
+    generated = []
+
+    def generate():
+        generated.append(call_to_openai(descriptions, on_level, player_type))
+        return {key: value for key, value in generated[0].items() if key not in PLAYER_SPECIFIC_FIELDS}
+    response_json, is_hit = llm_cache.get_or_compute(player_profile(user_id, use_stats, player_type), generate)
+    logging.info(f"{user_id} - LLM cache {'hit' if is_hit else 'miss'}, {llm_cache.stats()}")
+    if generated:
+        return generated[0], False
+    return {key: value for key, value in response_json.items() if key not in PLAYER_SPECIFIC_FIELDS}, True
+
+
+@tracing.traced('bucket_upload')
+def levels_to_bucket(user_id, json_levels, if_generation_match=None):
+    # Returns the generation of the uploaded object, None if the upload failed. With if_generation_match the file
+    # is only replaced if it is still that generation. Levels given as a list get the level_uids of the file when
+    # it already held the same levels (see bucket_publisher.py).
     # Ensure json_levels is a Python object, not a string
     if isinstance(json_levels, str):
         json_levels = json.loads(json_levels)
 
-    client = storage.Client()
-    bucket = client.get_bucket('m3-levels')
-    blob = bucket.blob(f'{user_id}.json')
-    blob.cache_control = "public, max-age=0"
-    formatted_json_data = json.dumps(json_levels, indent=4)
-
     try:
-        blob.upload_from_string(
-            data=formatted_json_data,
-            content_type='application/json'
-        )
-        logging.info(f'https://storage.googleapis.com/m3-levels/{user_id}.json uploaded.')
+        generation = bucket_publisher.publish(user_id, json_levels, if_generation_match)
+        logging.info(f'https://storage.googleapis.com/m3-levels/{user_id}.json published, {bucket_publisher.stats()}')
+        return generation
     except Exception as e:
         logging.error(f"An error occurred while uploading to bucket: {e}")
+        return None
 
 
 def compare_all_levels(levels):
@@ -414,26 +916,10 @@ def compare_all_levels(levels):
     return all_sentences
 
 
-def generate_random_levels():
-    levels = []
-    for _ in range(NUM_LEVELS_TO_SUGGEST):
-        num_different_pieces = random.randint(*NUM_DIFFERENT_PIECES_RANGE)
-        num_different_goals = random.randint(NUM_DIFFERENT_GOALS[0], min(NUM_DIFFERENT_GOALS[1], num_different_pieces))
-        score_goal = random.choice([i for i in range(*SCORE_GOAL_RANGE) if i % 3 == 0])
-        num_moves = random.randint(*NUM_MOVES_RANGE)
-        board_width = random.randint(*BOARD_SIZE_RANGE)
-        board_height = random.randint(*BOARD_SIZE_RANGE)
-        collection_goals = [random.randint(*COLLECTION_GOALS_PIECES_RANGE) for _ in range(num_different_goals)]
-        levels.append({
-            "num_different_pieces": num_different_pieces,
-            "score_goal": score_goal,
-            "board_width": board_width,
-            "board_height": board_height,
-            "num_moves": num_moves,
-            "time_seconds": 0,
-            "collection_goals": collection_goals
-        })
-    return levels
+def generate_random_levels(seed=None):
+    return generate_random_level_batch(NUM_LEVELS_TO_SUGGEST, NUM_DIFFERENT_PIECES_RANGE, NUM_DIFFERENT_GOALS,
+                                       SCORE_GOAL_RANGE, NUM_MOVES_RANGE, BOARD_SIZE_RANGE,
+                                       COLLECTION_GOALS_PIECES_RANGE, seed=seed)
 
 
 def generate_response_for_random():
@@ -444,3 +930,12 @@ def generate_response_for_random():
         "levels": levels
     }
     return data
+
+
+if LEVEL_POOL_SIZE > 0:
+    if os.environ.get('LEVEL_POOL_PATH'):
+        level_pool_backend = SqlitePoolBackend(os.environ['LEVEL_POOL_PATH'])
+    else:
+        level_pool_backend = MemoryPoolBackend()
+    level_pool = LevelPool(level_pool_backend, generate_levels, LocalRefillQueue(), LEVEL_POOL_SIZE,
+                           LEVEL_POOL_MAX_AGE_SECONDS)
@@ -0,0 +1,213 @@
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Headless version of the client's board rules (Assets/Scripts/Board*.cs) to estimate how passable a level is.
+# Boards are int8 arrays of shape (num_boards, width, height), indexed [board, x, y] with y = 0 at the bottom
+# like the client, and EMPTY where there is no piece. Every step runs on all boards at once.
+#
+# Rules reproduced:
+#   BoardFiller.FillBoard - cells are filled column by column from the bottom, a piece is redrawn while it makes
+#     three in a row with the two pieces to its left or below it (at most 100 times)
+#   BoardMatcher - three or more equal pieces in a row or column match
+#   BoardClearer / GameManager.ScorePoints - a cleared piece scores 20 * multiplier, plus 20 when four or more
+#     pieces are cleared together; the multiplier grows by one with every cascade
+#   BoardCollapser - pieces fall down to fill the cleared cells, the board is refilled and cleared again while
+#     there are matches
+#   BoardDeadlock / BoardShuffler - when no swap makes a match, the pieces are shuffled
+#   LevelGoalCollected - a level is passed with a score of at least score_goal / 3 and all collection goals
+#     collected, the game ends when moves run out or all goals and the full score_goal are reached
+# Bombs, boosters and collectibles are not simulated (generated levels don't use collectibles).
+
+EMPTY = -1
+PIECE_SCORE = 20
+BIG_MATCH_BONUS = 20
+MAX_FILL_ITERATIONS = 100
+MAX_SHUFFLES = 20
+
+
+def find_matches(boards):
+    # Boolean mask of every piece that is part of three or more in a row or column
+    valid = boards != EMPTY
+    mask = np.zeros(boards.shape, dtype=bool)
+    horizontal = valid[:, :-2, :] & (boards[:, :-2, :] == boards[:, 1:-1, :]) & (boards[:, 1:-1, :] == boards[:, 2:, :])
+    mask[:, :-2, :] |= horizontal
+    mask[:, 1:-1, :] |= horizontal
+    mask[:, 2:, :] |= horizontal
+    vertical = valid[:, :, :-2] & (boards[:, :, :-2] == boards[:, :, 1:-1]) & (boards[:, :, 1:-1] == boards[:, :, 2:])
+    mask[:, :, :-2] |= vertical
+    mask[:, :, 1:-1] |= vertical
+    mask[:, :, 2:] |= vertical
+    return mask
+
+
+def swap_coordinates(width, height):
+    # Every pair of neighbouring cells, as arrays (xa, ya, xb, yb)
+    swaps = [(x, y, x + 1, y) for x in range(width - 1) for y in range(height)]
+    swaps += [(x, y, x, y + 1) for x in range(width) for y in range(height - 1)]
+    return tuple(np.array(column) for column in zip(*swaps))
+
+
+def apply_swaps(boards, swaps, choice):
+    # Swaps one pair of cells per board, choice indexes into swaps
+    xa, ya, xb, yb = (coordinate[choice] for coordinate in swaps)
+    n = np.arange(len(boards))
+    a = boards[n, xa, ya].copy()
+    boards[n, xa, ya] = boards[n, xb, yb]
+    boards[n, xb, yb] = a
+    return boards
+
+
+def match_counts_per_swap(boards, swaps):
+    # (num_boards, num_swaps) number of pieces each swap would match, 0 for illegal swaps
+    counts = np.zeros((len(boards), len(swaps[0])), dtype=np.int32)
+    for i in range(len(swaps[0])):
+        swapped = apply_swaps(boards.copy(), swaps, np.full(len(boards), i))
+        counts[:, i] = find_matches(swapped).sum(axis=(1, 2))
+    return counts
+
+
+def fill(boards, num_pieces, rng):
+    width, height = boards.shape[1:]
+    for x in range(width):
+        for y in range(height):
+            todo = boards[:, x, y] == EMPTY
+            for _ in range(MAX_FILL_ITERATIONS):
+                if not todo.any():
+                    break
+                boards[todo, x, y] = rng.integers(0, num_pieces, size=todo.sum())
+                piece = boards[:, x, y]
+                makes_match = np.zeros(len(boards), dtype=bool)
+                if x >= 2:
+                    makes_match |= (boards[:, x - 1, y] == piece) & (boards[:, x - 2, y] == piece)
+                if y >= 2:
+                    makes_match |= (boards[:, x, y - 1] == piece) & (boards[:, x, y - 2] == piece)
+                todo &= makes_match
+    return boards
+
+
+def collapse(boards):
+    # Stable sort of every column so the pieces keep their order and the empty cells end up on top
+    order = np.argsort(boards == EMPTY, axis=2, kind='stable')
+    return np.take_along_axis(boards, order, axis=2)
+
+
+def new_boards(num_boards, width, height, num_pieces, rng):
+    boards = np.full((num_boards, width, height), EMPTY, dtype=np.int8)
+    boards = fill(boards, num_pieces, rng)
+    return fix_deadlocks(boards, num_pieces, rng, swap_coordinates(width, height))
+
+
+def fix_deadlocks(boards, num_pieces, rng, swaps, active=None):
+    # Shuffles boards without a legal move until they have one and no ready-made matches
+    if active is None:
+        active = np.ones(len(boards), dtype=bool)
+    for _ in range(MAX_SHUFFLES):
+        stuck = active & ~(match_counts_per_swap(boards, swaps) > 0).any(axis=1)
+        stuck |= active & find_matches(boards).any(axis=(1, 2))
+        if not stuck.any():
+            return boards
+        shape = boards[stuck].shape
+        boards[stuck] = rng.permuted(boards[stuck].reshape(shape[0], -1), axis=1).reshape(shape)
+    # Very small boards may never get a move by shuffling, those get new pieces
+    stuck = active & ~(match_counts_per_swap(boards, swaps) > 0).any(axis=1)
+    if stuck.any():
+        boards[stuck] = EMPTY
+        boards[stuck] = fill(boards[stuck], num_pieces, rng)
+    return boards
+
+
+def resolve(boards, active, num_pieces, num_goals, rng):
+    # Clears matches, collapses and refills until the boards settle. Returns the score and the pieces
+    # collected per goal color for this move.
+    score = np.zeros(len(boards), dtype=np.int64)
+    collected = np.zeros((len(boards), num_goals), dtype=np.int64)
+    multiplier = 1
+    while True:
+        matches = find_matches(boards) & active[:, None, None]
+        cleared = matches.sum(axis=(1, 2))
+        if not cleared.any():
+            return boards, score, collected
+        bonus = np.where(cleared >= 4, BIG_MATCH_BONUS, 0)
+        score += cleared * (PIECE_SCORE * multiplier + bonus)
+        for color in range(num_goals):
+            # Goal i is collected with piece type i, like LevelGenerator pairs them
+            collected[:, color] += (matches & (boards == color)).sum(axis=(1, 2))
+        boards[matches] = EMPTY
+        boards = fill(collapse(boards), num_pieces, rng)
+        multiplier += 1
+
+
+def choose_moves(counts, policy, rng):
+    if policy == 'greedy':
+        # The swap that matches the most pieces, ties broken at random
+        noisy = counts + rng.random(counts.shape) * 0.5
+        noisy[counts == 0] = -1
+        return noisy.argmax(axis=1)
+    # Uniformly random legal swap
+    weights = (counts > 0) * rng.random(counts.shape)
+    return weights.argmax(axis=1)
+
+
+def simulate_level(level, playouts=500, policy='greedy', seed=None):
+    rng = np.random.default_rng(seed)
+    width, height = int(level['board_width']), int(level['board_height'])
+    num_pieces = int(level['num_different_pieces'])
+    goals = np.array(level.get('collection_goals') or [], dtype=np.int64)
+    score_goal = int(level['score_goal'])
+    swaps = swap_coordinates(width, height)
+
+    boards = new_boards(playouts, width, height, num_pieces, rng)
+    score = np.zeros(playouts, dtype=np.int64)
+    collected = np.zeros((playouts, len(goals)), dtype=np.int64)
+    moves_used = np.zeros(playouts, dtype=np.int64)
+    finished = np.zeros(playouts, dtype=bool)
+
+    for _ in range(int(level['num_moves'])):
+        active = ~finished
+        if not active.any():
+            break
+        counts = match_counts_per_swap(boards, swaps)
+        choice = choose_moves(counts, policy, rng)
+        moving = active & (counts > 0).any(axis=1)
+        boards[moving] = apply_swaps(boards[moving], swaps, choice[moving])
+        boards, move_score, move_collected = resolve(boards, active, num_pieces, len(goals), rng)
+        score += move_score
+        collected += move_collected
+        moves_used += active
+        boards = fix_deadlocks(boards, num_pieces, rng, swaps, active)
+        goals_complete = (collected >= goals).all(axis=1)
+        finished |= goals_complete & (score >= score_goal)
+
+    passed = (score >= score_goal // 3) & (collected >= goals).all(axis=1)
+    return {
+        'pass_rate': float(passed.mean()),
+        'avg_score': float(score.mean()),
+        'avg_moves_left': float((int(level['num_moves']) - moves_used)[passed].mean()) if passed.any() else 0.0,
+        'playouts': playouts
+    }
+
+
+def _simulate_job(args):
+    return simulate_level(*args)
+
+
+def estimate_pass_rates(levels, playouts=500, policy='greedy', seed=None, processes=None):
+    # Simulates every level in its own process, returns one result dict per level in the same order
+    seeds = np.random.SeedSequence(seed).spawn(len(levels))
+    jobs = [(level, playouts, policy, level_seed) for level, level_seed in zip(levels, seeds)]
+    if processes == 1:
+        return [_simulate_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_simulate_job, jobs))
+
+
+if __name__ == '__main__':
+    # python match3_sim.py levels.json [playouts] prints the pass rate estimate of every level in the file
+    with open(sys.argv[1]) as f:
+        levels_in_file = json.load(f)
+    results = estimate_pass_rates(levels_in_file, playouts=int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+    for level, result in zip(levels_in_file, results):
+        print(json.dumps({**level, 'estimated': result}))
@@ -0,0 +1,85 @@
+import numpy as np
+
+# Skill signals of a level completion from its moves, computed while the request still has them, so they are
+# stored with the completion (in match3.player_data and the feature store) and nothing needs to query match3.moves:
+#
+#   think_time_p50, think_time_p90  seconds spent on a move (median and 90th percentile)
+#   max_illegal_streak              longest run of illegal moves in a row
+#   score_per_move                  score gained per move made, illegal moves included
+#   direction_entropy               bits of entropy of the swipe directions of the legal moves (0: always the same
+#                                   direction, 2: all four equally often)
+#
+# The moves of all completions in a request are computed in one pass over flat arrays, with a group id per
+# completion, instead of a loop per completion. Completions without moves get None for every feature.
+
+MOVE_FEATURE_COLUMNS = ['think_time_p50', 'think_time_p90', 'max_illegal_streak', 'score_per_move',
+                        'direction_entropy']
+# swipeDirection as the game sends it ("none" for moves that aren't swipes, like boosters)
+SWIPE_DIRECTIONS = ['left', 'right', 'up', 'down']
+
+
+def _group_percentile(values, starts, counts, q):
+    # values are sorted within every group; linear interpolation like np.percentile
+    position = starts + q * (counts - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, starts + counts - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def move_features(moves_per_completion):
+    # Returns a dict of MOVE_FEATURE_COLUMNS per completion, in the order given
+    counts = np.array([len(moves) for moves in moves_per_completion], dtype=int)
+    features = [dict.fromkeys(MOVE_FEATURE_COLUMNS) for _ in moves_per_completion]
+    has_moves = np.flatnonzero(counts)
+    if not len(has_moves):
+        return features
+
+    moves = [move for moves in moves_per_completion for move in moves]
+    group = np.repeat(np.arange(len(has_moves)), counts[has_moves])
+    move_number = np.array([move.get('moveNumber') or 0 for move in moves], dtype=float)
+    duration = np.array([move.get('durationInSeconds') or 0 for move in moves], dtype=float)
+    legal = np.array([bool(move.get('isMoveLegal')) for move in moves])
+    score = np.array([move.get('scoreForMove') or 0 for move in moves], dtype=float)
+    direction = np.array([move.get('swipeDirection') or 'none' for move in moves])
+
+    # Moves in the order they were made within every completion
+    order = np.lexsort((move_number, group))
+    group, legal, score, direction = group[order], legal[order], score[order], direction[order]
+    group_counts = counts[has_moves]
+    starts = np.concatenate(([0], np.cumsum(group_counts)[:-1]))
+
+    # Think times sorted within every completion for the percentiles
+    duration = duration[order][np.lexsort((duration[order], group))]
+    p50 = _group_percentile(duration, starts, group_counts, 0.5)
+    p90 = _group_percentile(duration, starts, group_counts, 0.9)
+
+    # Running count of illegal moves, minus its value at the last legal move (or the completion's start)
+    illegal_count = np.cumsum(~legal)
+    reset = legal.copy()
+    reset[starts] = True
+    base = np.maximum.accumulate(np.where(reset, illegal_count - ~legal, 0))
+    max_streak = np.maximum.reduceat(illegal_count - base, starts)
+
+    score_per_move = np.add.reduceat(score, starts) / group_counts
+
+    direction_code = np.select([direction == name for name in SWIPE_DIRECTIONS],
+                               list(range(len(SWIPE_DIRECTIONS))), -1)
+    known = legal & (direction_code >= 0)
+    direction_counts = np.zeros((len(has_moves), len(SWIPE_DIRECTIONS)))
+    np.add.at(direction_counts, (group[known], direction_code[known]), 1)
+    totals = direction_counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = direction_counts / totals[:, None]
+        entropy = np.where(shares > 0, shares * np.log2(1 / shares), 0).sum(axis=1)
+
+    for i, completion in enumerate(has_moves):
+        features[completion] = {
+            'think_time_p50': round(float(p50[i]), 3),
+            'think_time_p90': round(float(p90[i]), 3),
+            'max_illegal_streak': int(max_streak[i]),
+            'score_per_move': round(float(score_per_move[i]), 2),
+            # No legal swipes, no direction to speak of
+            'direction_entropy': round(float(entropy[i]), 3) if totals[i] else None
+        }
+    return features
+
@@ -0,0 +1,230 @@
+import atexit
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import clients
+
+# Moves are collected as Arrow record batches, rolled over into Parquet files (in a local directory or under a
+# gs:// prefix) and loaded into match3.moves in bulk.
+#
+# The staging location is the list of pending files: every load lists it, so files an instance staged before it
+# was scaled down are loaded by the next instance that loads (at exit an instance only writes its batches out).
+# Files are loaded per time window of load_interval_seconds, once the window is over, with a job id derived from
+# the files. Instances that load the same window at the same time start the same job, BigQuery runs it once, and
+# a retry after a failure or crash uses the job id of the next attempt. Files are deleted once they are loaded.
+
+# Same columns and types as bq_tables/moves.json
+MOVES_SCHEMA = pa.schema([
+    ('moveNumber', pa.int64()),
+    ('createTime', pa.timestamp('s')),
+    ('durationInSeconds', pa.float64()),
+    ('isMoveLegal', pa.bool_()),
+    ('scoreForMove', pa.int64()),
+    ('starsForMove', pa.int64()),
+    ('swipeDirection', pa.string()),
+    ('levelCompletitionId', pa.string())
+])
+
+
+def moves_to_record_batch(moves, level_compl_id):
+    create_time = pa.array([move['createTime'] for move in moves], pa.string())
+    return pa.RecordBatch.from_arrays([
+        pa.array([move['moveNumber'] for move in moves], pa.int64()),
+        pc.strptime(create_time, format='%Y-%m-%d %H:%M:%S', unit='s'),
+        pa.array([move['durationInSeconds'] for move in moves], pa.float64()),
+        pa.array([move['isMoveLegal'] for move in moves], pa.bool_()),
+        pa.array([move['scoreForMove'] for move in moves], pa.int64()),
+        pa.array([move['starsForMove'] for move in moves], pa.int64()),
+        pa.array([move.get('swipeDirection') for move in moves], pa.string()),
+        pa.array([level_compl_id] * len(moves), pa.string())
+    ], schema=MOVES_SCHEMA)
+
+
+class ParquetStager:
+    # staging_uri is a local directory or gs://bucket/prefix
+    def __init__(self, staging_uri, table_name, schema, max_rows=5000, max_age_seconds=60,
+                 load_interval_seconds=300):
+        self.staging_uri = staging_uri.rstrip('/')
+        self.table_name = table_name
+        self.schema = schema
+        self.max_rows = max_rows
+        self.max_age_seconds = max_age_seconds
+        self.load_interval_seconds = load_interval_seconds
+        self._batches = []
+        self._rows = 0
+        self._first_batch_time = None
+        self._last_load_time = time.time()
+        self._lock = threading.Lock()
+        # Batches are taken under _lock, files are written and loaded under _io_lock on the worker thread
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.files_written = 0
+        self.load_jobs = 0
+        if not self.is_gcs:
+            os.makedirs(self.staging_uri, exist_ok=True)
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+        atexit.register(self.stage)
+
+    @property
+    def is_gcs(self):
+        return self.staging_uri.startswith('gs://')
+
+    def add(self, batch):
+        # Only appends, writing and loading the files happens on the worker thread
+        with self._lock:
+            if not self._batches:
+                self._first_batch_time = time.time()
+            self._batches.append(batch)
+            self._rows += batch.num_rows
+            if self._rows >= self.max_rows:
+                self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait(timeout=1)
+            self._wake.clear()
+            try:
+                self._flush_due()
+            except Exception as e:
+                logging.error(f"Staging for {self.table_name} failed: {e}")
+
+    def _take_batches(self, force):
+        with self._lock:
+            if not self._batches:
+                return []
+            if not force and self._rows < self.max_rows and \
+                    time.time() - self._first_batch_time < self.max_age_seconds:
+                return []
+            batches, self._batches = self._batches, []
+            self._rows = 0
+            self._first_batch_time = None
+            return batches
+
+    def _flush_due(self, force=False):
+        with self._io_lock:
+            self._roll_over(self._take_batches(force))
+            if force or time.time() - self._last_load_time >= self.load_interval_seconds:
+                self._load(force)
+
+    def stage(self):
+        # Writes the batches out without loading them, another instance (or a later load) picks the files up
+        with self._io_lock:
+            self._roll_over(self._take_batches(force=True))
+
+    def flush(self):
+        # Writes the batches out and loads every pending file, including the current window's
+        self._flush_due(force=True)
+
+    def _roll_over(self, batches):
+        if not batches:
+            return
+        table = pa.Table.from_batches(batches, schema=self.schema)
+        # The time in the name puts the file into its load window
+        name = f"{int(time.time())}-{uuid.uuid4().hex}.parquet"
+        if self.is_gcs:
+            bucket_name, prefix = self._bucket_and_prefix()
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer)
+            clients.storage_client().bucket(bucket_name).blob(prefix + name).upload_from_string(
+                buffer.getvalue(), content_type='application/octet-stream')
+        else:
+            # Written under another name first, so a listing never sees half a file
+            path = os.path.join(self.staging_uri, name)
+            pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        self.files_written += 1
+
+    def _bucket_and_prefix(self):
+        bucket_name, _, prefix = self.staging_uri[len('gs://'):].partition('/')
+        return bucket_name, f"{prefix}/" if prefix else ''
+
+    def pending_files(self):
+        # Every staged file not loaded yet, by any instance, oldest first
+        if self.is_gcs:
+            bucket_name, prefix = self._bucket_and_prefix()
+            names = [blob.name for blob in clients.storage_client().list_blobs(bucket_name, prefix=prefix)]
+            files = [f"gs://{bucket_name}/{name}" for name in names
+                     if name.endswith('.parquet') and '/' not in name[len(prefix):]]
+        else:
+            files = [os.path.join(self.staging_uri, name) for name in os.listdir(self.staging_uri)
+                     if name.endswith('.parquet')]
+        return sorted(files, key=lambda file: os.path.basename(file))
+
+    def _window(self, file):
+        return int(os.path.basename(file).split('-', 1)[0]) // self.load_interval_seconds
+
+    def _load(self, force=False):
+        self._last_load_time = time.time()
+        windows = {}
+        for file in self.pending_files():
+            windows.setdefault(self._window(file), []).append(file)
+        # A window is complete once it is over (and files uploaded at its end have arrived)
+        current = int(time.time() - self.max_age_seconds) // self.load_interval_seconds
+        for window, files in sorted(windows.items()):
+            if force or window < current:
+                self._load_files(files)
+
+    def job_id(self, files, attempt=0):
+        digest = hashlib.sha1('\n'.join(sorted(files)).encode('utf-8')).hexdigest()[:24]
+        return f"{self.table_name.replace('.', '_')}_staged_{digest}_{attempt}"
+
+    def _load_files(self, files, max_attempts=5):
+        from google.api_core.exceptions import Conflict
+        from google.cloud import bigquery
+        client = clients.bigquery_client()
+        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET,
+                                            write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        for attempt in range(max_attempts):
+            job_id = self.job_id(files, attempt)
+            try:
+                if self.is_gcs:
+                    job = client.load_table_from_uri(files, self.table_name, job_config=job_config, job_id=job_id)
+                else:
+                    # Local files are combined so they still go in with a single load job
+                    buffer = io.BytesIO()
+                    pq.write_table(pa.concat_tables([pq.read_table(path) for path in files]), buffer)
+                    buffer.seek(0)
+                    job = client.load_table_from_file(buffer, self.table_name, job_config=job_config,
+                                                      job_id=job_id)
+                job.result()
+            except Conflict:
+                # The job was started before, by this or another instance
+                job = client.get_job(job_id)
+                if job.state != 'DONE':
+                    logging.info(f"{len(files)} staged files are being loaded into {self.table_name} by {job_id}")
+                    return
+                if job.error_result:
+                    continue
+                logging.info(f"{len(files)} staged files were already loaded into {self.table_name} by {job_id}")
+            except Exception as e:
+                # The files stay, the next load tries again (with the next attempt's job id if this one failed)
+                logging.error(f"Loading {len(files)} staged files into {self.table_name} failed: {e}")
+                return
+            else:
+                self.load_jobs += 1
+                logging.info(f"Loaded {len(files)} staged files into {self.table_name}")
+            self._remove(files)
+            return
+        logging.error(f"Loading {len(files)} staged files into {self.table_name} failed {max_attempts} times, "
+                      f"they stay staged")
+
+    def _remove(self, files):
+        for file in files:
+            try:
+                if self.is_gcs:
+                    bucket_name, _, blob_name = file[len('gs://'):].partition('/')
+                    clients.storage_client().bucket(bucket_name).blob(blob_name).delete()
+                else:
+                    os.remove(file)
+            except Exception as e:
+                logging.warning(f"Could not remove staged file {file}: {e}")
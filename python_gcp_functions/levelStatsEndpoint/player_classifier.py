@@ -0,0 +1,277 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import random
+import re
+import sys
+
+import numpy as np
+
+# Local player type classifier, so the LLM doesn't have to work out the type of the player on every request.
+# A softmax (multinomial logistic) regression over features of the player's latest levels, taken from the rows of
+# their feature store history. main.py logs those features with every gpt request (the classifier_features column
+# of match3.logs), and the classifier is trained offline from an export of match3.logs:
+#
+#   python player_classifier.py logs_export.csv player_classifier.json [--holdout 0.2]
+#
+# and loaded once per instance with PlayerClassifier.load(path). classify() takes well under a millisecond.
+#
+# Only the types the LLM determined itself are trained on: rows where the LLM was told the classifier's type
+# (player_type_source 'classifier') would train the classifier on its own predictions. Rows logged before
+# classifier_features existed only have the descriptions, their features are parsed from the text.
+
+PLAYER_TYPES = ['not so skilled player', 'casual player', 'great player']
+# How many of the latest levels the features are averaged over
+RECENT_LEVELS = 5
+FEATURE_NAMES = ['score_ratio', 'passed', 'moves_left_ratio', 'num_failed_moves', 'num_clicks_on_board',
+                 'num_boosters_used', 'user_rating', 'num_different_pieces', 'board_area', 'collection_goals_total',
+                 'log_num_levels']
+FLAG_RANDOM = "Data was randomly generated"
+
+# Both description templates have these phrases, the ones with stats only add the cluster's numbers around them
+_NUMBER = r'(-?\d+(?:\.\d+)?|None|nan|NaN|<NA>)'
+_PATTERNS = {
+    'score': re.compile(r'the user scored ' + _NUMBER),
+    'score_goal': re.compile(_NUMBER + r' was the minimum to pass|the passing score was ' + _NUMBER),
+    'moves_left': re.compile(r'They had ' + _NUMBER + ' moves left'),
+    'num_moves': re.compile(r'moves left out of ' + _NUMBER + r'|allowed nuber of moves was ' + _NUMBER),
+    'num_failed_moves': re.compile(r'They made ' + _NUMBER + ' failed moves'),
+    'num_clicks_on_board': re.compile(r'They made ' + _NUMBER + ' clicks on the board'),
+    'num_boosters_used': re.compile(r'They used ' + _NUMBER + ' boosters'),
+    'user_rating': re.compile(r'rated the level as ' + _NUMBER + ' out of 5'),
+    'num_different_pieces': re.compile(r'contained ' + _NUMBER + ' different pieces'),
+    'board': re.compile(r'Board width x height was ' + _NUMBER + ' x ' + _NUMBER)
+}
+_COLLECTION_GOALS = re.compile(r'Collection goals were \[([^\]]*)\]')
+_SUMMARIZED_LEVELS = re.compile(r'For levels \S+ to \S+ \((\d+) levels\)')
+
+
+def _value(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def split_levels(descriptions):
+    # The description of every level, in order
+    return [sentence for sentence in re.split(r'(?=For level )', descriptions or '')
+            if sentence.startswith('For level ')]
+
+
+def parse_level(sentence):
+    # The numbers in the description of a level, nan where the description had None
+    level = {}
+    for name, pattern in _PATTERNS.items():
+        match = pattern.search(sentence)
+        groups = [group for group in match.groups() if group is not None] if match else []
+        if name == 'board':
+            level['board_width'], level['board_height'] = (_value(group) for group in groups) if groups \
+                else (math.nan, math.nan)
+        else:
+            level[name] = _value(groups[0]) if groups else math.nan
+    goals = _COLLECTION_GOALS.search(sentence)
+    level['collection_goals_total'] = sum(_value(goal) for goal in goals.group(1).split(',') if goal.strip()) \
+        if goals else math.nan
+    return level
+
+
+def description_features(descriptions):
+    # For rows logged without classifier_features. Only the recent levels are parsed, the rest are just counted,
+    # with the ones prompt_builder summarised
+    sentences = split_levels(descriptions)
+    num_summarized = sum(int(count) for count in _SUMMARIZED_LEVELS.findall(descriptions or ''))
+    return features([parse_level(sentence) for sentence in sentences[-RECENT_LEVELS:]],
+                    len(sentences) + num_summarized)
+
+
+LEVEL_FIELDS = ['score', 'score_goal', 'moves_left', 'num_moves', 'num_failed_moves', 'num_clicks_on_board',
+                'num_boosters_used', 'user_rating', 'num_different_pieces', 'board_width', 'board_height',
+                'collection_goals_total']
+
+
+def features(levels, num_levels=None):
+    # One row of FEATURE_NAMES for a player, nan where none of their recent levels had the value. num_levels is
+    # the length of the whole history when only the recent levels were parsed.
+    recent = levels[-RECENT_LEVELS:]
+    if not recent:
+        return np.full(len(FEATURE_NAMES), np.nan)
+    (score, score_goal, moves_left, num_moves, failed, clicks, boosters, rating, pieces, width, height,
+     goals) = np.array([[level[name] for name in LEVEL_FIELDS] for level in recent], dtype=float).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_level = np.array([score / score_goal, np.where(np.isnan(score + score_goal), np.nan, score >= score_goal),
+                              moves_left / num_moves, failed, clicks, boosters, rating, pieces, width * height, goals])
+        per_level[np.isinf(per_level)] = np.nan
+        # Mean over the levels that have the value
+        known = ~np.isnan(per_level)
+        row = np.where(known, per_level, 0).sum(axis=1) / known.sum(axis=1)
+    return np.append(row, math.log1p(num_levels if num_levels is not None else len(levels)))
+
+
+def history_features(history):
+    # The features of a player from their feature store rows (FeatureStore.history), oldest first
+    levels = []
+    for row in history[-RECENT_LEVELS:]:
+        level = {name: _value(row.get(name)) for name in LEVEL_FIELDS if name != 'collection_goals_total'}
+        goals = [goal for goal in row.get('collection_goals') or [] if goal is not None]
+        level['collection_goals_total'] = float(sum(goals)) if row.get('collection_goals') is not None else math.nan
+        levels.append(level)
+    return features(levels, len(history))
+
+
+def features_json(x):
+    # A row of FEATURE_NAMES as logged in classifier_features, null where it is nan
+    return json.dumps({name: None if math.isnan(value) else round(float(value), 4)
+                       for name, value in zip(FEATURE_NAMES, x)})
+
+
+def _softmax(z):
+    z = z - z.max(axis=1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class PlayerClassifier:
+    def __init__(self, labels, mean, std, weights, bias, info=None):
+        self.labels = list(labels)
+        self.mean = np.asarray(mean, dtype=float)
+        self.std = np.asarray(std, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.bias = np.asarray(bias, dtype=float)
+        self.info = info or {}
+
+    def _scaled(self, x):
+        # Missing values are imputed with the training mean, i.e. 0 once scaled
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        x = np.where(np.isnan(x), self.mean, x)
+        return (x - self.mean) / self.std
+
+    def probabilities(self, x):
+        return _softmax(self._scaled(x) @ self.weights + self.bias)
+
+    def classify(self, history):
+        # (player type, probability) from the player's feature store rows, or (None, 0.0) if there are none
+        if not history:
+            return None, 0.0
+        probabilities = self.probabilities(history_features(history))[0]
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    @classmethod
+    def fit(cls, x, y, labels=PLAYER_TYPES, l2=0.01, learning_rate=0.5, iterations=2000):
+        # Full batch gradient descent on the cross entropy, classes weighted by their inverse frequency
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=int)
+        mean = np.nanmean(x, axis=0)
+        mean = np.where(np.isnan(mean), 0.0, mean)
+        x = np.where(np.isnan(x), mean, x)
+        std = x.std(axis=0)
+        std = np.where(std > 0, std, 1.0)
+        x = (x - mean) / std
+
+        num_classes = len(labels)
+        targets = np.eye(num_classes)[y]
+        counts = np.bincount(y, minlength=num_classes)
+        sample_weights = (len(y) / (num_classes * np.maximum(counts, 1)))[y][:, None]
+        weights = np.zeros((x.shape[1], num_classes))
+        bias = np.zeros(num_classes)
+        for _ in range(iterations):
+            error = (_softmax(x @ weights + bias) - targets) * sample_weights / len(y)
+            weights -= learning_rate * (x.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return cls(labels, mean, std, weights, bias)
+
+    def accuracy(self, x, y):
+        return float((self.probabilities(x).argmax(axis=1) == np.asarray(y)).mean()) if len(y) else None
+
+    def to_json(self):
+        return json.dumps({'labels': self.labels, 'feature_names': FEATURE_NAMES, 'mean': self.mean.tolist(),
+                           'std': self.std.tolist(), 'weights': self.weights.tolist(), 'bias': self.bias.tolist(),
+                           'info': self.info})
+
+    @classmethod
+    def from_json(cls, data):
+        model = json.loads(data)
+        if model['feature_names'] != FEATURE_NAMES:
+            raise ValueError("The classifier was trained on different features, it needs to be retrained")
+        return cls(model['labels'], model['mean'], model['std'], model['weights'], model['bias'], model.get('info'))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_json(f.read())
+
+
+def logged_features(row):
+    # The features of a match3.logs row, None if there are none
+    if row.get('classifier_features'):
+        logged = json.loads(row['classifier_features'])
+        return np.array([_value(logged.get(name)) for name in FEATURE_NAMES])
+    description = row.get('description') or ''
+    if 'For level ' in description:
+        return description_features(description)
+    return None
+
+
+def read_logs_export(path):
+    # match3.logs exported as CSV or newline delimited JSON. Only rows the LLM labelled with a known type by itself
+    # are kept, as (features, label)
+    if path.endswith('.csv'):
+        csv.field_size_limit(sys.maxsize)
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    examples = []
+    for row in rows:
+        label = (row.get('resp_player_type') or '').strip().lower()
+        if label not in PLAYER_TYPES or row.get('player_type_source') == 'classifier' or \
+                row.get('description') == FLAG_RANDOM:
+            continue
+        x = logged_features(row)
+        if x is not None:
+            examples.append((x, PLAYER_TYPES.index(label)))
+    return examples
+
+
+def train(examples, holdout=0.2, seed=0):
+    examples = list(examples)
+    random.Random(seed).shuffle(examples)
+    x = np.array([features for features, _ in examples], dtype=float)
+    y = np.array([label for _, label in examples], dtype=int)
+    num_test = int(len(examples) * holdout)
+    model = PlayerClassifier.fit(x[num_test:], y[num_test:])
+    test_accuracy = model.accuracy(x[:num_test], y[:num_test]) if num_test else None
+    # The saved model is refitted on every row
+    if num_test:
+        model = PlayerClassifier.fit(x, y)
+    model.info = {'rows': len(examples), 'class_counts': np.bincount(y, minlength=len(PLAYER_TYPES)).tolist(),
+                  'train_accuracy': model.accuracy(x, y), 'holdout_accuracy': test_accuracy}
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the player type classifier from a match3.logs export")
+    parser.add_argument('logs', help="match3.logs exported as .csv or newline delimited .json")
+    parser.add_argument('output', help="where to write the model (JSON)")
+    parser.add_argument('--holdout', type=float, default=0.2, help="share of rows to measure the accuracy on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    examples = read_logs_export(args.logs)
+    if not examples:
+        sys.exit(f"No labelled rows in {args.logs}")
+    model = train(examples, args.holdout)
+    model.save(args.output)
+    logging.info(f"Saved {args.output}: {json.dumps(model.info)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import logging
+import math
+
+import numpy as np
+
+# Keeps the player's data in the prompt within a token budget, however many levels they have played. The latest
+# levels are described one sentence per level as before, older ones are summarised per block of levels:
+#
+#   For levels 1 to 20 (20 levels) the user passed 14 and scored 104% of the minimum to pass on average. ...
+#
+# Blocks get larger (and then the verbatim window smaller) until the descriptions fit token_budget. Tokens are
+# counted with tiktoken if it is installed, otherwise estimated from the length of the text.
+# benchmarks/prompt_size.py measures prompt size and build time against the length of the history.
+
+CHARS_PER_TOKEN = 3  # Descriptions are mostly numbers, which take more tokens than English text
+SUMMARY_COLUMNS = ['level_in_row', 'level_passed', 'moves_left', 'num_moves', 'num_failed_moves',
+                   'num_clicks_on_board', 'num_boosters_used', 'user_rating', 'num_different_pieces', 'board_width',
+                   'board_height']
+_encodings = {}
+
+
+def count_tokens(text, model=None):
+    if model not in _encodings:
+        try:
+            import tiktoken
+            _encodings[model] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            # tiktoken is optional, and may not know the model
+            _encodings[model] = None
+    encoding = _encodings[model]
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def _column(df, name):
+    if name not in df:
+        return np.full(len(df), np.nan)
+    values = df[name].to_numpy()
+    if values.dtype == object:
+        values = np.where(np.equal(values, None), np.nan, values)
+    return values.astype(float)
+
+
+def summary_columns(df):
+    # The columns of generate_sentence_per_row the summaries are made of, as float arrays (nan if missing)
+    score, score_goal = _column(df, 'score'), _column(df, 'score_goal')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score_percent = np.where(score_goal > 0, 100 * score / score_goal, np.nan)
+    columns = {name: _column(df, name) for name in SUMMARY_COLUMNS}
+    columns['score_percent'] = score_percent
+    return columns
+
+
+def _block_means(values, starts):
+    known = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(known, values, 0), starts)
+    counts = np.add.reduceat(known.astype(int), starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts, sums, counts
+
+
+def _number(value, digits=1):
+    if np.isnan(value):
+        return None
+    value = round(float(value), digits)
+    return int(value) if value.is_integer() else value
+
+
+def summarize(columns, block_size):
+    # One line per block of block_size levels
+    num_levels = len(columns['level_in_row'])
+    if not num_levels:
+        return []
+    starts = np.arange(0, num_levels, block_size)
+    ends = np.minimum(starts + block_size, num_levels)
+    means = {name: _block_means(values, starts)[0] for name, values in columns.items()}
+    passed = _block_means(columns['level_passed'], starts)[1]
+    boosters = _block_means(columns['num_boosters_used'], starts)[1]
+    level_in_row = columns['level_in_row']
+    lines = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        first = int(level_in_row[start]) if not np.isnan(level_in_row[start]) else start + 1
+        last = int(level_in_row[end - 1]) if not np.isnan(level_in_row[end - 1]) else end
+
+        def mean(name, digits=1):
+            return _number(means[name][i], digits)
+        lines.append(
+            f"For levels {first} to {last} ({end - start} levels) the user passed {int(passed[i])} and scored "
+            f"{mean('score_percent', 0)}% of the minimum to pass on average. "
+            f"They had {mean('moves_left')} moves left out of {mean('num_moves')} on average. "
+            f"They made {mean('num_failed_moves')} failed moves and "
+            f"{mean('num_clicks_on_board')} clicks on the board on average. "
+            f"They used {int(boosters[i])} boosters in total. "
+            f"Player rated the levels as {mean('user_rating')} out of 5 on average. "
+            f"The levels contained {mean('num_different_pieces')} different pieces and "
+            f"boards of {mean('board_width')} x {mean('board_height')} on average.")
+    return lines
+
+
+def build_descriptions(df, describe_level, recent_levels, token_budget, block_size=20, model=None):
+    # describe_level(row) is called for the recent levels only
+    num_recent = min(recent_levels, len(df))
+    recent = [describe_level(row) for _, row in df.iloc[len(df) - num_recent:].iterrows()] if num_recent else []
+    columns = summary_columns(df)
+    while True:
+        num_older = len(df) - num_recent
+        older = {name: values[:num_older] for name, values in columns.items()}
+        recent_text = '\n'.join(recent[len(recent) - num_recent:])
+        remaining_tokens = token_budget - count_tokens(recent_text, model)
+        size = block_size
+        if num_older:
+            # Blocks about large enough to fit the remaining tokens right away, judging by the first line
+            line_tokens = count_tokens(summarize({name: values[:size] for name, values in older.items()}, size)[0],
+                                       model)
+            max_lines = max(1, remaining_tokens // (line_tokens + 1))
+            size = max(size, math.ceil(num_older / max_lines))
+        summary = summarize(older, size)
+        while len(summary) > 1 and count_tokens('\n'.join(summary), model) > remaining_tokens:
+            size *= 2
+            summary = summarize(older, size)
+        descriptions = '\n'.join(summary + recent[len(recent) - num_recent:])
+        if num_recent <= 1 or count_tokens(descriptions, model) <= token_budget:
+            break
+        num_recent -= 1
+    if count_tokens(descriptions, model) > token_budget:
+        logging.warning(f"Descriptions of {len(df)} levels don't fit {token_budget} tokens")
+    return descriptions
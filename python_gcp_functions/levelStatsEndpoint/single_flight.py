@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+# Single flight per key: the first request for a key runs, concurrent duplicates wait for its result and later
+# retries get the stored result until it expires. A claim is a lease, so a key whose owner died is taken over once
+# the lease runs out; a failed run releases the key and the next duplicate runs again.
+#
+# The store decides who runs. MemoryFlightStore works within one instance, SqliteFlightStore stands in for a store
+# shared by the instances (the same claim / complete / release over one SQLite file).
+
+CLAIMED = 'claimed'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class MemoryFlightStore:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key, owner, lease_seconds, now=None):
+        # Returns (CLAIMED, None), (RUNNING, None) or (DONE, result)
+        now = now or time.time()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight['expires_at'] > now:
+                return (DONE, json.loads(flight['result'])) if flight['state'] == DONE else (RUNNING, None)
+            self._flights[key] = {'state': RUNNING, 'owner': owner, 'result': None, 'expires_at': now + lease_seconds}
+            self._expire(now)
+            return CLAIMED, None
+
+    def complete(self, key, owner, result, ttl_seconds):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight['owner'] == owner:
+                self._flights[key] = {'state': DONE, 'owner': owner, 'result': json.dumps(result),
+                                      'expires_at': time.time() + ttl_seconds}
+
+    def release(self, key, owner):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight['owner'] == owner and flight['state'] == RUNNING:
+                del self._flights[key]
+
+    def _expire(self, now):
+        for key in [key for key, flight in self._flights.items() if flight['expires_at'] <= now]:
+            del self._flights[key]
+
+
+class SqliteFlightStore:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, state TEXT, owner TEXT, "
+                         "result TEXT, expires_at REAL)")
+
+    def _connect(self):
+        # Claims from other processes wait for the write lock instead of failing
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def claim(self, key, owner, lease_seconds, now=None):
+        now = now or time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            found = conn.execute("SELECT state, result FROM flights WHERE key = ? AND expires_at > ?",
+                                 (key, now)).fetchone()
+            if found is None:
+                conn.execute("DELETE FROM flights WHERE expires_at <= ?", (now,))
+                conn.execute("INSERT OR REPLACE INTO flights VALUES (?, ?, ?, NULL, ?)",
+                             (key, RUNNING, owner, now + lease_seconds))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if found is None:
+            return CLAIMED, None
+        return (DONE, json.loads(found[1])) if found[0] == DONE else (RUNNING, None)
+
+    def complete(self, key, owner, result, ttl_seconds):
+        with self._connect() as conn:
+            conn.execute("UPDATE flights SET state = ?, result = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                         (DONE, json.dumps(result), time.time() + ttl_seconds, key, owner))
+
+    def release(self, key, owner):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM flights WHERE key = ? AND owner = ? AND state = ?", (key, owner, RUNNING))
+
+
+class SingleFlight:
+    def __init__(self, store, ttl_seconds=3600, lease_seconds=300, poll_seconds=0.05):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        # Waiters in this instance are woken as soon as the run here finishes, others poll the store
+        self._done = {}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.waited = 0
+        self.replayed = 0
+
+    def run(self, key, fn):
+        # Returns fn()'s result (which must be JSON serialisable) and whether this call ran it, waited for it or
+        # got it from an earlier run: 'ran', 'waited' or 'replayed'
+        owner = uuid.uuid4().hex
+        waited = False
+        while True:
+            state, result = self.store.claim(key, owner, self.lease_seconds)
+            if state == DONE:
+                with self._lock:
+                    if waited:
+                        self.waited += 1
+                    else:
+                        self.replayed += 1
+                return result, 'waited' if waited else 'replayed'
+            if state == CLAIMED:
+                break
+            waited = True
+            with self._lock:
+                done = self._done.setdefault(key, threading.Event())
+            done.wait(self.poll_seconds)
+
+        with self._lock:
+            self.runs += 1
+            done = self._done.setdefault(key, threading.Event())
+        try:
+            result = fn()
+            self.store.complete(key, owner, result, self.ttl_seconds)
+        except Exception:
+            self.store.release(key, owner)
+            raise
+        finally:
+            with self._lock:
+                self._done.pop(key, None)
+            done.set()
+        return result, 'ran'
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs, 'waited': self.waited, 'replayed': self.replayed}
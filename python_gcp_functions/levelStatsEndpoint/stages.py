@@ -0,0 +1,54 @@
+import atexit
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Stages of a request that don't depend on each other run on this pool at the same time
+STAGE_WORKERS = int(os.environ.get('STAGE_WORKERS', 4))
+# Level generation has a pool of its own: generations that miss their deadline keep running, and on the stage pool
+# they would hold up the stages of later requests
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', 8))
+# Writes the response doesn't need are queued here and done while (or after) the response is sent.
+# Note that an idle instance may get little CPU, so queued writes can finish during the next request.
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 2))
+BACKGROUND_DRAIN_SECONDS = 60
+
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='stage')
+_generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix='generation')
+_background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='background')
+_pending = set()
+
+
+def run_stage(fn, *args, **kwargs):
+    # Starts a stage and returns a future; call .result() where the output (or its errors) are needed.
+    # The stage runs in a copy of the request's context, so it adds its spans to the request's trace.
+    return _stage_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def run_generation(fn, *args, **kwargs):
+    # Like run_stage, on the level generation pool. Time spent waiting for a worker counts towards the deadline.
+    return _generation_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def defer(fn, *args, **kwargs):
+    # Queues a write that the response doesn't depend on. Errors are logged, not raised.
+    def _run():
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Background task {fn.__name__} failed: {e}")
+
+    future = _background_executor.submit(contextvars.copy_context().run, _run)
+    _pending.add(future)
+    future.add_done_callback(_pending.discard)
+    return future
+
+
+def drain_background(timeout=BACKGROUND_DRAIN_SECONDS):
+    # Waits for the queued writes, e.g. before the instance shuts down
+    if _pending:
+        wait(list(_pending), timeout=timeout)
+
+
+atexit.register(drain_background)
@@ -0,0 +1,59 @@
+import base64
+import threading
+
+import numpy as np
+
+from match3_sim import new_boards
+
+# Starting boards generated on the server with the client's fill and deadlock rules (see match3_sim), so the
+# client can place them as they are instead of running its fill / shuffle loop at level load.
+#
+# Encoding: the board's cells in the client's [x, y] order (x major, y = 0 at the bottom), one piece index per
+# 4 bits, two cells per byte with the first cell in the high bits, padded with 0xF, then base64.
+
+BOARDS_PER_BATCH = 256
+
+
+def encode_board(board):
+    cells = board.astype(np.uint8).reshape(-1)
+    if len(cells) % 2:
+        cells = np.append(cells, 0x0F)
+    packed = (cells[0::2] << 4) | cells[1::2]
+    return base64.b64encode(packed.astype(np.uint8).tobytes()).decode('ascii')
+
+
+def decode_board(encoded, width, height):
+    packed = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8)
+    cells = np.empty(len(packed) * 2, dtype=np.int8)
+    cells[0::2] = packed >> 4
+    cells[1::2] = packed & 0x0F
+    return cells[:width * height].reshape(width, height)
+
+
+class StartingBoardCache:
+    # Boards are generated in batches per (width, height, num_different_pieces) and handed out one at a time
+    def __init__(self, batch_size=BOARDS_PER_BATCH, seed=None):
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def take(self, width, height, num_pieces):
+        key = (width, height, num_pieces)
+        with self._lock:
+            boards = self._boards.get(key)
+            if not boards:
+                boards = [encode_board(board) for board in
+                          new_boards(self.batch_size, width, height, num_pieces, self.rng)]
+                self._boards[key] = boards
+            return boards.pop()
+
+
+def attach_starting_boards(levels, cache):
+    # Levels that already have a board (e.g. ones published while streaming) keep it
+    for level in levels:
+        if level.get('starting_board'):
+            continue
+        level['starting_board'] = cache.take(int(level['board_width']), int(level['board_height']),
+                                             int(level['num_different_pieces']))
+    return levels
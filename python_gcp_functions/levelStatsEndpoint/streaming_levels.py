@@ -0,0 +1,74 @@
+import json
+
+# Incremental parser for the arguments of the next_levels function call while they are streamed in. It scans
+# every character once and returns each object of the top level "levels" array as soon as its closing brace has
+# arrived, so the first level can be served before the rest of the response (and type_explanation) is generated.
+
+LEVEL_KEYS = ['num_different_pieces', 'score_goal', 'board_width', 'board_height', 'num_moves', 'collection_goals']
+
+
+class LevelsStreamParser:
+    def __init__(self):
+        self.data = ''
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.expect_key = False
+        self.string_start = None
+        self.last_key = None
+        # Depth of the levels array once it has started, and where the current level object started
+        self.levels_depth = None
+        self.level_start = None
+        self.levels_done = False
+        self.num_levels = 0
+
+    def feed(self, text):
+        # Returns the levels completed by this piece of text
+        completed = []
+        self.data += text
+        data = self.data
+        for i in range(self.position, len(data)):
+            char = data[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect_key:
+                        self.last_key = json.loads(data[self.string_start:i + 1])
+                continue
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char in '{[':
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = True
+                elif char == '[' and self.depth == 2 and self.last_key == 'levels' and not self.levels_done:
+                    self.levels_depth = 2
+                elif char == '{' and self.levels_depth is not None and self.depth == self.levels_depth + 1:
+                    self.level_start = i
+            elif char in '}]':
+                if char == '}' and self.level_start is not None and self.depth == self.levels_depth + 1:
+                    completed.append(json.loads(data[self.level_start:i + 1]))
+                    self.level_start = None
+                    self.num_levels += 1
+                elif char == ']' and self.levels_depth is not None and self.depth == self.levels_depth:
+                    self.levels_depth = None
+                    self.levels_done = True
+                self.depth -= 1
+            elif self.depth == 1:
+                if char == ',':
+                    self.expect_key = True
+                elif char == ':':
+                    self.expect_key = False
+        self.position = len(data)
+        return completed
+
+
+def is_complete_level(level):
+    # A level can be served once it has every parameter the client needs
+    return isinstance(level, dict) and all(level.get(key) is not None for key in LEVEL_KEYS)
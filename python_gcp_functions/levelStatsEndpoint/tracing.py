@@ -0,0 +1,195 @@
+import atexit
+import bisect
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Timings of the stages of a request. A Trace is started per request and spans add their time to it:
+#
+#   with tracing.span('bucket_upload'):          or          @tracing.traced('openai_call')
+#       ...                                                  def call_to_openai(...):
+#
+# The request handler is decorated with @tracing.traced_request. The current trace is kept in a context variable
+# (stages.py runs stages in the request's context), so spans don't need the trace passed around. Every span also
+# goes into a histogram per stage name for the whole instance, see histogram_snapshot().
+#
+# With TRACE_PROFILE_SAMPLE_RATE > 0 that share of requests runs under cProfile (one request at a time, on the
+# request's own thread) and the profile of the ones slower than TRACE_PROFILE_SLOW_MS is logged.
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('TRACE_PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.environ.get('TRACE_PROFILE_SLOW_MS', 5000))
+PROFILE_LINES = 25
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000]
+
+_current = contextvars.ContextVar('trace', default=None)
+_histograms = {}
+_histograms_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+
+class Histogram:
+    # Counts per bucket of HISTOGRAM_BOUNDS_MS, quantiles are the upper bound of the bucket they fall in
+    # (or the largest value seen, if that is lower)
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, ms):
+        with self._lock:
+            self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, ms)] += 1
+            self.count += 1
+            self.sum_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = HISTOGRAM_BOUNDS_MS[i] if i < len(HISTOGRAM_BOUNDS_MS) else self.max_ms
+                return round(min(bound, self.max_ms), 1)
+        return round(self.max_ms, 1)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.sum_ms / self.count, 1) if self.count else None,
+            'p50_ms': self.quantile(0.50),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': round(self.max_ms, 1)
+        }
+
+
+def histogram(name):
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        return _histograms[name]
+
+
+def histogram_snapshot():
+    with _histograms_lock:
+        names = list(_histograms)
+    return {name: histogram(name).snapshot() for name in names}
+
+
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.timings = {}
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def add(self, name, ms):
+        # A stage that runs more than once per request adds up
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + ms
+        histogram(name).add(ms)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def total_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def timings_ms(self):
+        with self._lock:
+            return {name: round(ms, 1) for name, ms in self.timings.items()}
+
+    def to_json(self):
+        return json.dumps(self.timings_ms())
+
+
+def start_trace():
+    trace = Trace()
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+        trace.profiler = cProfile.Profile()
+        trace.profiler.enable()
+    return trace
+
+
+def current_trace():
+    return _current.get()
+
+
+def finish_trace(trace, label=''):
+    # Ends the request's part of the trace; spans of deferred writes may still be added afterwards
+    if trace.end is not None:
+        return trace.total_ms()
+    trace.end = time.perf_counter()
+    total_ms = trace.total_ms()
+    histogram('request').add(total_ms)
+    if trace.profiler:
+        trace.profiler.disable()
+        _profile_lock.release()
+        if total_ms >= PROFILE_SLOW_MS:
+            out = io.StringIO()
+            pstats.Stats(trace.profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            logging.warning(f"{label} - Slow request ({total_ms:.0f} ms), stages {trace.to_json()}\n{out.getvalue()}")
+        trace.profiler = None
+    return total_ms
+
+
+@contextmanager
+def span(name):
+    trace = _current.get()
+    if trace is None:
+        # Outside of a request the time still goes into the histogram
+        start = time.perf_counter()
+        try:
+            yield None
+        finally:
+            histogram(name).add((time.perf_counter() - start) * 1000)
+    else:
+        with trace.span(name):
+            yield trace
+
+
+def traced_request(fn):
+    # Runs a request handler in its own trace (available as current_trace()). The handler may finish the trace
+    # itself before queueing its deferred writes, otherwise it is finished when the handler returns or fails.
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = start_trace()
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            finish_trace(trace)
+            _current.reset(token)
+    return wrapper
+
+
+def traced(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+atexit.register(lambda: logging.info(f"Stage histograms: {json.dumps(histogram_snapshot())}"))
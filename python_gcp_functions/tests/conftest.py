@@ -0,0 +1,25 @@
+import os
+import sys
+
+# The functions import their modules flat from their own folder (each folder is deployed on its own), tests do the
+# same with endpoint_path. The SDKs are replaced by the fakes the benchmarks use, and request bodies come from the
+# benchmarks' payloads module.
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [os.path.join(FUNCTIONS_DIR, 'benchmarks', 'fakes'), os.path.join(FUNCTIONS_DIR, 'benchmarks')]
+
+
+ENDPOINTS = ['levelStatsEndpoint', 'analyticsEndpoint', 'genDefaultLevelsEndpoint']
+
+
+def endpoint_path(endpoint):
+    # The endpoints have modules of the same name (main, clients, ...): the endpoint goes first on sys.path and the
+    # modules imported from the other endpoints are forgotten, test modules already holding them keep them
+    path = os.path.join(FUNCTIONS_DIR, endpoint)
+    others = [os.path.join(FUNCTIONS_DIR, other) + os.sep for other in ENDPOINTS if other != endpoint]
+    for name, module in list(sys.modules.items()):
+        if any((getattr(module, '__file__', None) or '').startswith(other) for other in others):
+            del sys.modules[name]
+    if path in sys.path:
+        sys.path.remove(path)
+    sys.path.insert(0, path)
@@ -0,0 +1,97 @@
+import gzip
+import json
+import uuid
+
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import main  # noqa: E402
+import pandas_gbq  # noqa: E402
+import payloads  # noqa: E402
+import stages  # noqa: E402
+from bucket_publisher import BucketPublisher  # noqa: E402
+from google.cloud import storage  # noqa: E402
+
+
+def levels(num_moves=20, starting_board=None):
+    # A set as process_completion publishes it: new level_uids, created_time and boards every time
+    return [{'level_uid': f'LUID-{uuid.uuid4()}', 'num_different_pieces': 4, 'score_goal': 1000 + 100 * i,
+             'board_width': 7, 'board_height': 8, 'num_moves': num_moves, 'time_seconds': 0,
+             'created_time': uuid.uuid4().int % 10 ** 15, 'collection_goals': [10, 5],
+             'starting_board': starting_board or [uuid.uuid4().int % 4 for _ in range(56)]} for i in range(3)]
+
+
+def test_same_levels_with_new_uids_are_not_uploaded_again():
+    storage.objects.clear()
+    publisher = BucketPublisher('m3-levels')
+    generation = publisher.publish('user-1', levels())
+    assert publisher.publish('user-1', levels()) == generation
+    assert publisher.stats()['uploads'] == 1
+    assert publisher.stats()['skipped'] == 1
+
+    assert publisher.publish('user-1', levels(num_moves=25)) != generation
+    assert publisher.publish('user-2', levels()) is not None
+    assert publisher.stats()['uploads'] == 3
+
+
+def bucket_uids(name):
+    body = storage.objects[('m3-levels', f'{name}.json')]
+    return [level['level_uid'] for level in json.loads(gzip.decompress(body))]
+
+
+def test_skipped_levels_get_the_uids_in_the_bucket():
+    storage.objects.clear()
+    publisher = BucketPublisher('m3-levels')
+    first = levels()
+    publisher.publish('user-1', first)
+    second = levels()
+    publisher.publish('user-1', second)
+    assert [level['level_uid'] for level in second] == bucket_uids('user-1') == \
+        [level['level_uid'] for level in first]
+    assert [level['starting_board'] for level in second] == [level['starting_board'] for level in first]
+
+
+def test_served_uids_are_the_ones_in_the_bucket(monkeypatch):
+    storage.objects.clear()
+    main.bucket_publisher.forget('user-skip')
+    # Random sets with the same parameters, as a cached LLM response gives
+    same_levels = [{key: level[key] for key in ['num_different_pieces', 'score_goal', 'board_width', 'board_height',
+                                                'num_moves', 'collection_goals']} for level in levels()]
+    monkeypatch.setattr(main, 'generate_random_levels', lambda: [dict(level) for level in same_levels])
+    served = []
+    for _ in range(2):
+        body = payloads.level_stats_payload(user_id='user-skip', strategy='random')
+        response_json = main.main(payloads.FakeRequest(body))
+        served.append([level['level_uid'] for level in response_json['levels']])
+        assert served[-1] == bucket_uids('user-skip')
+    assert served[0] == served[1]
+    assert main.feature_store.level_params(served[1][0])['score_goal'] == same_levels[0]['score_goal']
+    # The levels of the file are recorded in match3.level_params once
+    stages.drain_background()
+    recorded = [uid for df in pandas_gbq.written['match3.level_params'] for uid in df['level_uid']]
+    assert sorted(uid for uid in recorded if uid in served[0]) == sorted(served[0])
+
+
+def test_a_stale_generation_is_uploaded():
+    storage.objects.clear()
+    publisher = BucketPublisher('m3-levels')
+    generation = publisher.publish('user-1', levels())
+    publisher.publish('user-1', levels(num_moves=25))
+    # The late levels were made for the first file, which isn't the current one any more
+    with pytest.raises(storage.PreconditionFailed):
+        publisher.publish('user-1', levels(num_moves=25), if_generation_match=generation)
+    assert publisher.stats()['skipped'] == 0
+
+
+def test_versioned_objects_are_named_after_their_bytes():
+    storage.objects.clear()
+    publisher = BucketPublisher('m3-levels', versioned=True)
+    publisher.publish('user-1', levels(num_moves=20, starting_board=[1] * 56))
+    publisher.forget('user-1')
+    publisher.publish('user-1', levels(num_moves=20, starting_board=[1] * 56))
+    versions = [name for _, name in storage.objects if name.startswith('levels/user-1/')]
+    # Different level_uids, different immutable objects
+    assert len(versions) == 2
@@ -0,0 +1,87 @@
+import json
+import sqlite3
+
+from conftest import endpoint_path
+
+endpoint_path('analyticsEndpoint')
+
+from buffered_writer import BufferedWriter, JsonLinesSink, SqliteSink  # noqa: E402
+
+# Long enough that the timer thread never flushes during a test
+MAX_AGE_SECONDS = 3600
+
+
+class FailingSink:
+    # Fails until it is told to work, then keeps what it was given
+    def __init__(self):
+        self.failing = True
+        self.batches = []
+
+    def write(self, rows):
+        if self.failing:
+            raise ConnectionError("sink is down")
+        self.batches.append(list(rows))
+
+
+def rows(start, stop):
+    return [{'user_id': f'user-{i}', 'screen_name': 'WinScreen', 'current_level': i} for i in range(start, stop)]
+
+
+def read_json_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_flushes_in_bulk_at_max_rows(tmp_path):
+    path = str(tmp_path / 'tracking.jsonl')
+    writer = BufferedWriter(JsonLinesSink(path), max_rows=3, max_age_seconds=MAX_AGE_SECONDS)
+    for row in rows(0, 2):
+        writer.append(row)
+    assert not (tmp_path / 'tracking.jsonl').exists()
+    for row in rows(2, 7):
+        writer.append(row)
+    assert read_json_lines(path) == rows(0, 6)
+    assert writer.stats()['flush_count'] == 2
+    assert writer.stats()['buffered_rows'] == 1
+    writer.flush()
+    assert read_json_lines(path) == rows(0, 7)
+
+
+def test_sqlite_sink(tmp_path):
+    path = str(tmp_path / 'tracking.db')
+    writer = BufferedWriter(SqliteSink(path, 'tracking'), max_rows=100, max_age_seconds=MAX_AGE_SECONDS)
+    for row in rows(0, 5):
+        writer.append(row)
+    assert writer.flush() == 5
+    with sqlite3.connect(path) as conn:
+        payloads = [json.loads(payload) for payload, in conn.execute("SELECT payload FROM tracking ORDER BY rowid")]
+    assert payloads == rows(0, 5)
+
+
+def test_failed_rows_are_retried_in_order():
+    sink = FailingSink()
+    writer = BufferedWriter(sink, max_rows=2, max_age_seconds=MAX_AGE_SECONDS)
+    for row in rows(0, 3):
+        writer.append(row)
+    assert writer.stats()['failed_flushes'] == 2
+    assert writer.stats()['buffered_rows'] == 3
+
+    sink.failing = False
+    writer.append(rows(3, 4)[0])
+    assert sink.batches == [rows(0, 4)]
+    assert writer.stats()['rows_flushed'] == 4
+    assert writer.stats()['dropped_rows'] == 0
+
+
+def test_oldest_rows_are_dropped_while_the_sink_fails():
+    sink = FailingSink()
+    writer = BufferedWriter(sink, max_rows=2, max_age_seconds=MAX_AGE_SECONDS, max_buffered_rows=5)
+    for row in rows(0, 8):
+        writer.append(row)
+    stats = writer.stats()
+    assert stats['buffered_rows'] == 5
+    assert stats['dropped_rows'] == 3
+
+    sink.failing = False
+    assert writer.flush() == 5
+    assert sink.batches == [rows(3, 8)]
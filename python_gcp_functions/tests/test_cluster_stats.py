@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+from cluster_stats import MAX_BINS, ClusterStats, QuantileSketch  # noqa: E402
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+# Largest difference from the exact pandas quantile once centroids are merged, as a share of the range of values
+MAX_RELATIVE_ERROR = 0.01
+
+DISTRIBUTIONS = {
+    'uniform scores': lambda rng, n: rng.integers(300, 2500, n),
+    'normal scores': lambda rng, n: np.round(rng.normal(1200, 300, n)),
+    'lognormal clicks': lambda rng, n: np.round(rng.lognormal(3, 1, n)),
+    'few distinct values': lambda rng, n: rng.poisson(3, n)
+}
+
+
+def sketch_of(values, max_bins=MAX_BINS):
+    sketch = QuantileSketch(max_bins)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+@pytest.mark.parametrize('distribution', DISTRIBUTIONS)
+@pytest.mark.parametrize('seed', range(3))
+def test_quantiles_within_bound_of_pandas(distribution, seed):
+    values = DISTRIBUTIONS[distribution](np.random.default_rng(seed), 20000)
+    sketch = sketch_of(values)
+    exact = pd.Series(values)
+    value_range = values.max() - values.min()
+    for q in QUANTILES:
+        assert abs(sketch.quantile(q) - exact.quantile(q)) <= MAX_RELATIVE_ERROR * value_range, q
+
+
+def test_quantiles_exact_while_few_distinct_values():
+    values = np.random.default_rng(0).integers(0, MAX_BINS, 5000)
+    sketch = sketch_of(values)
+    for q in np.linspace(0, 1, 21):
+        assert sketch.quantile(q) == pytest.approx(pd.Series(values).quantile(q))
+
+
+def test_moments_are_exact():
+    values = np.random.default_rng(1).integers(300, 2500, 10000)
+    sketch = sketch_of(values)
+    assert sketch.count == len(values)
+    assert sketch.mean() == pytest.approx(values.mean())
+    assert (sketch.min, sketch.max) == (values.min(), values.max())
+
+
+def test_merged_sketches_within_bound_of_pandas():
+    values = np.random.default_rng(2).integers(300, 2500, 20000)
+    merged = sketch_of(values[:7000]).merge(sketch_of(values[7000:]))
+    assert merged.count == len(values)
+    assert merged.mean() == pytest.approx(values.mean())
+    value_range = values.max() - values.min()
+    for q in QUANTILES:
+        assert abs(merged.quantile(q) - pd.Series(values).quantile(q)) <= MAX_RELATIVE_ERROR * value_range
+
+
+def test_sketch_survives_serialisation():
+    sketch = sketch_of(np.random.default_rng(3).integers(0, 1000, 3000))
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+    assert (restored.count, restored.total, restored.min, restored.max) == \
+        (sketch.count, sketch.total, sketch.min, sketch.max)
+    assert [restored.quantile(q) for q in QUANTILES] == [sketch.quantile(q) for q in QUANTILES]
+
+
+def test_describe_against_pandas():
+    rng = np.random.default_rng(4)
+    df = pd.DataFrame({
+        'num_different_pieces': rng.integers(3, 6, 3000), 'board_width': 5, 'board_height': 5,
+        'score': rng.integers(300, 2500, 3000), 'moves_left': rng.integers(0, 10, 3000),
+        'num_failed_moves': rng.integers(0, 6, 3000), 'num_clicks_on_board': rng.integers(20, 60, 3000),
+        'num_boosters_used': rng.integers(0, 3, 3000)
+    })
+    stats = ClusterStats()
+    for row in df.to_dict('records'):
+        stats.add(row)
+    stats = ClusterStats.from_json(stats.to_json())
+
+    cluster = df[df['num_different_pieces'] == 4]
+    described = stats.describe({'num_different_pieces': 4, 'board_width': 5, 'board_height': 5})
+    assert described['avg_score'] == pytest.approx(round(cluster['score'].mean(), 2))
+    assert described['min_score'] == cluster['score'].min()
+    assert described['max_score'] == cluster['score'].max()
+    assert abs(described['median_score'] - cluster['score'].median()) <= MAX_RELATIVE_ERROR * 2200
+    assert described['median_moves_left'] == cluster['moves_left'].median()
+
+    unknown = stats.describe({'num_different_pieces': 9, 'board_width': 5, 'board_height': 5})
+    assert set(unknown.values()) == {0}
@@ -0,0 +1,31 @@
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import main  # noqa: E402
+import payloads  # noqa: E402
+
+
+def completion(user_id, date_sent):
+    body = payloads.level_stats_payload(user_id=user_id, strategy='random')
+    body['level']['dateSent'] = date_sent
+    return body
+
+
+@pytest.mark.parametrize('body, error', [
+    ({'completions': []}, "completions is empty"),
+    ({'completions': None}, "completions is empty"),
+    ({'completions': [completion('user-1', '2024-01-01 10:00:00'), completion('user-2', '2024-01-01 10:01:00')]},
+     "completions of more than one userId"),
+    ({'completions': [{'moves': []}]}, "every completion needs level.userId")
+])
+def test_bad_batches_are_rejected(body, error):
+    assert main.main(payloads.FakeRequest(body)) == (error, 400)
+
+
+def test_batches_of_one_player_are_accepted():
+    assert main.batch_error({'completions': [completion('user-1', '2024-01-01 10:00:00'),
+                                             completion('user-1', '2024-01-01 10:01:00')]}) is None
+    assert main.batch_error(completion('user-1', '2024-01-01 10:00:00')) is None
@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('genDefaultLevelsEndpoint')
+
+import main  # noqa: E402
+import payloads  # noqa: E402
+from default_sets import DefaultSetCache  # noqa: E402
+from llm_cache import MemoryStorage, ResponseCache  # noqa: E402
+
+LEVELS = [{'num_different_pieces': 4, 'score_goal': 900, 'board_width': 5, 'board_height': 5, 'num_moves': 25,
+           'collection_goals': [10, 12]}]
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    calls = []
+
+    def call_to_openai():
+        calls.append(1)
+        return {'levels': [dict(level) for level in LEVELS]}
+    monkeypatch.setattr(main, 'call_to_openai', call_to_openai)
+    monkeypatch.setattr(main, 'DEFAULT_SET_REFRESH_TOKEN', 'secret')
+    monkeypatch.setattr(main, 'gpt_default_set', DefaultSetCache(
+        'm3-levels', main.filename_gpt, lambda levels, metadata: main.levels_to_bucket(main.filename_gpt, levels,
+                                                                                       metadata)))
+    monkeypatch.setattr(main, 'llm_cache', ResponseCache(MemoryStorage()))
+    return calls
+
+
+def request(**fields):
+    return payloads.FakeRequest({'levelsServingStrategy': 'gpt', **fields})
+
+
+def test_force_refresh_needs_the_token(llm_calls):
+    main.main(request())
+    calls = len(llm_calls)
+    main.main(request(forceRefresh=True))
+    main.main(request(forceRefresh=True, refreshToken='guess'))
+    main.main(request(forceRefresh=True, refreshToken=['secret']))
+    assert len(llm_calls) == calls
+
+    main.main(request(forceRefresh=True, refreshToken='secret'))
+    assert len(llm_calls) == calls + 1
+
+
+def test_force_refresh_is_off_without_a_token_configured(llm_calls, monkeypatch):
+    monkeypatch.setattr(main, 'DEFAULT_SET_REFRESH_TOKEN', '')
+    main.main(request())
+    calls = len(llm_calls)
+    main.main(request(forceRefresh=True, refreshToken=''))
+    assert len(llm_calls) == calls
@@ -0,0 +1,65 @@
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import clients  # noqa: E402
+import main  # noqa: E402
+import payloads  # noqa: E402
+from feature_store import FeatureStore, MemoryBackend, sync_user  # noqa: E402
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    # The queries sent to BigQuery; the player has 2 rows in match3.player_data
+    sent = []
+
+    def query_rows(query, params=None):
+        sent.append(query)
+        return [{'completions': 2}] if 'COUNT(*)' in query else []
+    monkeypatch.setattr(clients, 'query_rows', query_rows)
+    return sent
+
+
+def level(level_uid):
+    return {'level_uid': level_uid, 'num_different_pieces': 4, 'score_goal': 900, 'num_moves': 20, 'board_width': 7,
+            'board_height': 8, 'collection_goals': [10, 5]}
+
+
+def test_store_is_trusted_for_levels_it_served(queries):
+    store = FeatureStore(MemoryBackend())
+    assert sync_user(store, 'user-1', verify=False, level_uid='LUID-default') is None
+    assert queries == ["SELECT * FROM match3.player_levels(@user_id)"]
+    store.add_levels([level('LUID-1')])
+
+    queries.clear()
+    sync_user(store, 'user-1', verify=False, level_uid='LUID-1')
+    assert queries == []
+
+
+def test_levels_served_elsewhere_check_the_player(queries):
+    store = FeatureStore(MemoryBackend())
+    sync_user(store, 'user-1', verify=False)
+    queries.clear()
+    # The store missed completions, the player is backfilled again
+    assert sync_user(store, 'user-1', verify=False, level_uid='LUID-other') == 2
+    assert len(queries) == 2 and 'COUNT(*)' in queries[0]
+    assert store.player_data_count('user-1') == 2
+
+    queries.clear()
+    store.add_completion('user-1', {'level_compl_id': 'LUID-other'})
+    store.set_player_data_count('user-1', 3)
+    store.add_levels([level('LUID-2')])
+    assert sync_user(store, 'user-1', verify=False, level_uid='LUID-2') == 3
+    # verify checks the player on every completion
+    assert sync_user(store, 'user-1', verify=True, level_uid='LUID-2') == 2
+    assert sum('COUNT(*)' in query for query in queries) == 1
+
+
+def test_random_levels_make_no_queries(queries, monkeypatch):
+    monkeypatch.setattr(main, 'cluster_stats_ready', False)
+    body = payloads.level_stats_payload(user_id='user-random', strategy='random')
+    main.main(payloads.FakeRequest(body))
+    assert queries == []
+    assert not main.feature_store.has_user('user-random')
@@ -0,0 +1,106 @@
+import csv
+import gzip
+import json
+
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('analyticsEndpoint')
+
+from funnel import FunnelAggregator  # noqa: E402
+
+TRACKING = [
+    # screen_name, world_served, game_version, current_level
+    ('WinScreen', 'gpt', '3', '1'),
+    ('LostScreen', 'gpt', '3', '1'),
+    ('WinScreen', 'random', '3', '2'),
+    ('InstructionScreen', 'random', '3', '1'),
+    ('LostScreen', 'random', '', '1'),
+    ('WinScreen', 'gpt-stats', '4', '5'),
+    ('EndGameScreen', 'gpt', '4', '6'),
+]
+EXPECTED = {
+    ('gpt', '3', 'all_levels', 'level_completed'): 2, ('gpt', '3', 'first_level', 'level_completed'): 2,
+    ('gpt', '3', 'all_levels', 'level_passed'): 1, ('gpt', '3', 'first_level', 'level_passed'): 1,
+    ('random', '3', 'all_levels', 'level_completed'): 1, ('random', '3', 'all_levels', 'level_passed'): 1,
+    ('random', '', 'all_levels', 'level_completed'): 1, ('random', '', 'first_level', 'level_completed'): 1,
+    ('gpt-stats', '4', 'all_levels', 'level_completed'): 1, ('gpt-stats', '4', 'all_levels', 'level_passed'): 1,
+}
+
+
+class Stop(Exception):
+    pass
+
+
+def write_csv(path):
+    # user_id has quoted line breaks, as free text exported to CSV can
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user_id', 'screen_name', 'world_served', 'game_version', 'current_level'])
+        for i, row in enumerate(TRACKING):
+            writer.writerow([f'user {i}\nsecond line' if i % 2 else f'user {i}', *row])
+            if i == 3:
+                f.write('\n')
+
+
+def write_json_lines(path):
+    with open(path, 'w') as f:
+        for i, (screen_name, world_served, game_version, current_level) in enumerate(TRACKING):
+            f.write(json.dumps({'user_id': f'user {i}\n', 'screen_name': screen_name, 'world_served': world_served,
+                                'game_version': game_version, 'current_level': current_level}) + '\n')
+
+
+@pytest.fixture(params=['tracking.csv', 'tracking.csv.gz', 'tracking.json'])
+def export(request, tmp_path):
+    path = str(tmp_path / request.param)
+    write_json_lines(path) if request.param.endswith('.json') else write_csv(path)
+    return path
+
+
+def test_counts_in_chunks(export):
+    for chunk_rows in (1, 2, 100):
+        aggregator = FunnelAggregator()
+        aggregator.read_file(export, chunk_rows)
+        assert dict(aggregator.counts) == EXPECTED
+        assert aggregator.rows == len(TRACKING)
+
+
+def test_resumes_from_the_checkpoint(export, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    aggregator = FunnelAggregator()
+    chunks = []
+
+    def stop_after_two_chunks():
+        aggregator.save(checkpoint)
+        chunks.append(1)
+        if len(chunks) == 2:
+            raise Stop()
+    with pytest.raises(Stop):
+        aggregator.read_file(export, 3, stop_after_two_chunks)
+
+    resumed = FunnelAggregator.load(checkpoint)
+    resumed.read_file(export, 3)
+    assert dict(resumed.counts) == EXPECTED
+    assert resumed.rows == len(TRACKING)
+    # Nothing is counted twice when the file is read again
+    resumed.read_file(export, 3)
+    assert dict(resumed.counts) == EXPECTED
+
+
+def test_event_names_for_the_stan_models(export, tmp_path):
+    aggregator = FunnelAggregator()
+    aggregator.read_file(export)
+    output = tmp_path / 'level_data_final.csv'
+    # By default the events have the names levels.R filters on
+    aggregator.write_csv(str(output))
+    rows = list(csv.DictReader(output.open()))
+    assert list(rows[0]) == ['serving_strategy', 'level_group', 'event_name', 'cnt']
+    assert [row['event_name'] for row in rows[:4]] == ['level_start', 'level_end'] * 2
+    assert {(row['serving_strategy'], row['level_group'], row['event_name']): int(row['cnt']) for row in rows}[
+        ('gpt', 'all_levels', 'level_start')] == 2
+
+    aggregator.write_csv(str(output), event_names=['level_completed', 'level_passed'])
+    rows = list(csv.DictReader(output.open()))
+    assert [row['event_name'] for row in rows[:2]] == ['level_completed', 'level_passed']
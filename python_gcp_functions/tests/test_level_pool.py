@@ -0,0 +1,77 @@
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import level_pool  # noqa: E402
+from level_pool import LevelPool, MemoryPoolBackend, SqlitePoolBackend  # noqa: E402
+
+
+class Clock:
+    now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+class QueuedRefills:
+    # Refills run when the test says so
+    def __init__(self):
+        self.handler = None
+        self.queued = []
+
+    def enqueue(self, user_id, strategy):
+        self.queued.append((user_id, strategy))
+
+    def run(self):
+        queued, self.queued = self.queued, []
+        for user_id, strategy in queued:
+            self.handler(user_id, strategy)
+
+
+class Generator:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, user_id, strategy, variant=0):
+        self.calls.append(variant)
+        return f'descriptions {len(self.calls)}', {'levels': [], 'set': len(self.calls)}, None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(level_pool, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    return MemoryPoolBackend() if request.param == 'memory' else SqlitePoolBackend(str(tmp_path / 'pool.db'))
+
+
+def test_refill_makes_variants_after_the_first_set(clock, backend):
+    generate, refills = Generator(), QueuedRefills()
+    pool = LevelPool(backend, generate, refills, size=3)
+    assert pool.take('user-1', 'gpt') is None
+    refills.run()
+    # The first set may come from the LLM cache, the others are asked for as variants
+    assert generate.calls == [0, 1, 2]
+    assert [pool.take('user-1', 'gpt')['response_json']['set'] for _ in range(3)] == [1, 2, 3]
+
+
+def test_sets_older_than_max_age_are_not_served(clock, backend):
+    generate, refills = Generator(), QueuedRefills()
+    pool = LevelPool(backend, generate, refills, size=2, max_age_seconds=600)
+    pool.take('user-1', 'gpt')
+    refills.run()
+    clock.now += 601
+    assert pool.take('user-1', 'gpt') is None
+    assert pool.expired == 2
+    assert backend.size('user-1', 'gpt') == 0
+
+    refills.run()
+    clock.now += 599
+    assert pool.take('user-1', 'gpt')['response_json']['set'] == 3
+    assert (pool.served_from_pool, pool.served_empty) == (1, 2)
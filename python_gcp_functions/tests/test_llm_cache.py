@@ -0,0 +1,43 @@
+import random
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import main  # noqa: E402
+import payloads  # noqa: E402
+import stages  # noqa: E402
+from google.cloud import bigquery  # noqa: E402
+from llm_cache import MemoryStorage, ResponseCache  # noqa: E402
+
+
+def test_cached_responses_have_no_text_about_another_player(monkeypatch):
+    monkeypatch.setattr(main, 'llm_cache', ResponseCache(MemoryStorage()))
+    # Both players have the same profile
+    monkeypatch.setattr(main, 'player_profile', lambda user_id, use_stats, player_type=None: 'profile')
+    monkeypatch.setattr(main, 'call_to_openai', lambda descriptions, on_level=None, player_type=None, variant=0: {
+        'player_type': 'casual player', 'type_explanation': f'About {descriptions}', 'levels': [{'num_moves': 20}]})
+
+    first, first_hit = main.cached_call_to_openai('user-1', 'player one', False)
+    assert first['type_explanation'] == 'About player one'
+    second, second_hit = main.cached_call_to_openai('user-2', 'player two', False)
+    assert (first_hit, second_hit) == (False, True)
+    assert 'type_explanation' not in second
+    assert second['levels'] == first['levels']
+    assert second['player_type'] == 'casual player'
+
+
+def test_cache_hits_are_logged(monkeypatch):
+    monkeypatch.setattr(main, 'llm_cache', ResponseCache(MemoryStorage()))
+    bigquery.written['match3.logs'].clear()
+    # New players with the same first level have the same profile
+    for user_id in ['user-new-1', 'user-new-2']:
+        body = payloads.level_stats_payload(random.Random(0), user_id=user_id, strategy='gpt')
+        main.main(payloads.FakeRequest(body))
+    main.main(payloads.FakeRequest(payloads.level_stats_payload(user_id='user-new-3', strategy='random')))
+    stages.drain_background()
+    rows = {row['user_id']: row for row in bigquery.written['match3.logs']}
+    assert rows['user-new-1']['llm_cache_hit'] is False
+    assert rows['user-new-2']['llm_cache_hit'] is True
+    assert rows['user-new-2']['resp_type_explanation'] == ''
+    assert rows['user-new-3']['llm_cache_hit'] is None
@@ -0,0 +1,81 @@
+import numpy as np
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+from match3_sim import (EMPTY, estimate_pass_rates, find_matches, match_counts_per_swap, new_boards,  # noqa: E402
+                        resolve, simulate_level, swap_coordinates)
+
+LEVEL = {'num_different_pieces': 4, 'score_goal': 900, 'board_width': 5, 'board_height': 5, 'num_moves': 20,
+         'collection_goals': [10, 8]}
+
+
+def board(columns):
+    # One board from its columns, each listed from the bottom up
+    return np.array([columns], dtype=np.int8)
+
+
+def resolve_one(columns, num_pieces=2, num_goals=2):
+    boards, score, collected = resolve(board(columns), np.ones(1, dtype=bool), num_pieces, num_goals,
+                                       np.random.default_rng(0))
+    return int(score[0]), collected[0].tolist()
+
+
+def test_three_pieces_score_20_each():
+    # A 3 x 1 board: the refill can't make another match
+    assert resolve_one([[1], [1], [1]]) == (60, [0, 3])
+
+
+def test_four_or_more_pieces_get_the_bonus():
+    assert resolve_one([[0], [0], [0], [0]]) == (4 * (20 + 20), [4, 0])
+
+
+def test_cascades_raise_the_multiplier():
+    # One column: the three 1s are cleared, then the 0s fall onto the 0 below and are cleared at multiplier 2
+    assert resolve_one([[0, 1, 1, 1, 0, 0]]) == (3 * 20 + 3 * 20 * 2, [3, 3])
+
+
+def test_goal_i_collects_piece_i():
+    assert resolve_one([[2], [2], [2]], num_pieces=3, num_goals=3) == (60, [0, 0, 3])
+    # Pieces without a goal score but aren't collected
+    assert resolve_one([[2], [2], [2]], num_pieces=3, num_goals=2) == (60, [0, 0])
+
+
+def test_new_boards_are_playable():
+    rng = np.random.default_rng(0)
+    boards = new_boards(50, 5, 6, 5, rng)
+    assert not (boards == EMPTY).any()
+    assert not find_matches(boards).any()
+    assert (match_counts_per_swap(boards, swap_coordinates(5, 6)) > 0).any(axis=1).all()
+
+
+def test_a_third_of_the_score_goal_passes():
+    # One move scores at least 60
+    assert simulate_level({**LEVEL, 'num_moves': 1, 'score_goal': 180, 'collection_goals': []},
+                          playouts=50, seed=0)['pass_rate'] == 1.0
+    assert simulate_level({**LEVEL, 'num_moves': 1, 'score_goal': 10 ** 7, 'collection_goals': []},
+                          playouts=50, seed=0)['pass_rate'] == 0.0
+    # Collection goals must be collected too
+    assert simulate_level({**LEVEL, 'num_moves': 1, 'score_goal': 180, 'collection_goals': [1000]},
+                          playouts=50, seed=0)['pass_rate'] == 0.0
+
+
+def test_simulations_are_seeded():
+    assert simulate_level(LEVEL, playouts=50, seed=1) == simulate_level(LEVEL, playouts=50, seed=1)
+
+
+def test_estimate_pass_rates():
+    easy = {**LEVEL, 'score_goal': 300, 'collection_goals': [3, 3], 'num_moves': 30}
+    hard = {**LEVEL, 'num_different_pieces': 5, 'score_goal': 6000, 'collection_goals': [30, 30, 30],
+            'num_moves': 10}
+    results = estimate_pass_rates([easy, hard, LEVEL], playouts=40, seed=3, processes=1)
+    assert len(results) == 3
+    for result in results:
+        assert 0.0 <= result['pass_rate'] <= 1.0
+        assert result['playouts'] == 40
+        assert result['avg_score'] >= 0
+    assert results[0]['pass_rate'] > results[1]['pass_rate']
+    assert results[1]['pass_rate'] == 0.0 and results[1]['avg_moves_left'] == 0.0
+    # Every level has its own seed, the results don't depend on the processes
+    assert estimate_pass_rates([easy, hard, LEVEL], playouts=40, seed=3, processes=2) == results
@@ -0,0 +1,122 @@
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import fake_service  # noqa: E402
+import moves_staging  # noqa: E402
+from google.cloud import bigquery, storage  # noqa: E402
+from moves_staging import MOVES_SCHEMA, ParquetStager, moves_to_record_batch  # noqa: E402
+
+INTERVAL = 300
+TABLE = 'match3.moves'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000 * INTERVAL
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(moves_staging, 'time', clock)
+    yield clock
+    fake_service.configure(failures={})
+
+
+@pytest.fixture(params=['local', 'gcs'])
+def staging_uri(request, tmp_path):
+    bigquery.written.clear()
+    if request.param == 'local':
+        return str(tmp_path / 'staging')
+    storage.objects.clear()
+    return f"gs://staging-bucket/moves-{tmp_path.name}"
+
+
+def stager(staging_uri):
+    # Nothing is written or loaded by the worker thread unless the test moves the clock
+    return ParquetStager(staging_uri, TABLE, MOVES_SCHEMA, max_rows=10 ** 9, max_age_seconds=60,
+                         load_interval_seconds=INTERVAL)
+
+
+def batch(level_compl_id, num_moves=3):
+    return moves_to_record_batch([{'moveNumber': i, 'createTime': '2024-01-01 10:00:00', 'durationInSeconds': 1.5,
+                                   'isMoveLegal': True, 'scoreForMove': 10, 'starsForMove': 0,
+                                   'swipeDirection': 'left'} for i in range(num_moves)], level_compl_id)
+
+
+def loads():
+    # Load jobs that went into match3.moves (one entry per gs:// file or per local load)
+    return list(bigquery.written[TABLE])
+
+
+def test_files_of_a_scaled_down_instance_are_loaded_by_another(clock, staging_uri):
+    gone = stager(staging_uri)
+    gone.add(batch('level-1'))
+    gone.add(batch('level-2'))
+    # At exit the batches are only written out
+    gone.stage()
+    assert len(gone.pending_files()) == 1
+    assert loads() == []
+
+    other = stager(staging_uri)
+    other.flush()
+    assert len(loads()) == 1
+    assert other.pending_files() == []
+    assert other.load_jobs == 1
+
+
+def test_only_finished_windows_are_loaded(clock, staging_uri):
+    instance = stager(staging_uri)
+    instance.add(batch('level-1'))
+    instance.stage()
+    clock.now += INTERVAL - 1
+    instance.add(batch('level-2'))
+    instance.stage()
+    with instance._io_lock:
+        instance._load()
+    assert loads() == []
+
+    clock.now += INTERVAL + 60
+    with instance._io_lock:
+        instance._load()
+    assert len(loads()) == (2 if instance.is_gcs else 1)
+    assert instance.pending_files() == []
+
+
+def test_same_files_are_loaded_once(clock, staging_uri):
+    if not staging_uri.startswith('gs://'):
+        pytest.skip("a local staging directory belongs to one instance")
+    first, second = stager(staging_uri), stager(staging_uri)
+    first.add(batch('level-1'))
+    first.stage()
+    files = second.pending_files()
+    first.flush()
+    loaded = loads()
+    # The second instance listed the files before they were deleted, its job has the same id
+    second._load_files(files)
+    assert loads() == loaded
+    assert second.load_jobs == 0
+
+
+def test_failed_load_is_retried_with_the_next_job_id(clock, staging_uri):
+    instance = stager(staging_uri)
+    instance.add(batch('level-1'))
+    instance.stage()
+    files = instance.pending_files()
+    fake_service.configure(failures={'bigquery.load': 1})
+    instance.flush()
+    assert loads() == []
+    assert instance.pending_files() == files
+    assert bigquery.jobs[instance.job_id(files, 0)].error_result
+
+    fake_service.configure(failures={})
+    instance.flush()
+    assert len(loads()) == 1
+    assert instance.job_id(files, 1) in bigquery.jobs
+    assert instance.pending_files() == []
@@ -0,0 +1,98 @@
+import json
+import math
+import random
+
+import numpy as np
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+from player_classifier import (FEATURE_NAMES, PLAYER_TYPES, PlayerClassifier, features_json,  # noqa: E402
+                               history_features, read_logs_export, train)
+
+
+def history_row(rng, skill, level_in_row):
+    score_goal = rng.choice([500, 1000, 1500])
+    return {
+        'level_in_row': level_in_row, 'level_compl_id': f'level-{level_in_row}', 'level_passed': skill > 0.4,
+        'score': int(score_goal * (0.5 + skill + rng.uniform(-0.1, 0.1))), 'moves_left': int(20 * skill),
+        'num_failed_moves': int(6 * (1 - skill)), 'num_clicks_on_board': rng.randint(20, 40),
+        'num_boosters_used': rng.randint(0, 2), 'user_rating': rng.choice([None, 3, 4]),
+        'num_different_pieces': rng.randint(3, 6), 'score_goal': score_goal, 'num_moves': 20, 'board_width': 7,
+        'board_height': 8,
+        'collection_goals': [rng.randint(5, 15), rng.randint(5, 15)] if level_in_row % 2 else None
+    }
+
+
+def history(rng, label, num_levels=8):
+    skill = {0: 0.1, 1: 0.5, 2: 0.9}[label] + rng.uniform(-0.05, 0.05)
+    return [history_row(rng, skill, i + 1) for i in range(num_levels)]
+
+
+def logs_row(rng, label, **columns):
+    return {'description': 'For level 1, the user scored ...', 'resp_player_type': PLAYER_TYPES[label],
+            'classifier_features': features_json(history_features(history(rng, label))), **columns}
+
+
+def write_export(tmp_path, rows):
+    path = tmp_path / 'logs.json'
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    return str(path)
+
+
+def test_history_features():
+    rows = [history_row(random.Random(0), 0.5, i + 1) for i in range(3)]
+    rows[1]['score'] = None
+    for row in rows:
+        row['user_rating'] = None
+    x = history_features(rows)
+    assert len(x) == len(FEATURE_NAMES)
+    features = dict(zip(FEATURE_NAMES, x))
+    # Means over the levels that have the value
+    assert features['score_ratio'] == np.mean([rows[0]['score'] / rows[0]['score_goal'],
+                                               rows[2]['score'] / rows[2]['score_goal']])
+    assert math.isnan(features['user_rating'])
+    assert features['collection_goals_total'] == np.mean([sum(rows[0]['collection_goals']),
+                                                          sum(rows[2]['collection_goals'])])
+    assert features['log_num_levels'] == math.log1p(3)
+
+
+def test_classify_from_history():
+    rng = random.Random(0)
+    examples = [(history_features(history(rng, label)), label) for label in [0, 1, 2] * 30]
+    model = train(examples, holdout=0)
+    for label in range(len(PLAYER_TYPES)):
+        player_type, probability = model.classify(history(rng, label))
+        assert player_type == PLAYER_TYPES[label]
+        assert 0 < probability <= 1
+    assert model.classify([]) == (None, 0.0)
+    assert PlayerClassifier.from_json(model.to_json()).classify(history(rng, 2))[0] == PLAYER_TYPES[2]
+
+
+def test_read_logs_export_keeps_llm_labels_only(tmp_path):
+    rng = random.Random(0)
+    rows = [
+        logs_row(rng, 0, player_type_source='llm'),
+        # Logged before player_type_source existed
+        logs_row(rng, 1),
+        # The LLM was told the classifier's type
+        logs_row(rng, 2, player_type_source='classifier', classifier_player_type=PLAYER_TYPES[2]),
+        logs_row(rng, 2, player_type_source='llm', classifier_player_type=PLAYER_TYPES[1]),
+        {'description': 'Data was randomly generated', 'resp_player_type': 'Data was randomly generated'}
+    ]
+    examples = read_logs_export(write_export(tmp_path, rows))
+    assert [label for _, label in examples] == [0, 1, 2]
+    assert np.allclose(examples[0][0], history_features(history(random.Random(0), 0)), atol=1e-4,
+                       equal_nan=True)
+
+
+def test_read_logs_export_parses_old_descriptions(tmp_path):
+    description = ("For level 1, the user scored 900 where 1000 was the minimum to pass. They had 3 moves left out "
+                   "of 20. They made 2 failed moves. They made 30 clicks on the board. They used 1 boosters."
+                   "Player rated the level as None out of 5. The level contained 4 different pieces. "
+                   "Board width x height was 7 x 8. Collection goals were [5, 10].")
+    rows = [{'description': description, 'resp_player_type': 'casual player'}]
+    (x, label), = read_logs_export(write_export(tmp_path, rows))
+    assert label == 1
+    assert dict(zip(FEATURE_NAMES, x))['score_ratio'] == 0.9
@@ -0,0 +1,25 @@
+import filecmp
+import os
+from collections import defaultdict
+
+from conftest import ENDPOINTS, FUNCTIONS_DIR
+
+# Modules with the same name in several function folders are copies of one module (every folder is deployed on
+# its own, with its own copy). A change to one copy has to be copied over the others.
+
+
+def shared_modules():
+    copies = defaultdict(list)
+    for endpoint in ENDPOINTS:
+        for name in sorted(os.listdir(os.path.join(FUNCTIONS_DIR, endpoint))):
+            if name.endswith('.py') and name != 'main.py':
+                copies[name].append(os.path.join(FUNCTIONS_DIR, endpoint, name))
+    return {name: paths for name, paths in copies.items() if len(paths) > 1}
+
+
+def test_copies_are_the_same():
+    modules = shared_modules()
+    assert {'clients.py', 'llm_cache.py', 'level_generator.py'} <= set(modules)
+    for name, paths in modules.items():
+        different = [path for path in paths[1:] if not filecmp.cmp(paths[0], path, shallow=False)]
+        assert not different, f"{name} differs between {paths[0]} and {', '.join(different)}"
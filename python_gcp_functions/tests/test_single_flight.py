@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+from single_flight import CLAIMED, DONE, RUNNING, MemoryFlightStore, SingleFlight, SqliteFlightStore  # noqa: E402
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    return MemoryFlightStore() if request.param == 'memory' else SqliteFlightStore(str(tmp_path / 'flights.db'))
+
+
+class Counter:
+    # fn for SingleFlight.run: counts its calls and, until released, blocks so that duplicates come in while it runs
+    def __init__(self, blocking=False):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not blocking:
+            self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(10)
+        return {'levels': [self.calls]}
+
+
+def test_concurrent_duplicates_run_once(store):
+    flight = SingleFlight(store, poll_seconds=0.01)
+    fn = Counter(blocking=True)
+    results = []
+
+    def send():
+        results.append(flight.run('user-1:LUID-1:2024-01-01 10:00:00', fn))
+    threads = [threading.Thread(target=send) for _ in range(5)]
+    threads[0].start()
+    fn.started.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    fn.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert fn.calls == 1
+    assert sorted(how for _, how in results) == ['ran'] + ['waited'] * 4
+    assert all(result == {'levels': [1]} for result, _ in results)
+    assert flight.stats() == {'runs': 1, 'waited': 4, 'replayed': 0}
+
+
+def test_finished_result_is_replayed(store):
+    flight = SingleFlight(store)
+    fn = Counter()
+    assert flight.run('key', fn) == ({'levels': [1]}, 'ran')
+    assert flight.run('key', fn) == ({'levels': [1]}, 'replayed')
+    assert flight.run('other-key', fn) == ({'levels': [2]}, 'ran')
+    assert fn.calls == 2
+
+
+def test_replayed_result_expires(store):
+    flight = SingleFlight(store, ttl_seconds=0.05)
+    fn = Counter()
+    flight.run('key', fn)
+    time.sleep(0.1)
+    assert flight.run('key', fn) == ({'levels': [2]}, 'ran')
+
+
+def test_failed_run_releases_the_key(store):
+    flight = SingleFlight(store)
+
+    def fail():
+        raise ConnectionError("BigQuery is down")
+    with pytest.raises(ConnectionError):
+        flight.run('key', fail)
+    # The retry runs instead of waiting for the lease of the failed run
+    assert flight.run('key', Counter()) == ({'levels': [1]}, 'ran')
+
+
+def test_expired_lease_is_taken_over(store):
+    # An owner that died while running never completes nor releases the key
+    assert store.claim('key', 'dead-owner', lease_seconds=0.05) == (CLAIMED, None)
+    assert store.claim('key', 'other-owner', lease_seconds=0.05) == (RUNNING, None)
+    time.sleep(0.1)
+    flight = SingleFlight(store, poll_seconds=0.01)
+    assert flight.run('key', Counter()) == ({'levels': [1]}, 'ran')
+    # The late owner doesn't overwrite the result of the one that took over
+    store.complete('key', 'dead-owner', {'levels': ['late']}, ttl_seconds=60)
+    assert store.claim('key', 'next-owner', lease_seconds=60) == (DONE, {'levels': [1]})
+
+
+def test_waiters_take_over_when_the_owner_dies(store):
+    store.claim('key', 'dead-owner', lease_seconds=0.1)
+    flight = SingleFlight(store, poll_seconds=0.01)
+    started = time.time()
+    assert flight.run('key', Counter()) == ({'levels': [1]}, 'ran')
+    assert time.time() - started >= 0.09
+
+
+def test_sqlite_store_is_shared_by_instances(tmp_path):
+    path = str(tmp_path / 'flights.db')
+    first = SingleFlight(SqliteFlightStore(path), poll_seconds=0.01)
+    second = SingleFlight(SqliteFlightStore(path), poll_seconds=0.01)
+    fn = Counter(blocking=True)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(first.run('key', fn)))
+    thread.start()
+    fn.started.wait(10)
+    # The second instance polls the file until the first one is done
+    waiter = threading.Thread(target=lambda: results.append(second.run('key', fn)))
+    waiter.start()
+    time.sleep(0.05)
+    fn.release.set()
+    thread.join(10)
+    waiter.join(10)
+
+    assert fn.calls == 1
+    assert sorted(how for _, how in results) == ['ran', 'waited']
+    assert second.run('key', fn) == ({'levels': [1]}, 'replayed')
+    assert second.stats() == {'runs': 0, 'waited': 1, 'replayed': 1}
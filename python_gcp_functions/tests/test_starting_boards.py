@@ -0,0 +1,63 @@
+import itertools
+
+import numpy as np
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import starting_boards  # noqa: E402
+from match3_sim import find_matches, match_counts_per_swap, swap_coordinates  # noqa: E402
+from starting_boards import StartingBoardCache, attach_starting_boards, decode_board, encode_board  # noqa: E402
+
+# The sizes and piece counts levels are generated with (BOARD_SIZE_RANGE and NUM_DIFFERENT_PIECES_RANGE in main.py)
+BOARD_SIZES = range(4, 7)
+NUM_PIECES = range(3, 6)
+
+
+def level(width=5, height=6, num_pieces=4, **fields):
+    return {'num_different_pieces': num_pieces, 'score_goal': 900, 'board_width': width, 'board_height': height,
+            'num_moves': 20, 'collection_goals': [10, 5], **fields}
+
+
+def test_boards_of_every_size_are_playable():
+    cache = StartingBoardCache(batch_size=64, seed=0)
+    for width, height, num_pieces in itertools.product(BOARD_SIZES, BOARD_SIZES, NUM_PIECES):
+        boards = np.array([decode_board(cache.take(width, height, num_pieces), width, height) for _ in range(64)])
+        assert boards.shape == (64, width, height)
+        assert ((boards >= 0) & (boards < num_pieces)).all()
+        assert not find_matches(boards).any(), (width, height, num_pieces)
+        assert (match_counts_per_swap(boards, swap_coordinates(width, height)) > 0).any(axis=1).all(), \
+            (width, height, num_pieces)
+
+
+def test_encoding_round_trips():
+    board = np.arange(35, dtype=np.int8).reshape(5, 7) % 5
+    assert (decode_board(encode_board(board), 5, 7) == board).all()
+
+
+def test_boards_come_from_the_cached_batch(monkeypatch):
+    batches = []
+    generate = starting_boards.new_boards
+
+    def new_boards(*args):
+        batches.append(args[:4])
+        return generate(*args)
+    monkeypatch.setattr(starting_boards, 'new_boards', new_boards)
+    cache = StartingBoardCache(batch_size=3, seed=0)
+    levels = [level(), level(), level(width=4, height=4, num_pieces=3)]
+    attach_starting_boards(levels, cache)
+    assert batches == [(3, 5, 6, 4), (3, 4, 4, 3)]
+    assert levels[0]['starting_board'] != levels[1]['starting_board']
+
+    # The batch is used up before a new one is generated
+    boards = [cache.take(5, 6, 4) for _ in range(2)]
+    assert len(batches) == 3
+    assert len(set(boards + [levels[0]['starting_board'], levels[1]['starting_board']])) == 4
+
+
+def test_levels_with_a_board_keep_it():
+    levels = [level(starting_board='published-board'), level()]
+    attach_starting_boards(levels, StartingBoardCache(batch_size=2, seed=0))
+    assert levels[0]['starting_board'] == 'published-board'
+    assert decode_board(levels[1]['starting_board'], 5, 6).shape == (5, 6)
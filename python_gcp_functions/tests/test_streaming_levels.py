@@ -0,0 +1,97 @@
+import gzip
+import json
+import random
+
+import pytest
+
+from conftest import endpoint_path
+
+endpoint_path('levelStatsEndpoint')
+
+import main  # noqa: E402
+import openai  # noqa: E402
+import payloads  # noqa: E402
+from google.cloud import storage  # noqa: E402
+from llm_cache import cache_from_env  # noqa: E402
+from streaming_levels import LevelsStreamParser, is_complete_level  # noqa: E402
+
+# Strings with quotes, braces, brackets and the word levels, before and after the levels array
+ARGUMENTS = {
+    'player_type': 'casual "levels": [{"not": "a level"}] player\\',
+    'levels': [
+        {'level_number': 1, 'num_different_pieces': 4, 'score_goal': 900, 'board_width': 5, 'board_height': 5,
+         'num_moves': 25, 'collection_goals': [10, 12], 'note': 'a } and a { in "quotes"'},
+        {'level_number': 2, 'num_different_pieces': 4, 'score_goal': 1200, 'board_width': 5, 'board_height': 6,
+         'num_moves': 26, 'collection_goals': [10, 12, 8], 'nested': {'levels': [{'x': '}]'}]}},
+        {'level_number': 3, 'num_different_pieces': 5, 'score_goal': 1500, 'board_width': 6, 'board_height': 6,
+         'num_moves': 28, 'collection_goals': [12, 12, 10]}
+    ],
+    'type_explanation': 'Not {"levels": [{}]} \\" either'
+}
+
+
+def pieces(text, rng):
+    # text cut at random places, including single characters and empty pieces
+    cuts = sorted(rng.randrange(len(text) + 1) for _ in range(rng.randint(0, len(text) // 3)))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def parse(chunks):
+    parser = LevelsStreamParser()
+    return [level for chunk in chunks for level in parser.feed(chunk)], parser
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_levels_at_any_chunk_boundaries(indent):
+    text = json.dumps(ARGUMENTS, indent=indent)
+    rng = random.Random(0)
+    for _ in range(50):
+        levels, parser = parse(pieces(text, rng))
+        assert levels == ARGUMENTS['levels']
+        assert parser.num_levels == 3
+    assert parse(list(text))[0] == ARGUMENTS['levels']
+
+
+def test_truncated_stream_returns_the_complete_levels():
+    text = json.dumps(ARGUMENTS)
+    second_level_end = text.index('"level_number": 3') - 2
+    for end in range(text.index('"levels"'), second_level_end):
+        levels, _ = parse([text[:end]])
+        assert levels == ARGUMENTS['levels'][:len(levels)]
+    levels, _ = parse([text[:second_level_end]])
+    assert levels == ARGUMENTS['levels'][:2]
+
+
+def test_incomplete_levels_are_not_served():
+    assert is_complete_level(ARGUMENTS['levels'][0])
+    assert not is_complete_level({**ARGUMENTS['levels'][0], 'score_goal': None})
+    assert not is_complete_level({'level_number': 1})
+    assert not is_complete_level([1, 2])
+
+
+def test_levels_published_early_keep_their_uids_and_boards(monkeypatch):
+    storage.objects.clear()
+    monkeypatch.setattr(main, 'STREAM_LEVELS', True)
+    monkeypatch.setattr(main, 'ATTACH_STARTING_BOARDS', True)
+    # A cached response would not be streamed
+    monkeypatch.setattr(main, 'llm_cache', cache_from_env())
+    monkeypatch.setattr(openai, 'ARGUMENTS', ARGUMENTS)
+    early_files = []
+    levels_to_bucket = main.levels_to_bucket
+
+    def record(user_id, json_levels, if_generation_match=None):
+        generation = levels_to_bucket(user_id, json_levels, if_generation_match)
+        body = storage.objects[('m3-levels', f'{user_id}.json')]
+        early_files.append(json.loads(gzip.decompress(body)))
+        return generation
+    monkeypatch.setattr(main, 'levels_to_bucket', record)
+
+    body = payloads.level_stats_payload(user_id='user-stream', strategy='gpt')
+    response_json = main.main(payloads.FakeRequest(body))
+    # One file per level while streaming, then the whole set
+    assert [len(levels) for levels in early_files] == [1, 2, 3, 3]
+    final = early_files[-1]
+    assert final == response_json['levels']
+    for published in early_files[:3]:
+        assert [(level['level_uid'], level['starting_board']) for level in published] == \
+            [(level['level_uid'], level['starting_board']) for level in final[:len(published)]]